@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import multiprocessing
+import time
+
+logger = logging_.getLogger(__name__)
+
+# Positions in the shared state
+_RATE = 0
+_TOKENS = 1
+_LAST_UPDATE = 2
+
+
+class TokenBucket():
+    """
+    Token bucket that limits the bytes/sec uploaded. Up to one second of
+    tokens can be accumulated (the max. burst).
+
+    The state is kept in shared memory: a bucket created before starting
+    worker processes limits the sum of the uploads of all of them (and of all
+    their threads). The rate can be changed at any time, from any process.
+    """
+
+    def __init__(self, rate=0):
+        # rate (0 for no limit), available tokens, time of last update
+        self.state = multiprocessing.Array('d', [rate, rate, time.time()])
+
+    def get_rate(self):
+        return int(self.state[_RATE])
+
+    def set_rate(self, rate):
+        """Sets the max. bytes/sec (0 for no limit)"""
+        assert rate >= 0
+        logger.info("Setting bandwidth limit to %s bytes/sec", rate)
+        with self.state.get_lock():
+            self.state[_RATE] = rate
+            self.state[_TOKENS] = min(self.state[_TOKENS], rate)
+            self.state[_LAST_UPDATE] = time.time()
+
+    def consume(self, size):
+        """
+        Takes `size` tokens, waiting if the tokens aren't available. If `size` is
+        bigger than the available tokens, the bucket goes into debt, and the
+        caller waits until the debt is paid.
+        """
+        with self.state.get_lock():
+            rate = self.state[_RATE]
+            if rate <= 0:
+                return
+            now = time.time()
+            tokens = min(rate, self.state[_TOKENS] + (now - self.state[_LAST_UPDATE]) * rate)
+            tokens -= size
+            self.state[_TOKENS] = tokens
+            self.state[_LAST_UPDATE] = now
+        if tokens < 0:
+            time.sleep(-tokens / rate)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import os
+import sqlite3
+
+from frockup.metadata_record import decode_record
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_CATALOG_FILENAME = '~/.frockup/catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    archive_id TEXT,
+    size INTEGER,
+    data BLOB NOT NULL,
+    PRIMARY KEY (directory, filename)
+);
+CREATE INDEX IF NOT EXISTS metadata_archive_id ON metadata (archive_id);
+CREATE TABLE IF NOT EXISTS versions (
+    directory TEXT NOT NULL PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+-- No conflict clauses in the triggers: the 'OR REPLACE' of the statement that
+-- fires a trigger overrides them
+CREATE TRIGGER IF NOT EXISTS metadata_insert AFTER INSERT ON metadata BEGIN
+    INSERT INTO versions (directory, version) SELECT NEW.directory, 0
+        WHERE NOT EXISTS (SELECT 1 FROM versions WHERE directory = NEW.directory);
+    UPDATE versions SET version = version + 1 WHERE directory = NEW.directory;
+END;
+CREATE TRIGGER IF NOT EXISTS metadata_update AFTER UPDATE ON metadata BEGIN
+    INSERT INTO versions (directory, version) SELECT NEW.directory, 0
+        WHERE NOT EXISTS (SELECT 1 FROM versions WHERE directory = NEW.directory);
+    UPDATE versions SET version = version + 1
+        WHERE directory = NEW.directory OR directory = OLD.directory;
+END;
+CREATE TRIGGER IF NOT EXISTS metadata_delete AFTER DELETE ON metadata BEGIN
+    UPDATE versions SET version = version + 1 WHERE directory = OLD.directory;
+END;
+"""
+
+
+class MetadataCatalog():
+    """
+    Central database with the local metadata of all the files, keyed
+    by (directory, filename). It's an alternative to the per-directory
+    `.frockup.gdbm` databases, that allows tree-wide queries and getting
+    all the entries of a directory with one query.
+
+    The values are stored as in the gdbm databases (serialized by the
+    caller). The archive id and size are copied to their own columns, to be
+    used in queries.
+
+    Each directory has a version, incremented (by triggers) on each change
+    of its entries: see `get_version()`.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = os.path.expanduser(filename or DEFAULT_CATALOG_FILENAME)
+        logger.debug("Opening metadata catalog at '%s'", self.filename)
+        # Used from the upload threads too: the caller must serialize the access
+        self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        # Filenames are byte strings, and may not be valid UTF-8
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def get(self, directory, filename):
+        """Returns the raw value, or None if doesn't exists"""
+        row = self.connection.execute(
+            "SELECT data FROM metadata WHERE directory = ? AND filename = ?",
+            (directory, filename)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_directory(self, directory):
+        """Returns a dict with the raw values of all the files of `directory`"""
+        return dict(self.connection.execute(
+            "SELECT filename, data FROM metadata WHERE directory = ?", (directory,)))
+
+    def get_version(self, directory):
+        """Returns the version of the entries of `directory` (0 if never modified)"""
+        row = self.connection.execute(
+            "SELECT version FROM versions WHERE directory = ?", (directory,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def set(self, directory, filename, raw_data, archive_id=None, size=None, commit=True):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO metadata (directory, filename, archive_id, size, data) "
+            "VALUES (?, ?, ?, ?, ?)", (directory, filename, archive_id, size, raw_data))
+        if commit:
+            self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def import_gdbm_database(catalog, directory):
+    """
+    Imports the entries of the `.frockup.gdbm` database of `directory`
+    (the records are copied as is). Returns the number of imported entries.
+    """
+    import gdbm
+    database = gdbm.open(os.path.join(directory, '.frockup.gdbm'), 'r')
+    try:
+        count = 0
+        key = database.firstkey()
+        while key is not None:
+            raw_data = database[key]
+            data = decode_record(raw_data)
+            catalog.set(directory, key, raw_data, data.get('archive_id'),
+                data.get('stats.st_size'), commit=False)
+            count += 1
+            key = database.nextkey(key)
+        catalog.commit()
+        return count
+    finally:
+        database.close()
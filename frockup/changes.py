@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+from frockup.common import get_config_option
+from frockup.local_metadata import DB_FILENAME
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_CHANGE_INDEX_FILENAME = '~/.frockup/changes.sqlite'
+
+# Options of the passes of `Main.process_directory()` and of the web tier (only the
+# files of the directory). The passes of trees are identified by `get_tree_options()`
+DIRECTORY_PASS = 'directory'
+
+# Name of the dirty entries of whole directories (ie: created or moved in)
+WHOLE_DIRECTORY = ''
+
+# Seconds the changes are accumulated by the watcher before being written
+DEFAULT_BATCH_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    root TEXT NOT NULL PRIMARY KEY,
+    watcher_pid INTEGER,
+    watching_since REAL
+);
+CREATE TABLE IF NOT EXISTS passes (
+    directory TEXT NOT NULL,
+    options TEXT NOT NULL,
+    started REAL NOT NULL,
+    PRIMARY KEY (directory, options)
+);
+CREATE TABLE IF NOT EXISTS dirty (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    UNIQUE (directory, filename)
+);
+"""
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def get_tree_options(max_depth, prune_directories):
+    """Returns the options of the passes of `Main.process_tree()`"""
+    return 'tree:{}:{}'.format(max_depth, ','.join(prune_directories or []))
+
+
+def is_too_recent(ctx, stats):
+    """
+    Returns True if the file is excluded only until it gets older (see `ctx.min_age`):
+    it must be kept in the dirty set, because it won't change again.
+    """
+    return ctx.min_age is not None and time.time() - stats.st_mtime < ctx.min_age
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _is_inside(directory, root):
+    return directory == root or directory.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class ChangeIndex():
+    """
+    Dirty set of the watched trees (see `ChangeWatcher`), shared by all the
+    processes:
+
+    - `roots`: the watched trees. `watching_since` is the time since when
+      all the changes are recorded: NULL while the watches are being added
+      (or if they couldn't be added), and updated when events are lost.
+    - `passes`: when the last complete backup of each directory started (for
+      each set of options, ie: max. depth of a tree).
+    - `dirty`: the files (or whole directories) changed, with a sequence
+      number increased on each change.
+
+    The dirty set of a directory can be used instead of scanning it only if
+    a complete pass started while it was being watched (see `get_dirty()`).
+
+    The methods can be called from different threads.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = os.path.expanduser(filename or DEFAULT_CHANGE_INDEX_FILENAME)
+        logger.debug("Opening change index at '%s'", self.filename)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        # Filenames are byte strings, and may not be valid UTF-8
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    #
+    # Used by the watcher
+    #
+
+    def start_watching(self, root, pid):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO roots (root, watcher_pid, "
+                "watching_since) VALUES (?, ?, NULL)", (root, pid))
+            self.connection.commit()
+
+    def set_watching_since(self, root, watching_since):
+        """Sets since when the changes of `root` are recorded (None if they aren't)"""
+        with self.lock:
+            self.connection.execute("UPDATE roots SET watching_since = ? WHERE root = ?",
+                (watching_since, root))
+            self.connection.commit()
+
+    def stop_watching(self, root):
+        with self.lock:
+            self.connection.execute("UPDATE roots SET watcher_pid = NULL, "
+                "watching_since = NULL WHERE root = ?", (root,))
+            self.connection.commit()
+
+    def add_dirty(self, entries):
+        """Adds `(directory, filename)` entries (`WHOLE_DIRECTORY` as filename for directories)"""
+        with self.lock:
+            # The entries already dirty get a new `seq`
+            self.connection.executemany("INSERT OR REPLACE INTO dirty (directory, filename) "
+                "VALUES (?, ?)", entries)
+            self.connection.commit()
+
+    #
+    # Used by the backups
+    #
+
+    def _get_watching_since(self, directory):
+        """Returns since when all the changes of `directory` are recorded, or None"""
+        for root, watcher_pid, watching_since in self.connection.execute(
+                "SELECT root, watcher_pid, watching_since FROM roots"):
+            if not _is_inside(directory, root):
+                continue
+            if watcher_pid is not None and watching_since is not None and \
+                    _is_running(watcher_pid):
+                return watching_since
+        return None
+
+    def get_max_seq(self):
+        with self.lock:
+            return self.connection.execute("SELECT MAX(seq) FROM dirty").fetchone()[0] or 0
+
+    def get_dirty(self, directory, options, recursive=True):
+        """
+        Returns `(dirty, max_seq)`, where `dirty` is a dict with the dirty directories
+        inside `directory` (only `directory` if not `recursive`) and the set of its
+        dirty files (None for whole directories). Returns None if the directory must
+        be scanned: it isn't being watched, or wasn't completely backed up (with the
+        same `options`) since the watcher started recording its changes.
+        """
+        with self.lock:
+            watching_since = self._get_watching_since(directory)
+            if watching_since is None:
+                return None
+            row = self.connection.execute("SELECT started FROM passes WHERE directory = ? "
+                "AND options = ?", (directory, options)).fetchone()
+            if row is None or row[0] < watching_since:
+                return None
+            if recursive:
+                prefix = directory.rstrip(os.sep) + os.sep
+                # The paths inside `directory` are between `prefix` and the next character
+                rows = self.connection.execute("SELECT seq, directory, filename FROM dirty "
+                    "WHERE directory = ? OR (directory >= ? AND directory < ?)",
+                    (directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+            else:
+                rows = self.connection.execute("SELECT seq, directory, filename FROM dirty "
+                    "WHERE directory = ?", (directory,))
+            dirty = {}
+            max_seq = 0
+            for seq, a_directory, filename in rows:
+                max_seq = max(max_seq, seq)
+                if filename == WHOLE_DIRECTORY:
+                    dirty[a_directory] = None
+                elif a_directory not in dirty:
+                    dirty[a_directory] = set([filename])
+                elif dirty[a_directory] is not None:
+                    dirty[a_directory].add(filename)
+            return dirty, max_seq
+
+    def get_dirty_directories(self, directory):
+        """Returns the directories inside `directory` with changes (watched or not)"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        with self.lock:
+            return set([row[0] for row in self.connection.execute(
+                "SELECT DISTINCT directory FROM dirty WHERE directory = ? OR "
+                "(directory >= ? AND directory < ?)",
+                (directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))])
+
+    def set_pass(self, directory, options, started):
+        """Records a complete backup of `directory` (and all its dirty entries, up to then)"""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO passes (directory, options, "
+                "started) VALUES (?, ?, ?)", (directory, options, started))
+            self.connection.commit()
+
+    def clear(self, directories, max_seq):
+        """Removes the dirty entries of the backed up `directories` (up to `max_seq`)"""
+        with self.lock:
+            self.connection.executemany("DELETE FROM dirty WHERE directory = ? AND seq <= ?",
+                [(directory, max_seq) for directory in directories])
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ChangeTracker():
+    """
+    Used by the backups to process only the entries changed since the last
+    complete backup (when the directory is being watched), and to keep the
+    dirty set up to date:
+
+    - `get_dirty()` when the backup of a directory starts (None means that
+      all the files must be checked)
+    - `add_pending()` with the files that must be checked again (the uploads
+      that failed, and the files too recent to be uploaded)
+    - `done()` when the backup finished
+    """
+
+    def __init__(self, ctx, index=None):
+        self.ctx = ctx
+        self.index = index or ChangeIndex(get_config_option(self.ctx.config, 'changes', 'index'))
+        # (directory, filename) of the files to check again
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def start(self, directory, options, recursive=True):
+        """
+        Returns `(dirty, state)`: `dirty` is the dict returned by `ChangeIndex.get_dirty()`
+        (None for a complete backup), and `state` must be passed to `done()`.
+        """
+        started = time.time()
+        max_seq = self.index.get_max_seq()
+        dirty = self.index.get_dirty(directory, options, recursive)
+        if dirty is None:
+            logger.info("Changes of '%s' not tracked: checking all the files", directory)
+            return None, (directory, options, started, max_seq, True)
+        logger.info("Changes of '%s' tracked: checking %s directories", directory, len(dirty[0]))
+        return dirty[0], (directory, options, started, dirty[1], False)
+
+    def add_pending(self, directory, filename):
+        with self.lock:
+            self.pending.append((directory, filename))
+
+    def done(self, state, directories):
+        """Called when the backup finished: `directories` are the directories processed"""
+        directory, options, started, max_seq, complete = state
+        self.index.clear(directories, max_seq)
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.index.add_dirty(pending)
+        if complete:
+            self.index.set_pass(directory, options, started)
+
+    def close(self):
+        self.index.close()
+
+
+class Inotify():
+    """Minimal wrapper of the inotify API of Linux (see inotify(7))"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_error()
+
+    def _raise_error(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise_error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """Returns a list of `(wd, mask, cookie, name)`, waiting up to `timeout` seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeWatcher():
+    """
+    Watches the trees at `roots` with inotify, and records the changed
+    files and directories in the `ChangeIndex`. The changes are written
+    every `batch_seconds` seconds.
+
+    The changes of a tree stop being tracked (so the backups check all its
+    files) while the watcher isn't running, if the watches can't be added
+    (ie: the limit of `/proc/sys/fs/inotify/max_user_watches` was reached),
+    and until a new complete backup when events are lost (the inotify queue
+    overflowed). Symbolic links to directories aren't followed.
+    """
+
+    def __init__(self, index, roots, batch_seconds=DEFAULT_BATCH_SECONDS):
+        self.index = index
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.batch_seconds = batch_seconds
+        self.inotify = None
+        # wd -> path of the watched directory
+        self.watches = {}
+        self.dirty = set()
+        # Roots whose changes aren't tracked anymore
+        self.untracked = set()
+        self.stopped = False
+
+    def _get_root(self, path):
+        for root in self.roots:
+            if _is_inside(path, root):
+                return root
+        return None
+
+    def _untrack(self, path, error):
+        root = self._get_root(path)
+        logger.warn("Changes of '%s' not tracked (full scans will be done): %s", root, error)
+        if root is not None:
+            self.untracked.add(root)
+            self.index.set_watching_since(root, None)
+
+    def _add_watches(self, top, new=False):
+        """Watches `top` and its sub-directories (marked as dirty if `new`)"""
+        for directory, subdirectories, _ in os.walk(top):
+            try:
+                self.watches[self.inotify.add_watch(directory)] = directory
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    self._untrack(directory, "the limit of inotify watches was reached")
+                    return False
+                # Removed or not readable
+                logger.debug("Couldn't watch '%s': %s", directory, e)
+                subdirectories[:] = []
+                continue
+            if new:
+                self.dirty.add((directory, WHOLE_DIRECTORY))
+        return True
+
+    def _remove_watches(self, top):
+        """Stops watching `top` and its sub-directories (ie: moved out of its place)"""
+        for wd, directory in self.watches.items():
+            if _is_inside(directory, top):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def start(self):
+        self.inotify = Inotify()
+        for root in self.roots:
+            self.index.start_watching(root, os.getpid())
+            logger.info("Adding watches of '%s'...", root)
+            if self._add_watches(root):
+                # Only the changes after all the watches were added are recorded
+                self.index.set_watching_since(root, time.time())
+                logger.info("Watching '%s' (%s directories watched)", root, len(self.watches))
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: any directory may have changed
+            logger.warn("Events lost (the queue overflowed): full scans will be needed")
+            self.flush()
+            for root in self.roots:
+                if root not in self.untracked:
+                    self.index.set_watching_since(root, time.time())
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if directory in self.roots:
+                self._untrack(directory, "the directory was removed or moved")
+            return
+        path = os.path.join(directory, name)
+        if name == DB_FILENAME or path.startswith(self.index.filename):
+            # Written by the backups, or by the watcher itself
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watches(path, new=True)
+            elif mask & IN_MOVED_FROM:
+                self._remove_watches(path)
+            return
+        self.dirty.add((directory, name))
+
+    def flush(self):
+        if self.dirty:
+            logger.debug("Recording %s changes", len(self.dirty))
+            self.index.add_dirty(sorted(self.dirty))
+            self.dirty.clear()
+
+    def run(self):
+        """Records the changes until `stop()` is called"""
+        last_flush = time.time()
+        try:
+            while not self.stopped:
+                for wd, mask, _, name in self.inotify.read_events(self.batch_seconds):
+                    self.handle_event(wd, mask, name)
+                if time.time() - last_flush >= self.batch_seconds:
+                    self.flush()
+                    last_flush = time.time()
+        finally:
+            self.flush()
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        for root in self.roots:
+            self.index.stop_watching(root)
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
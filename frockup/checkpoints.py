@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import binascii
+import hashlib
+import json
+import os
+import threading
+import time
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_DIR = '~/.frockup/checkpoints'
+
+
+class UploadCheckpoint():
+    """
+    State of a multipart upload, saved after each uploaded part, so an
+    interrupted upload can be resumed from the first missing part.
+
+    The state is a dict with: 'filename', 'vault_name', 'upload_id', 'part_size',
+    'file_size', 'mtime', 'created' and 'parts' (tree hash of each uploaded
+    part, by offset).
+    """
+
+    def __init__(self, filename, state):
+        self.filename = filename
+        self.state = state
+        self.lock = threading.Lock()
+
+    @property
+    def upload_id(self):
+        return self.state['upload_id']
+
+    @property
+    def part_size(self):
+        return self.state['part_size']
+
+    def matches(self, stats):
+        """Returns True if the file didn't change since the upload was started"""
+        return self.state['file_size'] == stats.st_size and self.state['mtime'] == stats.st_mtime
+
+    def get_part_hashes(self):
+        """Returns a dict with the tree hash (binary digest) of the uploaded parts, by offset"""
+        with self.lock:
+            return dict([(int(offset), binascii.unhexlify(tree_hash))
+                         for offset, tree_hash in self.state['parts'].iteritems()])
+
+    def add_part(self, offset, tree_hash):
+        with self.lock:
+            self.state['parts'][str(offset)] = binascii.hexlify(tree_hash)
+            self.save()
+
+    def save(self):
+        # Write and rename, to never leave a partially written checkpoint
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as a_file:
+            json.dump(self.state, a_file)
+        os.rename(tmp_filename, self.filename)
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+
+class CheckpointStore():
+    """Directory with the checkpoints of the multipart uploads in progress"""
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or DEFAULT_CHECKPOINT_DIR)
+
+    def _get_filename(self, vault_name, full_filename):
+        key = hashlib.sha1('{0}\0{1}'.format(vault_name, full_filename)).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def _load_file(self, filename):
+        try:
+            with open(filename) as a_file:
+                return UploadCheckpoint(filename, json.load(a_file))
+        except (IOError, ValueError):
+            logger.warn("Ignoring invalid checkpoint at '%s'", filename, exc_info=True)
+            return None
+
+    def load(self, vault_name, full_filename):
+        """Returns the checkpoint of the upload of the file, or None"""
+        filename = self._get_filename(vault_name, full_filename)
+        if not os.path.exists(filename):
+            return None
+        return self._load_file(filename)
+
+    def create(self, vault_name, full_filename, stats, upload_id, part_size):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        checkpoint = UploadCheckpoint(self._get_filename(vault_name, full_filename), {
+            'filename': full_filename,
+            'vault_name': vault_name,
+            'upload_id': upload_id,
+            'part_size': part_size,
+            'file_size': stats.st_size,
+            'mtime': stats.st_mtime,
+            'created': time.time(),
+            'parts': {},
+        })
+        checkpoint.save()
+        return checkpoint
+
+    def get_checkpoints(self):
+        """Returns all the (valid) checkpoints"""
+        if not os.path.isdir(self.directory):
+            return []
+        checkpoints = []
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith('.json'):
+                checkpoint = self._load_file(os.path.join(self.directory, filename))
+                if checkpoint is not None:
+                    checkpoints.append(checkpoint)
+        return checkpoints
@@ -18,17 +18,42 @@
 #===============================================================================
 import os
 import logging
+import threading
 import ConfigParser
 
+from frockup.bandwidth import TokenBucket
+
 EXCLUDED_BY_FILE_FILTER = 'file-filter'
 EXCLUDED_BY_LOCAL_METADATA = 'local-metadata'
 FLAG_FILE_CHANGED_WHILE_UPLOADING = 'file-changed'
 
+# Calls to `stat_file()` done by this process
+_stat_calls = [0]
+_stat_calls_lock = threading.Lock()
+
+
+def stat_file(path, follow_symlinks=True):
+    """`os.stat()` (or `os.lstat()` if not `follow_symlinks`), counting the calls"""
+    with _stat_calls_lock:
+        _stat_calls[0] += 1
+    if follow_symlinks:
+        return os.stat(path)
+    return os.lstat(path)
+
+
+def get_stat_calls():
+    """Returns the number of calls to `stat_file()` done by this process"""
+    return _stat_calls[0]
+
 
 class Context(dict):
-    """Context to share state between all the components"""
+    """
+    Context to share state between all the components.
+    The methods that update the log and counters are thread safe.
+    """
 
     def __init__(self, config=None):
+        self.lock = threading.RLock()
         self.log = {}
         self.excluded_count = 0
         self.included_count = 0
@@ -37,25 +62,117 @@ class Context(dict):
         self.exclude_extensions = []
         self.config = config or get_config()
         self.dry_run = False
+        # Pack small files in bundles (see `frockup.packing`)
+        self.packing = get_config_option(self.config, 'packing', 'enabled', False, bool)
+        # Don't upload files whose contents were already uploaded (see `frockup.dedup`)
+        self.dedup = get_config_option(self.config, 'dedup', 'enabled', False, bool)
+        self.deduplicated_count = 0
+        self.bytes_saved = 0
+        # Recognize moved or renamed files (see `frockup.moves`)
+        self.detect_moves = get_config_option(self.config, 'moves', 'enabled', False, bool)
+        self.moved_count = 0
+        # Check only the files changed since the last backup (see `frockup.changes`)
+        self.track_changes = get_config_option(self.config, 'changes', 'enabled', False, bool)
+        # Files uploaded at the same time, and max. bytes of the files being uploaded
+        self.concurrent_files = get_config_option(self.config, 'upload', 'concurrent_files',
+            1, int)
+        self.max_bytes_in_flight = get_config_option(self.config, 'upload',
+            'max_bytes_in_flight_mb', 256, int) * 1024 * 1024
+        # Shared `TokenBucket` limiting the upload bytes/sec (None for no limit)
+        self.bandwidth_limiter = None
+        bandwidth_limit = get_config_option(self.config, 'upload', 'bandwidth_limit_kbps', 0, int)
+        if bandwidth_limit > 0:
+            self.bandwidth_limiter = TokenBucket(bandwidth_limit * 1024)
+        # Process sub-directories too (up to `max_depth` levels, None for no limit)
+        self.recursive = False
+        self.max_depth = None
+        # Names (or glob patterns) of sub-directories to ignore when `recursive`
+        self.prune_directories = get_config_list(self.config, 'filter', 'prune')
+        # Rules of `CompiledFileFilter` (sizes in bytes, ages in seconds)
+        self.include_globs = get_config_list(self.config, 'filter', 'include_globs')
+        self.exclude_globs = get_config_list(self.config, 'filter', 'exclude_globs')
+        self.exclude_regexes = []
+        exclude_regex = get_config_option(self.config, 'filter', 'exclude_regex')
+        if exclude_regex:
+            self.exclude_regexes.append(exclude_regex)
+        self.min_size = _scale(get_config_option(self.config, 'filter', 'min_size_kb',
+            None, int), 1024)
+        self.max_size = _scale(get_config_option(self.config, 'filter', 'max_size_kb',
+            None, int), 1024)
+        self.min_age = _scale(get_config_option(self.config, 'filter', 'min_age_days',
+            None, float), 24 * 60 * 60)
+        self.max_age = _scale(get_config_option(self.config, 'filter', 'max_age_days',
+            None, float), 24 * 60 * 60)
+        # Files checked, and calls to `stat_file()` done since the counters were reset
+        # (done by all the threads of the process: only accurate for a single job)
+        self.scanned_files = 0
+        self.stat_calls_start = get_stat_calls()
+
+    def reset_log(self):
+        """Clears the log and counters, to re-use the context for another job"""
+        with self.lock:
+            self.log = {}
+            self.excluded_count = 0
+            self.included_count = 0
+            self.error_count = 0
+            self.deduplicated_count = 0
+            self.bytes_saved = 0
+            self.moved_count = 0
+            self.scanned_files = 0
+            self.stat_calls_start = get_stat_calls()
 
     def add_log(self, directory, filename, **kwargs):
-        self.log[directory] = self.log.get(directory, dict())
-        self.log[directory][filename] = self.log[directory].get(filename, dict())
-        self.log[directory][filename].update(**kwargs)
+        with self.lock:
+            self.log[directory] = self.log.get(directory, dict())
+            self.log[directory][filename] = self.log[directory].get(filename, dict())
+            self.log[directory][filename].update(**kwargs)
 
     def add_excluded(self, directory, filename, reason):
-        self.add_log(directory, filename, excluded=True,
-            excluded_reason=reason)
-        self.excluded_count += 1
+        with self.lock:
+            self.add_log(directory, filename, excluded=True,
+                excluded_reason=reason)
+            self.excluded_count += 1
 
     def add_included(self, directory, filename):
-        self.add_log(directory, filename, included=True)
-        self.included_count += 1
+        with self.lock:
+            self.add_log(directory, filename, included=True)
+            self.included_count += 1
 
     def add_error(self, directory, filename, error_type, error_message):
-        self.add_log(directory, filename, error=True, error_type=error_type,
-            error_message=error_message)
-        self.error_count += 1
+        with self.lock:
+            self.add_log(directory, filename, error=True, error_type=error_type,
+                error_message=error_message)
+            self.error_count += 1
+
+    def add_deduplicated(self, directory, filename, size):
+        with self.lock:
+            self.add_log(directory, filename, deduplicated=True)
+            self.deduplicated_count += 1
+            self.bytes_saved += size
+
+    def add_moved(self, directory, filename, old_filename):
+        with self.lock:
+            self.add_log(directory, filename, moved_from=old_filename)
+            self.moved_count += 1
+
+    def add_scanned_file(self):
+        with self.lock:
+            self.scanned_files += 1
+
+    def get_stat_calls(self):
+        return get_stat_calls() - self.stat_calls_start
+
+    def get_stat_calls_per_file(self):
+        if not self.scanned_files:
+            return 0.0
+        return float(self.get_stat_calls()) / self.scanned_files
+
+    def set_bandwidth_limit(self, kbps):
+        """Limits the upload bytes/sec of this context (0 for no limit)"""
+        if self.bandwidth_limiter is None:
+            self.bandwidth_limiter = TokenBucket(kbps * 1024)
+        else:
+            self.bandwidth_limiter.set_rate(kbps * 1024)
 
     def set_include_extensions(self, extensions):
         assert isinstance(extensions, (list, tuple))
@@ -65,6 +182,22 @@ class Context(dict):
         assert isinstance(extensions, (list, tuple))
         self.exclude_extensions = [tmp.lower() for tmp in extensions]
 
+    def set_prune_directories(self, patterns):
+        assert isinstance(patterns, (list, tuple))
+        self.prune_directories = list(patterns)
+
+    def set_include_globs(self, patterns):
+        assert isinstance(patterns, (list, tuple))
+        self.include_globs = list(patterns)
+
+    def set_exclude_globs(self, patterns):
+        assert isinstance(patterns, (list, tuple))
+        self.exclude_globs = list(patterns)
+
+    def set_exclude_regexes(self, regexes):
+        assert isinstance(regexes, (list, tuple))
+        self.exclude_regexes = list(regexes)
+
     def get_log_processed(self):
         #    self.log = {
         #        '/path/to/directory': {
@@ -104,3 +237,29 @@ def get_config(filename=None):
     config = ConfigParser.ConfigParser()
     config.read(config_file)
     return config
+
+
+def get_config_option(config, section, option, default=None, option_type=str):
+    """Returns the value of `option` in `section` of the configuration,
+    or `default` if it isn't defined"""
+    if config is None or not config.has_option(section, option):
+        return default
+    if option_type is int:
+        return config.getint(section, option)
+    if option_type is float:
+        return config.getfloat(section, option)
+    if option_type is bool:
+        return config.getboolean(section, option)
+    return config.get(section, option)
+
+
+def get_config_list(config, section, option):
+    """Returns the comma-separated values of `option`, as a list"""
+    value = get_config_option(config, section, option, '')
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _scale(value, factor):
+    if value is None:
+        return None
+    return value * factor
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import hashlib
+import os
+import sqlite3
+import threading
+
+from frockup.common import get_config_option
+from frockup.glacier import GlacierData
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_DEDUP_INDEX_FILENAME = '~/.frockup/dedup.sqlite'
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (device, inode)
+);
+CREATE TABLE IF NOT EXISTS archives (
+    content_hash TEXT NOT NULL PRIMARY KEY,
+    archive_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    tree_hash TEXT
+);
+"""
+
+
+def hash_file(filename):
+    """Returns the SHA-256 (hex) of the contents of the file"""
+    content_hash = hashlib.sha256()
+    with open(filename, 'rb') as a_file:
+        while True:
+            data = a_file.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            content_hash.update(data)
+    return content_hash.hexdigest()
+
+
+class DedupIndex():
+    """
+    Content-addressed index of the uploaded files, shared by all the backed
+    up directories:
+
+    - `file_hashes`: cache of the hash of the contents of the files, by
+      (device, inode). The cached hash is used only if the size and mtime
+      didn't change, so unchanged files are never re-read.
+    - `archives`: the archive with the contents of each hash.
+
+    The methods can be called from different threads.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = os.path.expanduser(filename or DEFAULT_DEDUP_INDEX_FILENAME)
+        logger.debug("Opening dedup index at '%s'", self.filename)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def get_content_hash(self, full_filename, stats):
+        """Returns the hash of the contents of the file (cached by device/inode/size/mtime)"""
+        key = (stats.st_dev, stats.st_ino)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content_hash FROM file_hashes WHERE device = ? AND inode = ? "
+                "AND size = ? AND mtime = ?", key + (stats.st_size, stats.st_mtime)).fetchone()
+        if row is not None:
+            return str(row[0])
+
+        logger.debug("Hashing contents of '%s'", full_filename)
+        content_hash = hash_file(full_filename)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO file_hashes (device, inode, size, mtime, content_hash) "
+                "VALUES (?, ?, ?, ?, ?)", key + (stats.st_size, stats.st_mtime, content_hash))
+            self.connection.commit()
+        return content_hash
+
+    def get_archive(self, content_hash):
+        """Returns the GlacierData of the archive with the contents, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT archive_id, tree_hash FROM archives WHERE content_hash = ?",
+                (content_hash,)).fetchone()
+        if row is None:
+            return None
+        glacier_data = GlacierData()
+        glacier_data.archive_id = str(row[0])
+        glacier_data.tree_hash = row[1] and str(row[1])
+        return glacier_data
+
+    def add_archive(self, content_hash, size, glacier_data):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO archives (content_hash, archive_id, size, tree_hash) "
+                "VALUES (?, ?, ?, ?)", (content_hash, glacier_data.archive_id, size,
+                                        glacier_data.tree_hash))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class Deduplicator():
+    """
+    Avoids uploading files whose contents were already uploaded (from any
+    directory): the local metadata of a duplicate references the existing archive.
+    """
+
+    def __init__(self, ctx, local_metadata):
+        self.ctx = ctx
+        self.local_metadata = local_metadata
+        self.index = DedupIndex(get_config_option(self.ctx.config, 'dedup', 'index'))
+
+    def get_content_hash(self, directory, filename, file_stats):
+        return self.index.get_content_hash(os.path.join(directory, filename), file_stats.stats)
+
+    def record_duplicate(self, directory, filename, file_stats, content_hash):
+        """
+        If the contents of the file were already uploaded, updates the local
+        metadata to reference that archive and returns True
+        """
+        glacier_data = self.index.get_archive(content_hash)
+        if glacier_data is None:
+            return False
+        logger.info("File '%s/%s' is a duplicate of archive %s (not uploaded)", directory,
+            filename, glacier_data.archive_id)
+        self.local_metadata.update_metadata(directory, filename, file_stats, glacier_data)
+        self.ctx.add_deduplicated(directory, filename, file_stats.stats.st_size)
+        return True
+
+    def add_upload(self, content_hash, file_stats, glacier_data):
+        """Registers the archive of an uploaded file"""
+        if glacier_data.bundle_offset is not None:
+            # Only archives with the contents of one file can be referenced
+            return
+        self.index.add_archive(content_hash, file_stats.stats.st_size, glacier_data)
+
+    def close(self):
+        self.index.close()
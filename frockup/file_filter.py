@@ -18,7 +18,10 @@
 #===============================================================================
 
 import logging as logging_
+import fnmatch
 import os
+import re
+import time
 
 logger = logging_.getLogger(__name__)
 
@@ -32,6 +35,9 @@ class FileFilter():
     Filename extensions checks are CASE INSENSITIVE.
     """
 
+    # True if `include_stats()` must be called (only when the stats of the file are known)
+    has_stats_rules = False
+
     def __init__(self, ctx):
         self.ctx = ctx
 
@@ -64,11 +70,120 @@ class FileFilter():
         logger.debug("Including '%s/%s'", directory, filename)
         return True
 
+    def prune_directory(self, directory, name):
+        """Returns True if the sub-directory `name` of `directory` must be ignored"""
+        for pattern in self.ctx.prune_directories:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+
+def _compile_globs(patterns):
+    """Returns a regex matching any of the glob `patterns`, or None if there are no patterns"""
+    if not patterns:
+        return None
+    return re.compile('|'.join(['(?:{0})'.format(fnmatch.translate(pattern))
+                                for pattern in patterns]))
+
+
+def _compile_regexes(regexes):
+    if not regexes:
+        return None
+    return re.compile('|'.join(['(?:{0})'.format(regex) for regex in regexes]))
+
+
+class CompiledFileFilter(FileFilter):
+    """
+    FileFilter that compiles the rules of the context when created, so the
+    check of each file is a few set lookups and regex matches:
+
+    - extensions (`ctx.include_extensions` / `ctx.exclude_extensions`), as sets
+    - globs (`ctx.include_globs` / `ctx.exclude_globs`) and regexes
+      (`ctx.exclude_regexes`), each group as one regex matched against the filename
+    - size and age bounds (`ctx.min_size`, `ctx.max_size`, `ctx.min_age`,
+      `ctx.max_age`), checked by `include_stats()` once the file was stat'ed
+    - prune rules (`ctx.prune_directories`), as one regex matched against the
+      name of the sub-directories
+
+    A file is included if it matches any of the include rules (if any), and
+    doesn't match any of the exclude rules. Changes to the rules of the
+    context after the creation of the filter are ignored.
+    """
+
+    def __init__(self, ctx):
+        FileFilter.__init__(self, ctx)
+        self.include_extensions = frozenset(ctx.include_extensions)
+        self.exclude_extensions = frozenset(ctx.exclude_extensions)
+        self.include_globs = _compile_globs(ctx.include_globs)
+        self.exclude_globs = _compile_globs(ctx.exclude_globs)
+        self.exclude_regexes = _compile_regexes(ctx.exclude_regexes)
+        self.prune_globs = _compile_globs(ctx.prune_directories)
+        self.has_include_rules = bool(self.include_extensions) or self.include_globs is not None
+        self.min_size = ctx.min_size
+        self.max_size = ctx.max_size
+        self.min_age = ctx.min_age
+        self.max_age = ctx.max_age
+        # If False, `include_stats()` doesn't need to be called
+        self.has_stats_rules = any([value is not None for value in
+            (self.min_size, self.max_size, self.min_age, self.max_age)])
+        # Avoid the overhead of the debug messages of each file
+        self.debug = logger.isEnabledFor(logging_.DEBUG)
+
+    def include_file(self, directory, filename):
+        """Returns True if the file must be included in the backup, False otherwise"""
+        # Excludes '.frockup*' too
+        if filename[:1] == '.':
+            if self.debug:
+                logger.debug("Excluding .*: '%s/%s'", directory, filename)
+            return False
+
+        if '.' in filename:
+            extension = filename.rsplit('.', 1)[1].lower()
+        else:
+            extension = ''
+
+        if self.has_include_rules and not (extension in self.include_extensions or
+                (self.include_globs is not None and self.include_globs.match(filename))):
+            if self.debug:
+                logger.debug("Ignoring '%s/%s' (not matched 'include')", directory, filename)
+            return False
+
+        if extension in self.exclude_extensions or \
+                (self.exclude_globs is not None and self.exclude_globs.match(filename)) or \
+                (self.exclude_regexes is not None and self.exclude_regexes.search(filename)):
+            if self.debug:
+                logger.debug("Ignoring '%s/%s' (matched 'exclude')", directory, filename)
+            return False
+
+        return True
+
+    def include_stats(self, directory, filename, stats):
+        """Returns True if the stats of the file are inside the size and age bounds"""
+        if self.min_size is not None and stats.st_size < self.min_size:
+            return False
+        if self.max_size is not None and stats.st_size > self.max_size:
+            return False
+        if self.min_age is not None or self.max_age is not None:
+            age = time.time() - stats.st_mtime
+            if self.min_age is not None and age < self.min_age:
+                return False
+            if self.max_age is not None and age > self.max_age:
+                return False
+        return True
+
+    def prune_directory(self, directory, name):
+        return self.prune_globs is not None and self.prune_globs.match(name) is not None
+
 
 class FileFilterMock():
 
+    has_stats_rules = False
+
     def __init__(self, ctx):
         self.ctx = ctx
 
     def include_file(self, directory, filename):
         return True
+
+    def prune_directory(self, directory, name):
+        return False
@@ -17,21 +17,320 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #===============================================================================
 
+import atexit
+import binascii
+import calendar
+import collections
 import uuid
+import hashlib
+import httplib
 import multiprocessing
 import logging as logging_
 import random
 import os
+import socket
+import threading
 import time
 from ftplib import FTP
+from multiprocessing.pool import ThreadPool
+
+from frockup.checkpoints import CheckpointStore
+from frockup.common import get_config_option
 
 logger = logging_.getLogger(__name__)
 
+MEGABYTE = 1024 * 1024
+TREE_HASH_LEAF_SIZE = MEGABYTE
+
+# Glacier accepts up to 10,000 parts, of 1 MiB multiplied by a power of 2 (up to 4 GiB)
+MAX_PARTS = 10000
+MAX_PART_SIZE = 4096 * MEGABYTE
+
+# Defaults of the `[upload]` section of the configuration
+DEFAULT_MULTIPART_THRESHOLD_MB = 64
+DEFAULT_PART_SIZE_MB = 8
+DEFAULT_CONCURRENT_PARTS = 4
+DEFAULT_HEALTH_CHECK_INTERVAL = 300
+
+# Multipart uploads started before this time (in days) are considered abandoned
+DEFAULT_ABANDONED_UPLOAD_DAYS = 7
+
+# The body of the uploads is throttled (see `frockup.bandwidth`) by chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Errors that means the connection to Glacier should be re-created
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+
+# Connection pools of this process, by (pid, access key id)
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_part_size(file_size, part_size):
+    """
+    Returns the part size to use for a multipart upload of `file_size` bytes:
+    the smallest valid part size (1 MiB multiplied by a power of 2) not
+    smaller than `part_size` and big enough to not exceed `MAX_PARTS` parts.
+    """
+    valid_part_size = MEGABYTE
+    while valid_part_size < part_size or valid_part_size * MAX_PARTS < file_size:
+        valid_part_size *= 2
+    if valid_part_size > MAX_PART_SIZE:
+        raise ValueError("File too big for multipart upload: {0} bytes".format(file_size))
+    return valid_part_size
+
+
+class GlacierConnectionPool():
+    """
+    Holds the authenticated connection to Glacier (Layer2) and the vault
+    handles, so they are created only once per process and shared
+    between all the uploads.
+
+    The connection is checked (with a `describe_vault()` call) if it wasn't
+    used in the last `health_check_interval` seconds, and re-created
+    if the check fails or after `invalidate()` is called.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.health_check_interval = get_config_option(config, 'upload',
+            'health_check_interval', DEFAULT_HEALTH_CHECK_INTERVAL, int)
+        self.lock = threading.Lock()
+        self.layer2 = None
+        self.vaults = {}
+        self.last_used = 0
+
+    def _connect(self):
+        from boto.glacier.layer2 import Layer2
+        logger.info("Connecting to Glacier...")
+        self.layer2 = Layer2(
+            self.config.get("identity", "aws_access_key_id"),
+            self.config.get("identity", "aws_secret_access_key")
+        )
+        self.vaults = {}
+
+    def _is_healthy(self, vault_name):
+        try:
+            self.layer2.layer1.describe_vault(vault_name)
+            return True
+        except:
+            logger.warn("Health check of Glacier connection failed, will reconnect",
+                exc_info=True)
+            return False
+
+    def _disconnect(self):
+        if self.layer2 is not None:
+            try:
+                self.layer2.layer1.close()
+            except:
+                logger.exception("Exception detected when trying to close(), "
+                                 "will log and ignore it...")
+        self.layer2 = None
+        self.vaults = {}
+
+    def get_vault(self, vault_name):
+        """Returns the (cached) vault handle, connecting to Glacier if needed"""
+        with self.lock:
+            if self.layer2 is not None and \
+                    time.time() - self.last_used > self.health_check_interval:
+                if not self._is_healthy(vault_name):
+                    self._disconnect()
+            if self.layer2 is None:
+                self._connect()
+            if vault_name not in self.vaults:
+                self.vaults[vault_name] = self.layer2.get_vault(vault_name)
+            self.last_used = time.time()
+            return self.vaults[vault_name]
+
+    def invalidate(self):
+        """Discards the connection, a new one will be created on next use"""
+        with self.lock:
+            self._disconnect()
+
+    def close(self):
+        self.invalidate()
+
+
+def get_connection_pool(config):
+    """Returns the GlacierConnectionPool of the current process"""
+    key = (os.getpid(), config.get("identity", "aws_access_key_id"))
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = GlacierConnectionPool(config)
+        return _connection_pools[key]
+
+
+@atexit.register
+def close_connection_pools():
+    """Closes the connection pools created by the current process"""
+    with _connection_pools_lock:
+        for key in [key for key in _connection_pools if key[0] == os.getpid()]:
+            _connection_pools.pop(key).close()
+
+
+def bytes_to_hex(digest):
+    return binascii.hexlify(digest)
+
+
+def combine_tree_hashes(hashes):
+    """
+    Returns the tree hash (binary digest) built from `hashes`, hashing together
+    adjacent pairs of hashes until only one remains.
+
+    This works both with the hashes of the 1 MiB leaves and with the
+    tree hashes of the parts of a multipart upload (since the part
+    size is 1 MiB multiplied by a power of 2).
+    """
+    hashes = list(hashes)
+    if not hashes:
+        return hashlib.sha256('').digest()
+    while len(hashes) > 1:
+        combined = []
+        for i in xrange(0, len(hashes) - 1, 2):
+            combined.append(hashlib.sha256(hashes[i] + hashes[i + 1]).digest())
+        if len(hashes) % 2:
+            combined.append(hashes[-1])
+        hashes = combined
+    return hashes[0]
+
+
+def hash_part(part_data):
+    """
+    Returns a tuple (linear hash, tree hash) of `part_data`. The linear hash is
+    returned as an hex string and the tree hash as a binary digest.
+    """
+    leaf_hashes = [hashlib.sha256(part_data[offset:offset + TREE_HASH_LEAF_SIZE]).digest()
+                   for offset in xrange(0, len(part_data), TREE_HASH_LEAF_SIZE)]
+    return hashlib.sha256(part_data).hexdigest(), combine_tree_hashes(leaf_hashes)
+
+
+def iter_hashed_parts(fileobj, part_size, pool=None, max_pending=1, skip_offsets=None):
+    """
+    Hashing stage for uploads: reads `fileobj` only once, in parts of `part_size`
+    bytes, and yields `(offset, part_data, linear_hash, tree_hash)` for each part
+    (hashes as returned by `hash_part()`).
+
+    If `pool` (a `multiprocessing.Pool`) is given, the parts are hashed on it,
+    with up to `max_pending` parts being hashed at the same time, so hashing of
+    big files isn't limited to one core.
+
+    The parts at `skip_offsets` (already uploaded) aren't read nor yielded.
+    """
+    pending = collections.deque()
+    max_pending = 1 if pool is None else max(1, max_pending)
+    offset = 0
+    while True:
+        if skip_offsets and offset in skip_offsets:
+            offset += part_size
+            fileobj.seek(offset)
+            continue
+        part_data = fileobj.read(part_size)
+        if not part_data:
+            break
+        if pool is None:
+            pending.append((offset, part_data, hash_part(part_data)))
+        else:
+            pending.append((offset, part_data, pool.apply_async(hash_part, (part_data,))))
+        offset += len(part_data)
+        while len(pending) >= max_pending:
+            yield _resolve_hashed_part(pending.popleft())
+    while pending:
+        yield _resolve_hashed_part(pending.popleft())
+
+
+def _resolve_hashed_part(pending_part):
+    offset, part_data, hashes = pending_part
+    if not isinstance(hashes, tuple):
+        hashes = hashes.get()
+    return (offset, part_data) + hashes
+
+
+class ThrottledBody():
+    """
+    Read-only file-like view of the body of a request, that calls `throttle(size)`
+    before each chunk of `chunk_size` bytes is read. `httplib` sends a file-like
+    body as it's read, so the upload is spread over time (instead of being sent
+    in bursts) and a change of the bandwidth limit is honored on the next chunk.
+
+    If given, `progress(size)` is called with the size of each block read (sent).
+    """
+
+    def __init__(self, data, throttle, chunk_size=UPLOAD_CHUNK_SIZE, progress=None):
+        self.data = data
+        self.throttle = throttle
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.offset = 0
+        # Bytes already throttled (read or not)
+        self.throttled = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else min(len(self.data), self.offset + size)
+        while self.throttled < end:
+            chunk_size = min(self.chunk_size, len(self.data) - self.throttled)
+            self.throttle(chunk_size)
+            self.throttled += chunk_size
+        block = self.data[self.offset:end]
+        self.offset = end
+        if block and self.progress is not None:
+            self.progress(len(block))
+        return block
+
+
+class ThrottledSender():
+    """
+    `sender` of boto requests, that sends the body as a `ThrottledBody`. The body
+    is re-created on each try, so the requests retried by boto are sent complete.
+    """
+
+    def __init__(self, throttle, progress=None):
+        self.throttle = throttle
+        self.progress = progress
+
+    def __call__(self, connection, method, path, body, headers):
+        connection.request(method, path, ThrottledBody(body, self.throttle,
+            progress=self.progress), headers)
+        return connection.getresponse()
+
+
+def upload_archive(layer1, vault_name, archive_data, linear_hash, tree_hash, description,
+        sender):
+    """Same as boto's `Layer1.upload_archive()`, but sending the data with `sender`"""
+    headers = {'x-amz-content-sha256': linear_hash,
+               'x-amz-sha256-tree-hash': tree_hash,
+               'Content-Length': str(len(archive_data))}
+    if description:
+        headers['x-amz-archive-description'] = description
+    return layer1.make_request('POST', 'vaults/%s/archives' % vault_name, headers=headers,
+        sender=sender, data=archive_data, ok_responses=(201,),
+        response_headers=[('x-amz-archive-id', u'ArchiveId'),
+                          ('Location', u'Location'),
+                          ('x-amz-sha256-tree-hash', u'TreeHash')])
+
+
+def upload_part(layer1, vault_name, upload_id, linear_hash, tree_hash, byte_range, part_data,
+        sender):
+    """Same as boto's `Layer1.upload_part()`, but sending the data with `sender`"""
+    headers = {'x-amz-content-sha256': linear_hash,
+               'x-amz-sha256-tree-hash': tree_hash,
+               'Content-Range': 'bytes %d-%d/*' % byte_range}
+    return layer1.make_request('PUT', 'vaults/%s/multipart-uploads/%s' % (vault_name, upload_id),
+        headers=headers, sender=sender, data=part_data, ok_responses=(204,),
+        response_headers=[('x-amz-sha256-tree-hash', u'TreeHash')])
+
 
 class GlacierData():
 
     def __init__(self):
         self.archive_id = None
+        # SHA-256 tree hash of the uploaded file (hex), if known
+        self.tree_hash = None
+        # Offset and length of the file inside the archive (for packed files)
+        self.bundle_offset = None
+        self.bundle_length = None
 
 
 class Glacier():
@@ -39,36 +338,270 @@ class Glacier():
 
     def __init__(self, ctx):
         self.ctx = ctx
-        self.layer2 = None
+        # Files of this size (or bigger) are uploaded with multipart uploads
+        self.multipart_threshold = get_config_option(self.ctx.config, 'upload',
+            'multipart_threshold_mb', DEFAULT_MULTIPART_THRESHOLD_MB, int) * MEGABYTE
+        self.part_size = get_config_option(self.ctx.config, 'upload',
+            'part_size_mb', DEFAULT_PART_SIZE_MB, int) * MEGABYTE
+        # Max. number of parts uploaded at the same time
+        self.concurrent_parts = max(1, get_config_option(self.ctx.config, 'upload',
+            'concurrent_parts', DEFAULT_CONCURRENT_PARTS, int))
+        # Processes used to hash the parts of multipart uploads (0: hash in the upload thread)
+        self.hashing_processes = get_config_option(self.ctx.config, 'upload',
+            'hashing_processes', multiprocessing.cpu_count(), int)
+        self.hashing_pool = None
+        self.hashing_pool_lock = threading.Lock()
+        # Checkpoints of the multipart uploads, to resume them if interrupted
+        if get_config_option(self.ctx.config, 'upload', 'resumable', True, bool):
+            self.checkpoints = CheckpointStore(get_config_option(self.ctx.config, 'upload',
+                'checkpoint_dir'))
+        else:
+            self.checkpoints = None
 
-    def upload_file(self, directory, filename):
-        """Uploads a file to glacier. Returns an instance of GlacierData"""
+    def upload_file(self, directory, filename, description=None, progress=None):
+        """
+        Uploads a file to glacier. Returns an instance of GlacierData.
+        The archive description defaults to the full path of the file.
+
+        If given, `progress(size)` is called (from any thread) as the bytes are
+        sent. The bytes re-sent when a request is retried are reported again.
+        """
         logger.debug("Uploading file '%s/%s'", directory, filename)
         if self.ctx.dry_run:
             return
-        from boto.glacier.layer2 import Layer2
-        self.layer2 = Layer2(
-            self.ctx.config.get("identity", "aws_access_key_id"),
-            self.ctx.config.get("identity", "aws_secret_access_key")
-        )
-
-        vault = self.layer2.get_vault(self.ctx.config.get("defaults", "vault_name"))
-        archive_id = vault.create_archive_from_file(os.path.join(directory, filename),
-            description=os.path.join(directory, filename))
+        connection_pool = get_connection_pool(self.ctx.config)
+        vault_name = self.ctx.config.get("defaults", "vault_name")
+        full_filename = os.path.join(directory, filename)
+        description = description or full_filename
+        file_size = os.path.getsize(full_filename)
+        try_num = 1
+        while True:
+            vault = connection_pool.get_vault(vault_name)
+            try:
+                if file_size >= self.multipart_threshold:
+                    archive_id, tree_hash = self._upload_multipart(vault, full_filename,
+                        file_size, description, progress)
+                else:
+                    archive_id, tree_hash = self._upload_single(vault, full_filename,
+                        description, progress)
+                break
+            except CONNECTION_ERRORS:
+                if try_num == 2:
+                    raise
+                logger.warn("Connection error detected when uploading '%s', "
+                            "will reconnect and retry", full_filename, exc_info=True)
+                connection_pool.invalidate()
+                try_num += 1
 
         glacier_data = GlacierData()
         glacier_data.archive_id = archive_id
+        glacier_data.tree_hash = tree_hash
         return glacier_data
 
-    def close(self):
-        if self.layer2:
+    def _throttle(self, size):
+        """Waits until `size` bytes can be sent without exceeding the bandwidth limit"""
+        if self.ctx.bandwidth_limiter is not None:
+            self.ctx.bandwidth_limiter.consume(size)
+
+    def _get_sender(self, progress=None):
+        """Returns the `sender` of the uploads, throttled by chunks (see `ThrottledBody`)"""
+        return ThrottledSender(self._throttle, progress)
+
+    def _get_hashing_pool(self):
+        """Returns the process pool used to hash the parts (None to hash in the caller)"""
+        with self.hashing_pool_lock:
+            if self.hashing_pool is None and self.hashing_processes > 0:
+                self.hashing_pool = multiprocessing.Pool(self.hashing_processes)
+            return self.hashing_pool
+
+    def _upload_single(self, vault, full_filename, description, progress=None):
+        """
+        Uploads the file with a single request.
+        Returns a tuple (archive id, tree hash).
+        """
+        with open(full_filename, 'rb') as fp:
+            archive_data = fp.read()
+        linear_hash, part_tree_hash = hash_part(archive_data)
+        response = upload_archive(vault.layer1, vault.name, archive_data, linear_hash,
+            bytes_to_hex(part_tree_hash), description, self._get_sender(progress))
+        return response['ArchiveId'], bytes_to_hex(part_tree_hash)
+
+    def _abort_upload(self, layer1, vault_name, upload_id):
+        try:
+            layer1.abort_multipart_upload(vault_name, upload_id)
+        except:
+            logger.exception("Exception detected when trying to abort the upload, "
+                             "will log and ignore it...")
+
+    def _load_checkpoint(self, layer1, vault_name, full_filename, stats):
+        """Returns the checkpoint of an upload of the file that can be resumed, or None"""
+        if self.checkpoints is None:
+            return None
+        checkpoint = self.checkpoints.load(vault_name, full_filename)
+        if checkpoint is None:
+            return None
+        if not checkpoint.matches(stats):
+            logger.info("File '%s' changed since its upload was started, will abort it",
+                full_filename)
+            self._abort_upload(layer1, vault_name, checkpoint.upload_id)
+            checkpoint.remove()
+            return None
+        try:
+            layer1.list_parts(vault_name, checkpoint.upload_id)
+        except CONNECTION_ERRORS:
+            raise
+        except:
+            logger.warn("Upload of '%s' can't be resumed, will start a new one", full_filename,
+                exc_info=True)
+            checkpoint.remove()
+            return None
+        return checkpoint
+
+    def _upload_multipart(self, vault, full_filename, file_size, description, progress=None):
+        """
+        Uploads the file using a multipart upload, sending up to
+        `concurrent_parts` parts at the same time.
+        The file is read only once: each part is hashed (see `iter_hashed_parts()`)
+        and then uploaded.
+
+        If resumable, a checkpoint is saved after each part (see `frockup.checkpoints`)
+        and an interrupted upload of the file is resumed from the missing parts.
+        Returns a tuple (archive id, tree hash).
+        """
+        layer1 = vault.layer1
+        vault_name = vault.name
+        stats = os.stat(full_filename)
+        checkpoint = self._load_checkpoint(layer1, vault_name, full_filename, stats)
+        if checkpoint is not None:
+            upload_id = checkpoint.upload_id
+            part_size = checkpoint.part_size
+            part_tree_hashes = checkpoint.get_part_hashes()
+            part_count = (file_size + part_size - 1) // part_size
+            logger.info("Resuming multipart upload of '%s' (%s of %s parts already uploaded)",
+                full_filename, len(part_tree_hashes), part_count)
+        else:
+            part_size = get_part_size(file_size, self.part_size)
+            part_count = (file_size + part_size - 1) // part_size
+            logger.info("Starting multipart upload of '%s' (%s parts of %s bytes)",
+                full_filename, part_count, part_size)
+            response = layer1.initiate_multipart_upload(vault_name, part_size,
+                description=description)
+            upload_id = response['UploadId']
+            part_tree_hashes = {}
+            if self.checkpoints is not None:
+                checkpoint = self.checkpoints.create(vault_name, full_filename, stats,
+                    upload_id, part_size)
+
+        # Limits the parts read (and kept in memory) but not uploaded yet
+        parts_in_flight = threading.Semaphore(self.concurrent_parts)
+        upload_failed = threading.Event()
+
+        def _upload_part(offset, part_data, linear_hash, part_tree_hash):
             try:
-                self.layer2.close()
+                byte_range = (offset, offset + len(part_data) - 1)
+                logger.debug("Uploading part %s of '%s'", byte_range, full_filename)
+                upload_part(layer1, vault_name, upload_id, linear_hash,
+                    bytes_to_hex(part_tree_hash), byte_range, part_data,
+                    self._get_sender(progress))
+                if checkpoint is not None:
+                    checkpoint.add_part(offset, part_tree_hash)
+                return offset, part_tree_hash
             except:
-                logger.exception("Exception detected when trying to close(), "
-                                 "will log and ignore it...")
+                upload_failed.set()
+                raise
             finally:
-                self.layer2 = None
+                parts_in_flight.release()
+
+        pool = ThreadPool(max(1, min(self.concurrent_parts, part_count - len(part_tree_hashes))))
+        try:
+            results = []
+            with open(full_filename, 'rb') as fp:
+                for hashed_part in iter_hashed_parts(fp, part_size, self._get_hashing_pool(),
+                        self.concurrent_parts, skip_offsets=frozenset(part_tree_hashes)):
+                    parts_in_flight.acquire()
+                    if upload_failed.is_set():
+                        break
+                    results.append(pool.apply_async(_upload_part, hashed_part))
+            part_tree_hashes.update([result.get() for result in results])
+        except:
+            if checkpoint is not None:
+                logger.exception("Exception detected when uploading parts of '%s', "
+                                 "the upload will be resumed by the next try", full_filename)
+            else:
+                logger.exception("Exception detected when uploading parts of '%s', "
+                                 "will abort the multipart upload", full_filename)
+                self._abort_upload(layer1, vault_name, upload_id)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+        assert len(part_tree_hashes) == part_count, \
+            "Uploaded {0} parts of '{1}', expected {2}".format(len(part_tree_hashes),
+                full_filename, part_count)
+        archive_tree_hash = bytes_to_hex(combine_tree_hashes(
+            [part_tree_hashes[offset] for offset in sorted(part_tree_hashes)]))
+        response = layer1.complete_multipart_upload(vault_name, upload_id,
+            archive_tree_hash, file_size)
+        if checkpoint is not None:
+            checkpoint.remove()
+        return response['ArchiveId'], archive_tree_hash
+
+    def cleanup_uploads(self, max_age=DEFAULT_ABANDONED_UPLOAD_DAYS * 24 * 60 * 60):
+        """
+        Aborts the abandoned multipart uploads: the ones with a checkpoint of a file
+        that changed (or doesn't exist anymore) or older than `max_age` seconds, and
+        the ones of the vault without checkpoint and older than `max_age` seconds.
+        Returns the number of aborted uploads.
+        """
+        vault_name = self.ctx.config.get("defaults", "vault_name")
+        layer1 = get_connection_pool(self.ctx.config).get_vault(vault_name).layer1
+        checkpoints = self.checkpoints.get_checkpoints() if self.checkpoints else []
+        min_creation_time = time.time() - max_age
+        aborted = 0
+        upload_ids = set()
+        for checkpoint in checkpoints:
+            if checkpoint.state['vault_name'] != vault_name:
+                continue
+            # Handled here, must be ignored when listing the uploads of the vault
+            upload_ids.add(checkpoint.upload_id)
+            try:
+                stats = os.stat(checkpoint.state['filename'])
+            except OSError:
+                stats = None
+            if stats is not None and checkpoint.matches(stats) and \
+                    checkpoint.state['created'] >= min_creation_time:
+                continue
+            logger.info("Aborting abandoned upload of '%s'", checkpoint.state['filename'])
+            self._abort_upload(layer1, vault_name, checkpoint.upload_id)
+            checkpoint.remove()
+            aborted += 1
+
+        marker = None
+        while True:
+            response = layer1.list_multipart_uploads(vault_name, marker=marker)
+            for upload in response['UploadsList']:
+                creation_time = calendar.timegm(time.strptime(upload['CreationDate'][:19],
+                    '%Y-%m-%dT%H:%M:%S'))
+                if upload['MultipartUploadId'] in upload_ids or creation_time >= min_creation_time:
+                    continue
+                logger.info("Aborting abandoned upload '%s' (without checkpoint)",
+                    upload.get('ArchiveDescription'))
+                self._abort_upload(layer1, vault_name, upload['MultipartUploadId'])
+                aborted += 1
+            marker = response.get('Marker')
+            if not marker:
+                break
+        return aborted
+
+    def close(self):
+        # The connection is kept open in the process' `GlacierConnectionPool`
+        # to be re-used by other uploads (closed by `close_connection_pools()`)
+        with self.hashing_pool_lock:
+            if self.hashing_pool is not None:
+                self.hashing_pool.terminate()
+                self.hashing_pool.join()
+                self.hashing_pool = None
 
 
 #===============================================================================
@@ -80,7 +613,7 @@ class GlacierMock():
     def __init__(self, ctx):
         self.ctx = ctx
 
-    def upload_file(self, directory, filename):
+    def upload_file(self, directory, filename, description=None, progress=None):
         logger.debug("Uploading file '%s/%s'", directory, filename)
         glacier_data = GlacierData()
         glacier_data.archive_id = str(uuid.uuid4())
@@ -92,7 +625,7 @@ class GlacierMock():
 
 class GlacierErrorOnUploadMock(GlacierMock):
 
-    def upload_file(self, directory, filename):
+    def upload_file(self, directory, filename, description=None, progress=None):
         raise(Exception("This implementation of upload_file() ALWAYS raises an exception"))
 
 
@@ -139,7 +672,7 @@ class GlacierFtpBased():
                 time.sleep(0.1)
         ftp.connect('127.0.0.1', self.ftp_port)
 
-    def upload_file(self, directory, filename):
+    def upload_file(self, directory, filename, description=None, progress=None):
         logger.info("Connecting to FTP...")
         ftp = FTP()
         ftp.connect('127.0.0.1', self.ftp_port)
@@ -147,10 +680,18 @@ class GlacierFtpBased():
         ftp.login(self.ftp_user, self.ftp_password)
         generated_uuid = str(uuid.uuid4())
         remote_filename = "{0}-{1}".format(filename, generated_uuid)
+
+        def _callback(block):
+            if self.ctx.bandwidth_limiter is not None:
+                self.ctx.bandwidth_limiter.consume(len(block))
+            if progress is not None:
+                progress(len(block))
+            if self.upload_file_ftp_callback is not None:
+                self.upload_file_ftp_callback(block)
+
         with open(os.path.join(directory, filename)) as fp:
             logger.info("Sending file to FTP server...")
-            ftp.storbinary("STOR {0}".format(remote_filename), fp, 128,
-                self.upload_file_ftp_callback)
+            ftp.storbinary("STOR {0}".format(remote_filename), fp, 128, _callback)
         logger.info("File sent OK to FTP")
 
         glacier_data = GlacierData()
@@ -18,15 +18,31 @@
 #===============================================================================
 
 import logging as logging_
+import collections
 import gdbm
 import os
-import json
+import stat
+import threading
 
 from frockup.glacier import GlacierData
-from frockup.common import FLAG_FILE_CHANGED_WHILE_UPLOADING, Context
+from frockup.catalog import MetadataCatalog, DEFAULT_CATALOG_FILENAME
+from frockup.common import FLAG_FILE_CHANGED_WHILE_UPLOADING, Context, \
+    get_config_option, stat_file
+from frockup.metadata_record import encode_record, decode_record, decode_stats, \
+    FORMAT_BINARY, FORMAT_JSON
 
 logger = logging_.getLogger(__name__)
 
+DB_FILENAME = '.frockup.gdbm'
+
+# Defaults of the `[metadata]` section of the configuration
+DEFAULT_MAX_OPEN_DATABASES = 16
+DEFAULT_MAX_SNAPSHOTS = 1024
+
+# Metadata caches of this process, by pid
+_metadata_caches = {}
+_metadata_caches_lock = threading.Lock()
+
 
 class FileStats():
     """
@@ -45,19 +61,129 @@ class FileStats():
         self.stats = stats
 
 
+class MetadataCache():
+    """
+    LRU caches shared by all the LocalMetadata instances of a process:
+
+    - `databases`: the open gdbm databases (`directory` -> `(database, opened_ro)`).
+      The evicted databases are closed.
+    - `snapshots`: the metadata of all the files of a directory, as a dict
+      `filename` -> `(st_size, st_mtime)`, with the `signature` of the
+      database at the time the snapshot was loaded (the snapshot is discarded
+      if the signature of the database changes).
+    """
+
+    def __init__(self, max_databases, max_snapshots):
+        self.max_databases = max_databases
+        self.max_snapshots = max_snapshots
+        self.lock = threading.RLock()
+        self.databases = collections.OrderedDict()
+        self.snapshots = collections.OrderedDict()
+
+    def get_database(self, directory):
+        """Returns `(database, opened_ro)`, or None if not open"""
+        with self.lock:
+            cached = self.databases.pop(directory, None)
+            if cached is not None:
+                self.databases[directory] = cached
+            return cached
+
+    def put_database(self, directory, database, opened_ro):
+        with self.lock:
+            self.close_database(directory)
+            self.databases[directory] = (database, opened_ro)
+            while len(self.databases) > self.max_databases:
+                self.close_database(next(iter(self.databases)))
+
+    def close_database(self, directory):
+        with self.lock:
+            cached = self.databases.pop(directory, None)
+            if cached is not None:
+                logger.debug("Closing database at %s...", directory)
+                cached[0].close()
+
+    def close_databases(self):
+        with self.lock:
+            for directory in list(self.databases):
+                self.close_database(directory)
+
+    def get_snapshot(self, key, signature):
+        """
+        Returns the snapshot, or None if it isn't cached or its signature
+        is different from `signature`
+        """
+        with self.lock:
+            cached = self.snapshots.pop(key, None)
+            if cached is None or cached[0] != signature:
+                return None
+            self.snapshots[key] = cached
+            return cached[1]
+
+    def update_snapshot(self, key, filename, value, signature):
+        """Updates an entry of the snapshot (if cached) and sets its new signature"""
+        with self.lock:
+            cached = self.snapshots.get(key)
+            if cached is not None:
+                cached[1][filename] = value
+                self.snapshots[key] = (signature, cached[1])
+
+    def put_snapshot(self, key, signature, snapshot):
+        with self.lock:
+            self.snapshots.pop(key, None)
+            self.snapshots[key] = (signature, snapshot)
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+
+
+def get_metadata_cache(config):
+    """Returns the MetadataCache of the current process"""
+    with _metadata_caches_lock:
+        if os.getpid() not in _metadata_caches:
+            _metadata_caches[os.getpid()] = MetadataCache(
+                get_config_option(config, 'metadata', 'max_open_databases',
+                    DEFAULT_MAX_OPEN_DATABASES, int),
+                get_config_option(config, 'metadata', 'max_snapshots',
+                    DEFAULT_MAX_SNAPSHOTS, int))
+        return _metadata_caches[os.getpid()]
+
+
 class LocalMetadata():
     """
     Service that filters files to include in backup based on the local metadata
     (the status of previous upload of the file, if any).
+
+    In 'snapshot' mode (the default), the metadata of all the files of a
+    directory is loaded at once and the checks of `include_file()` are
+    answered from memory (see `MetadataCache`).
+
+    The public methods can be called from different threads (the access
+    to the database is serialized).
     """
 
     def __init__(self, ctx):
         self.ctx = ctx
+        self.cache = get_metadata_cache(self.ctx.config)
+        self.lock = self.cache.lock
+        self.use_snapshots = get_config_option(self.ctx.config, 'metadata', 'snapshots',
+            True, bool)
+        # Format of the records written (both formats are always readable)
+        self.record_format = get_config_option(self.ctx.config, 'metadata', 'record_format',
+            FORMAT_BINARY)
+        assert self.record_format in (FORMAT_BINARY, FORMAT_JSON), \
+            "Invalid record format '{0}'".format(self.record_format)
         self.last_directory = None
         self.database = None
         self.opened_ro = False
+        # Directory being checked (see `check_directory()`), and its snapshot once loaded
+        self.checked_directory = None
+        self.checked_snapshot = None
+        # Called with `(directory, filename, file_stats, glacier_data)` after each update
+        self.listeners = []
         assert isinstance(self.ctx, Context)
 
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
     def _stats_equals(self, stats1, stats2):
         return (stats1.st_size == stats2.st_size
             and stats1.st_mtime == stats2.st_mtime)
@@ -67,70 +193,147 @@ class LocalMetadata():
             and file_stats.st_mtime == local_metadata.get('stats.st_mtime', None))
 
     def _opendb(self, directory, try_ro_on_error=False):
-        if self.database is None:
-            assert self.last_directory is None
-            # continue, to open the DB
-        else:
-            should_reopen = False
-            if self.last_directory != directory:
-                should_reopen = True
-            if self.opened_ro is True and not try_ro_on_error:
-                should_reopen = True
-            if should_reopen:
-                # close the old DB
-                assert self.database is not None
-                self.database.close()
-                self.database = None
-                self.last_directory = None
-                # continue, to open the DB
-            else:
-                # just return, the current DB is the good one
+        cached = self.cache.get_database(directory)
+        if cached is not None:
+            database, opened_ro = cached
+            if not opened_ro or try_ro_on_error:
+                # just use it, the cached DB is a good one
+                self.database = database
+                self.opened_ro = opened_ro
+                self.last_directory = directory
                 return
+            # it's R/O, but we need R/W: re-open it
+            self.cache.close_database(directory)
 
+        self.database = None
+        self.last_directory = None
         self.opened_ro = False
-        db_filename = os.path.join(directory, '.frockup.gdbm')
+        db_filename = os.path.join(directory, DB_FILENAME)
         logger.debug("Opening metadata DB at '%s'", db_filename)
         try:
-            self.last_directory = directory
             try:
                 # First, try R/W
-                self.database = gdbm.open(db_filename, 'c')
+                database = gdbm.open(db_filename, 'c')
             except:
                 if try_ro_on_error:
                     # If `try_ro_on_error`, try R/O
-                    self.database = gdbm.open(db_filename, 'ru')
+                    database = gdbm.open(db_filename, 'ru')
                     self.opened_ro = True
                 else:
                     raise
         except:
-            self.last_directory = None
-            self.database = None
             logger.exception("gdbm.open() failed when trying to open DB {}".format(
                 db_filename))
             raise
+        self.cache.put_database(directory, database, self.opened_ro)
+        self.database = database
+        self.last_directory = directory
 
     def _get_filename_data(self, filename):
         try:
             raw_data = self.database[filename]
-            data = json.loads(raw_data)
-            return data
+            return decode_record(raw_data)
         except KeyError:
             return {}
 
     def _set_filename_data(self, filename, data):
-        self.database[filename] = json.dumps(data)
+        self.database[filename] = encode_record(data, self.record_format)
+
+    def _get_all_raw_data(self):
+        """Returns a dict with the serialized records of all the files"""
+        all_raw_data = {}
+        key = self.database.firstkey()
+        while key is not None:
+            all_raw_data[key] = self.database[key]
+            key = self.database.nextkey(key)
+        return all_raw_data
+
+    def _get_signature(self, directory):
+        """Returns a value that changes when the metadata of `directory` is modified"""
+        try:
+            stats = stat_file(os.path.join(directory, DB_FILENAME))
+        except OSError:
+            return None
+        return (stats.st_ino, stats.st_mtime, stats.st_size)
+
+    def _get_snapshot_key(self, directory):
+        return ('gdbm', directory)
+
+    def get_signature(self, directory):
+        """Returns a value that changes when the metadata of `directory` is modified"""
+        return self._get_signature(directory)
+
+    def _has_database(self, directory):
+        return os.path.exists(os.path.join(directory, DB_FILENAME))
+
+    def get_file_data(self, directory, filename):
+        """Returns a dict with the metadata of the file (empty if there is no metadata)"""
+        with self.lock:
+            if not self._has_database(directory):
+                return {}
+            self._opendb(directory, try_ro_on_error=True)
+            return self._get_filename_data(filename)
+
+    def get_directory_data(self, directory):
+        """Returns a dict with the metadata of all the files of `directory`"""
+        with self.lock:
+            self._opendb(directory, try_ro_on_error=True)
+            return dict([(filename, decode_record(raw_data)) for filename, raw_data
+                         in self._get_all_raw_data().iteritems()])
+
+    def check_directory(self, directory):
+        """
+        Must be called before checking the files of `directory` with `include_file()`:
+        the signature of its metadata is read once (instead of once per file), so the
+        changes done by other processes after the first check of the directory aren't
+        seen until the next call (or `close()`).
+        """
+        with self.lock:
+            self.checked_directory = directory
+            self.checked_snapshot = None
+
+    def _get_snapshot(self, directory):
+        if self.checked_snapshot is not None and self.checked_snapshot[0] == directory:
+            return self.checked_snapshot[1]
+        key = self._get_snapshot_key(directory)
+        snapshot = self.cache.get_snapshot(key, self._get_signature(directory))
+        if snapshot is None:
+            logger.debug("Loading snapshot of metadata of '%s'", directory)
+            with self.lock:
+                self._opendb(directory, try_ro_on_error=True)
+                # Only the stats are needed: skip the decoding of the other fields
+                snapshot = dict([(filename, decode_stats(raw_data)) for filename, raw_data
+                                 in self._get_all_raw_data().iteritems()])
+            # The signature is taken after opening the DB (it may have been created)
+            self.cache.put_snapshot(key, self._get_signature(directory), snapshot)
+        if directory == self.checked_directory:
+            self.checked_snapshot = (directory, snapshot)
+        return snapshot
 
-    def include_file(self, directory, filename):
+    def _update_snapshot(self, directory, filename, file_stats):
+        """Keeps the cached snapshot (if any) in sync with a change done by this process"""
+        self.cache.update_snapshot(self._get_snapshot_key(directory), filename,
+            (file_stats.st_size, file_stats.st_mtime), self._get_signature(directory))
+
+    def include_file(self, directory, filename, stats=None):
         """Returns an instance of FileStats if the file must be included in the backup,
-        False otherwise."""
+        False otherwise. `stats` are the stats of the file, if already known."""
         logger.debug("Checking '%s/%s'", directory, filename)
-        full_filename = os.path.join(directory, filename)
-        assert os.path.isfile(full_filename)
-        file_stats = os.stat(full_filename)
-        self._opendb(directory, try_ro_on_error=True)
-        data = self._get_filename_data(filename)
+        if stats is None:
+            file_stats = stat_file(os.path.join(directory, filename))
+            assert stat.S_ISREG(file_stats.st_mode)
+        else:
+            file_stats = stats
+        with self.lock:
+            if self.use_snapshots:
+                metadata_equals = self._get_snapshot(directory).get(filename) == \
+                    (file_stats.st_size, file_stats.st_mtime)
+            else:
+                self._opendb(directory, try_ro_on_error=True)
+                data = self._get_filename_data(filename)
+                metadata_equals = self._file_stats_and_local_metadata_equals(file_stats, data)
 
-        if self._file_stats_and_local_metadata_equals(file_stats, data):
+        if metadata_equals:
             logger.debug("Excluding %s/%s (metadata are equals)", directory, filename)
             return False
         else:
@@ -145,31 +348,130 @@ class LocalMetadata():
 
         assert isinstance(glacier_data, GlacierData)
         assert isinstance(file_stats, FileStats)
-        self._opendb(directory)
-        data = self._get_filename_data(filename)
-        if 'archive_id' in data:
-            # save old value
-            if not 'old_archive_ids' in data:
-                data['old_archive_ids'] = []
-            data['old_archive_ids'].append(data['archive_id'])
-        data['archive_id'] = glacier_data.archive_id
-        data['stats.st_size'] = file_stats.stats.st_size
-        data['stats.st_mtime'] = file_stats.stats.st_mtime
-
-        self._set_filename_data(filename, data)
-
-        current_stats = os.stat(os.path.join(directory, filename))
+        with self.lock:
+            self._opendb(directory)
+            data = self._get_filename_data(filename)
+            if 'archive_id' in data:
+                # save old value
+                if not 'old_archive_ids' in data:
+                    data['old_archive_ids'] = []
+                data['old_archive_ids'].append(data['archive_id'])
+            data['archive_id'] = glacier_data.archive_id
+            data['stats.st_size'] = file_stats.stats.st_size
+            data['stats.st_mtime'] = file_stats.stats.st_mtime
+            if glacier_data.tree_hash:
+                data['tree_hash'] = glacier_data.tree_hash
+            else:
+                data.pop('tree_hash', None)
+            if glacier_data.bundle_offset is not None:
+                # The file was packed in a bundle (see `frockup.packing`)
+                data['bundle.offset'] = glacier_data.bundle_offset
+                data['bundle.length'] = glacier_data.bundle_length
+            else:
+                data.pop('bundle.offset', None)
+                data.pop('bundle.length', None)
+
+            self._set_filename_data(filename, data)
+            self._update_snapshot(directory, filename, file_stats.stats)
+
+        for listener in self.listeners:
+            listener(directory, filename, file_stats, glacier_data)
+
+        # The metadata is already written: a file removed (or renamed) after being
+        # uploaded isn't an error
+        try:
+            current_stats = os.stat(os.path.join(directory, filename))
+        except OSError, e:
+            logger.warn("Couldn't check if the file changed while uploading: %s/%s (%s)",
+                directory, filename, e)
+            return
         if not self._stats_equals(current_stats, file_stats.stats):
             self.ctx.add_log(directory, filename,
-                {FLAG_FILE_CHANGED_WHILE_UPLOADING: True})
+                **{FLAG_FILE_CHANGED_WHILE_UPLOADING: True})
             logger.warn("File changed while uploading: %s/%s", directory, filename)
 
     def close(self):
-        if self.database is not None:
-            logger.debug("Closing database at %s...", self.last_directory)
-            self.database.close()
+        """Closes the open databases (the snapshots are kept in the cache)"""
+        with self.lock:
+            self.cache.close_databases()
             self.database = None
             self.last_directory = None
+            self.checked_directory = None
+            self.checked_snapshot = None
+
+
+class SqliteLocalMetadata(LocalMetadata):
+    """
+    LocalMetadata that keeps the metadata of all the directories in the
+    central `MetadataCatalog`, instead of a `.frockup.gdbm` in each directory.
+    """
+
+    def __init__(self, ctx):
+        LocalMetadata.__init__(self, ctx)
+        self.catalog_filename = os.path.expanduser(get_config_option(self.ctx.config,
+            'metadata', 'catalog', DEFAULT_CATALOG_FILENAME))
+        self.catalog = None
+
+    def _get_catalog(self):
+        if self.catalog is None:
+            self.catalog = MetadataCatalog(self.catalog_filename)
+        return self.catalog
+
+    def _opendb(self, directory, try_ro_on_error=False):
+        self._get_catalog()
+        self.last_directory = directory
+
+    def _has_database(self, directory):
+        return True
+
+    def _get_signature(self, directory):
+        # Only the changes of the directory invalidate its snapshot
+        with self.lock:
+            return self._get_catalog().get_version(directory)
+
+    def _get_snapshot_key(self, directory):
+        return (self.catalog_filename, directory)
+
+    def _get_filename_data(self, filename):
+        raw_data = self.catalog.get(self.last_directory, filename)
+        if raw_data is None:
+            return {}
+        return decode_record(raw_data)
+
+    def _set_filename_data(self, filename, data):
+        self.catalog.set(self.last_directory, filename,
+            encode_record(data, self.record_format), data.get('archive_id'),
+            data.get('stats.st_size'))
+
+    def _get_all_raw_data(self):
+        return self.catalog.get_directory(self.last_directory)
+
+    def close(self):
+        with self.lock:
+            if self.catalog is not None:
+                logger.debug("Closing metadata catalog...")
+                self.catalog.close()
+                self.catalog = None
+                self.last_directory = None
+            self.checked_directory = None
+            self.checked_snapshot = None
+
+
+# Implementations of local metadata, selected with `backend` in the `[metadata]`
+# section of the configuration
+METADATA_BACKENDS = {
+    'gdbm': LocalMetadata,
+    'sqlite': SqliteLocalMetadata,
+}
+
+
+def get_local_metadata_class(config):
+    """Returns the LocalMetadata implementation to use"""
+    backend = get_config_option(config, 'metadata', 'backend', 'gdbm')
+    assert backend in METADATA_BACKENDS, \
+        "Invalid metadata backend '{0}' (valid: {1})".format(backend,
+            ', '.join(sorted(METADATA_BACKENDS)))
+    return METADATA_BACKENDS[backend]
 
 
 class LocalMetadataMock():
@@ -177,7 +479,10 @@ class LocalMetadataMock():
     def __init__(self, ctx):
         self.ctx = ctx
 
-    def include_file(self, directory, filename):
+    def check_directory(self, directory):
+        pass
+
+    def include_file(self, directory, filename, stats=None):
         return True
 
     def update_metadata(self, directory, filename, glacier_data):
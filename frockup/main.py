@@ -20,36 +20,59 @@
 import argparse
 import os
 import logging as logging_
+import stat
+import threading
 import traceback
 import time
+from multiprocessing.pool import ThreadPool
 
 from frockup.common import Context, EXCLUDED_BY_FILE_FILTER, \
-    EXCLUDED_BY_LOCAL_METADATA
-from frockup.file_filter import FileFilter
+    EXCLUDED_BY_LOCAL_METADATA, get_config_option, stat_file
+from frockup.changes import ChangeTracker, DIRECTORY_PASS, get_tree_options, is_too_recent
+from frockup.dedup import Deduplicator
+from frockup.file_filter import CompiledFileFilter
 from frockup.glacier import Glacier, GlacierFtpBased
-from frockup.local_metadata import LocalMetadata, FileStats
+from frockup.local_metadata import FileStats, get_local_metadata_class
+from frockup.moves import MoveDetector
+from frockup.packing import Packer
+from frockup.walker import walk_parallel, list_directory, DEFAULT_WALKER_THREADS
 
 logger = logging_.getLogger(__name__)
 
 
-def _should_process_file(directory, filename, file_filter, local_metadata, ctx):
-    # check `directory` (same of `process_directory()`)
-    assert os.path.isabs(directory)
-    assert os.path.exists(directory)
-    assert os.path.isdir(directory)
-    # check `filename`
-    assert not os.path.isabs(filename)
-    full_filename = os.path.join(directory, filename)
-    assert not os.path.isdir(full_filename)
-    assert os.path.exists(full_filename)
-    assert os.path.isfile(full_filename)
+def _should_process_file(directory, filename, file_filter, local_metadata, ctx, entry=None):
+    """
+    If `entry` (the `os.DirEntry` of the file, from `scandir()`) is passed, the
+    checks of the paths are skipped (the directory was already checked, and the
+    entry was listed as a regular file) and the stats cached by `entry` are used,
+    so the file is stat'ed at most once.
+    """
+    ctx.add_scanned_file()
+    stats = None
+    if entry is None:
+        # check `directory` (same of `process_directory()`)
+        assert os.path.isabs(directory)
+        assert stat.S_ISDIR(stat_file(directory).st_mode)
+        # check `filename`
+        assert not os.path.isabs(filename)
+        stats = stat_file(os.path.join(directory, filename))
+        assert stat.S_ISREG(stats.st_mode)
 
+    # The filter only checks the filename: no need to stat excluded files
     if not file_filter.include_file(directory, filename):
         ctx.add_excluded(directory, filename, EXCLUDED_BY_FILE_FILTER)
         logger.debug("Ignoring file %s (excluded by filter)", filename)
         return (False, None)
 
-    file_stats = local_metadata.include_file(directory, filename)
+    if entry is not None:
+        stats = entry.stat()
+
+    if file_filter.has_stats_rules and not file_filter.include_stats(directory, filename, stats):
+        ctx.add_excluded(directory, filename, EXCLUDED_BY_FILE_FILTER)
+        logger.debug("Ignoring file %s (excluded by filter, size or age)", filename)
+        return (False, None)
+
+    file_stats = local_metadata.include_file(directory, filename, stats=stats)
     assert isinstance(file_stats, (FileStats, bool))
     if file_stats is False:
         ctx.add_excluded(directory, filename, EXCLUDED_BY_LOCAL_METADATA)
@@ -60,17 +83,77 @@ def _should_process_file(directory, filename, file_filter, local_metadata, ctx):
     return (True, file_stats)
 
 
+class UploadBudget():
+    """
+    Limits the uploads in flight, both by number of files and by the sum
+    of their sizes. A file bigger than `max_bytes` is admitted only
+    when no other upload is in flight.
+    """
+
+    def __init__(self, max_files, max_bytes):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """Waits until an upload of `size` bytes can be started"""
+        with self.condition:
+            while self.files > 0 and (self.files >= self.max_files
+                                      or self.bytes + size > self.max_bytes):
+                self.condition.wait()
+            self.files += 1
+            self.bytes += size
+
+    def release(self, size):
+        with self.condition:
+            self.files -= 1
+            self.bytes -= size
+            self.condition.notify_all()
+
+    def wait_until_idle(self):
+        """Waits until there are no uploads in flight"""
+        with self.condition:
+            while self.files > 0:
+                self.condition.wait()
+
+
 class Main():
 
-    def __init__(self, ctx=None, file_filter=FileFilter, glacier=Glacier,
-        local_metadata=LocalMetadata, config=None):
+    def __init__(self, ctx=None, file_filter=CompiledFileFilter, glacier=Glacier,
+        local_metadata=None, config=None):
         if ctx is None:
             self.ctx = Context(config=config)
         else:
             self.ctx = ctx
         self.file_filter = file_filter(self.ctx)
         self.glacier = glacier(self.ctx)
+        # By default, use the implementation selected in the configuration
+        local_metadata = local_metadata or get_local_metadata_class(self.ctx.config)
         self.local_metadata = local_metadata(self.ctx)
+        if self.ctx.packing:
+            self.packer = Packer(self.ctx, self.glacier, self.local_metadata)
+        else:
+            self.packer = None
+        if self.ctx.dedup:
+            self.deduplicator = Deduplicator(self.ctx, self.local_metadata)
+        else:
+            self.deduplicator = None
+        if self.ctx.detect_moves:
+            self.move_detector = MoveDetector(self.ctx, self.local_metadata)
+        else:
+            self.move_detector = None
+        if self.ctx.track_changes:
+            self.change_tracker = ChangeTracker(self.ctx)
+        else:
+            self.change_tracker = None
+        self.walker_threads = get_config_option(self.ctx.config, 'scan', 'walker_threads',
+            DEFAULT_WALKER_THREADS, int)
+        # Used when uploading many files at the same time (`ctx.concurrent_files` > 1)
+        self.upload_budget = UploadBudget(self.ctx.concurrent_files,
+            self.ctx.max_bytes_in_flight)
+        self.upload_pool = None
 
     def process_directory(self, directory):
         """Process the directory"""
@@ -78,20 +161,183 @@ class Main():
         assert os.path.isabs(directory)
         assert os.path.exists(directory)
         assert os.path.isdir(directory)
-        for entry in os.listdir(directory):
-            if os.path.isfile(os.path.join(directory, entry)):
-                self.process_file(directory, entry)
+        dirty, changes_state = self._start_changes(directory, DIRECTORY_PASS, recursive=False)
+        if dirty is None:
+            entries = list_directory(directory)
+        elif directory in dirty:
+            entries = self._list_dirty_entries(directory, dirty[directory])
+        else:
+            entries = []
+        self.local_metadata.check_directory(directory)
+        for entry in entries:
+            if entry.is_file():
+                self.process_file(directory, entry.name, entry)
             else:
-                logger.debug("Ignoring sub-directory '%s/%s'", directory, entry)
+                logger.debug("Ignoring sub-directory '%s/%s'", directory, entry.name)
+        self._directory_done()
+        self.upload_budget.wait_until_idle()
+        self._finish_changes(changes_state, [directory])
+
+    def _directory_done(self):
+        if self.packer is not None:
+            self.packer.flush()
+        if self.move_detector is not None:
+            self.move_detector.flush()
+
+    def _start_changes(self, directory, options, recursive):
+        """Returns the dirty directories (None if all must be processed), see `ChangeTracker`"""
+        if self.change_tracker is None or self.ctx.dry_run:
+            return None, None
+        return self.change_tracker.start(directory, options, recursive)
+
+    def _finish_changes(self, changes_state, directories):
+        if changes_state is None:
+            return
+        for directory in directories:
+            for filename, data in self.ctx.log.get(directory, {}).items():
+                if data.get('error'):
+                    # Failed uploads are checked again on the next backup
+                    self.change_tracker.add_pending(directory, filename)
+        self.change_tracker.done(changes_state, directories)
+
+    def _list_dirty_entries(self, directory, filenames):
+        """Returns the entries of the files of `directory` in `filenames` (all if None)"""
+        try:
+            entries = list_directory(directory)
+        except OSError, e:
+            # Removed after being changed
+            logger.debug("Couldn't list directory '%s': %s", directory, e)
+            return []
+        return [entry for entry in entries if entry.is_file() and
+                (filenames is None or entry.name in filenames)]
+
+    def _walk_dirty(self, top, dirty):
+        """
+        Yields `(directory, entries)` of the dirty directories of the tree at `top`
+        (same of `walk_parallel()`, but only with the dirty files)
+        """
+        for directory in sorted(dirty):
+            relative = os.path.relpath(directory, top)
+            parts = [] if relative == '.' else relative.split(os.sep)
+            if self.ctx.max_depth is not None and len(parts) > self.ctx.max_depth:
+                continue
+            parent = top
+            pruned = False
+            for name in parts:
+                if self.file_filter.prune_directory(parent, name):
+                    pruned = True
+                    break
+                parent = os.path.join(parent, name)
+            if not pruned:
+                yield directory, self._list_dirty_entries(directory, dirty[directory])
+
+    def process_tree(self, directory):
+        """Process the directory and its sub-directories (up to `ctx.max_depth` levels)"""
+        logger.debug("process_tree(): '%s'", directory)
+        assert os.path.isabs(directory)
+        assert os.path.exists(directory)
+        assert os.path.isdir(directory)
+        dirty, changes_state = self._start_changes(directory,
+            get_tree_options(self.ctx.max_depth, self.ctx.prune_directories), recursive=True)
+        if dirty is None:
+            directories = walk_parallel(directory, self.ctx.max_depth,
+                                        self.file_filter.prune_directory, self.walker_threads)
+        else:
+            directories = self._walk_dirty(directory, dirty)
+        processed = []
+        for a_directory, entries in directories:
+            self.local_metadata.check_directory(a_directory)
+            for entry in entries:
+                self.process_file(a_directory, entry.name, entry)
+            self._directory_done()
+            processed.append(a_directory)
+        self.upload_budget.wait_until_idle()
+        self._finish_changes(changes_state, processed)
+
+    def process(self, directory):
+        """Process the directory, and its sub-directories if `ctx.recursive`"""
+        if self.ctx.recursive:
+            self.process_tree(directory)
+        else:
+            self.process_directory(directory)
 
-    def process_file(self, directory, filename):
-        """Process a single file"""
+    def process_file(self, directory, filename, entry=None):
+        """Process a single file (`entry` is its `os.DirEntry`, if known)"""
         logger.debug("process_file(): '%s/%s'", directory, filename)
 
         should_proc, file_stats = _should_process_file(directory, filename, self.file_filter,
-                                                       self.local_metadata, self.ctx)
+                                                       self.local_metadata, self.ctx, entry)
 
         if not should_proc:
+            if file_stats is False and entry is not None and self.move_detector is not None:
+                # Already backed up: keep its location (the stats are cached by `entry`)
+                self.move_detector.file_seen(directory, filename, entry.stat())
+            if file_stats is None and self.change_tracker is not None and not self.ctx.dry_run:
+                self._keep_if_too_recent(directory, filename, entry)
+            return
+
+        if self.move_detector is not None and \
+                self.move_detector.record_move(directory, filename, file_stats):
+            return
+
+        if self.packer is not None and self.packer.accepts(file_stats):
+            if not self._check_duplicate(directory, filename, file_stats)[0]:
+                self.packer.add(directory, filename, file_stats)
+            return
+
+        if self.ctx.concurrent_files > 1:
+            self._start_upload(directory, filename, file_stats)
+        else:
+            self._upload(directory, filename, file_stats)
+
+    def _keep_if_too_recent(self, directory, filename, entry):
+        """Files excluded only because they're too recent must be checked again"""
+        if self.ctx.min_age is None or not self.file_filter.include_file(directory, filename):
+            return
+        stats = entry.stat() if entry is not None else stat_file(os.path.join(directory, filename))
+        if is_too_recent(self.ctx, stats):
+            self.change_tracker.add_pending(directory, filename)
+
+    def _start_upload(self, directory, filename, file_stats):
+        """Uploads the file in background, waiting for the `upload_budget` to admit it"""
+        size = file_stats.stats.st_size
+        self.upload_budget.acquire(size)
+        if self.upload_pool is None:
+            self.upload_pool = ThreadPool(self.ctx.concurrent_files)
+
+        def _upload_and_release():
+            try:
+                self._upload(directory, filename, file_stats)
+            except Exception, e:
+                logger.exception("Exception detected while processing file: '%s/%s'",
+                    directory, filename)
+                self.ctx.add_error(directory, filename, 'upload_error',
+                    traceback.format_exc() or str(e) or 'error')
+            finally:
+                self.upload_budget.release(size)
+
+        self.upload_pool.apply_async(_upload_and_release)
+
+    def _check_duplicate(self, directory, filename, file_stats):
+        """
+        Returns `(duplicate, content_hash)`. If the contents of the file were
+        already uploaded, `duplicate` is True (and the local metadata was updated).
+        """
+        if self.deduplicator is None:
+            return (False, None)
+        try:
+            content_hash = self.deduplicator.get_content_hash(directory, filename, file_stats)
+            return (self.deduplicator.record_duplicate(directory, filename, file_stats,
+                content_hash), content_hash)
+        except Exception:
+            logger.exception("Couldn't check for duplicates of file: '%s/%s'", directory,
+                filename)
+            return (False, None)
+
+    def _upload(self, directory, filename, file_stats):
+        """Uploads the file and updates the local metadata"""
+        duplicate, content_hash = self._check_duplicate(directory, filename, file_stats)
+        if duplicate:
             return
 
         error = None
@@ -113,8 +359,24 @@ class Main():
         else:
             if not self.ctx.dry_run:
                 self.local_metadata.update_metadata(directory, filename, file_stats, glacier_data)
+                if content_hash is not None:
+                    self.deduplicator.add_upload(content_hash, file_stats, glacier_data)
 
     def close(self):
+        if self.packer is not None:
+            self.packer.flush()
+        self.upload_budget.wait_until_idle()
+        if self.upload_pool is not None:
+            self.upload_pool.close()
+            self.upload_pool.join()
+            self.upload_pool = None
+        if self.deduplicator is not None:
+            self.deduplicator.close()
+        if self.move_detector is not None:
+            self.move_detector.flush()
+            self.move_detector.close()
+        if self.change_tracker is not None:
+            self.change_tracker.close()
         self.local_metadata.close()
         self.glacier.close()
 
@@ -129,10 +391,40 @@ def main():
         help="File extensions to include, separated by commas (ej: jpg,JPG)")
     parser.add_argument('--exclude', dest='exclude',
         help="File extensions to exclude, separated by commas (ej: avi,AVI,mov,MOV,xcf,XCF)")
+    parser.add_argument('--exclude-glob', dest='exclude_glob',
+        help="Filename patterns to exclude, separated by commas (ej: *.tmp,Thumbs.db)")
+    parser.add_argument('--exclude-regex', dest='exclude_regex',
+        help="Regular expression of the filenames to exclude")
+    parser.add_argument('--min-size', dest='min_size', type=int,
+        help="Ignore files smaller than this size (in KB)")
+    parser.add_argument('--max-size', dest='max_size', type=int,
+        help="Ignore files bigger than this size (in KB)")
+    parser.add_argument('--max-age', dest='max_age', type=float,
+        help="Ignore files not modified in this number of days")
     parser.add_argument('--one-file', dest='one_file',
         help="To upload only one file, if needed")
     parser.add_argument('--dry-run', dest='dry_run', action='store_true',
         help="Simulate process and report, without uploading anything")
+    parser.add_argument('--pack', dest='packing', action='store_true',
+        help="Pack small files of each directory in bundles, uploaded as one archive")
+    parser.add_argument('--dedup', dest='dedup', action='store_true',
+        help="Don't upload files whose contents were already uploaded from other directory")
+    parser.add_argument('--detect-moves', dest='detect_moves', action='store_true',
+        help="Don't upload files that were moved or renamed after being uploaded")
+    parser.add_argument('--changes', dest='track_changes', action='store_true',
+        help="Check only the files changed since the last backup, if the directory is "
+             "watched by 'python -m frockup.utils.watch_changes'")
+    parser.add_argument('--bandwidth-limit', dest='bandwidth_limit', type=int,
+        help="Max. upload speed, in kb/sec")
+    parser.add_argument('--concurrent-files', dest='concurrent_files', type=int,
+        help="Number of files to upload at the same time")
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+        help="Process sub-directories too")
+    parser.add_argument('--max-depth', dest='max_depth', type=int,
+        help="Max. levels of sub-directories to process (with --recursive)")
+    parser.add_argument('--prune', dest='prune',
+        help="Names (or patterns) of sub-directories to ignore (with --recursive), "
+             "separated by commas (ej: .thumbnails,cache*)")
     parser.add_argument('directory', nargs='+', metavar='DIRECTORY',
         help="Directory to backup")
 
@@ -154,16 +446,54 @@ def main():
     elif args.exclude:
         ctx.set_exclude_extensions(args.exclude.split(','))
 
+    if args.exclude_glob:
+        ctx.set_exclude_globs(args.exclude_glob.split(','))
+    if args.exclude_regex:
+        ctx.set_exclude_regexes([args.exclude_regex])
+    if args.min_size is not None:
+        ctx.min_size = args.min_size * 1024
+    if args.max_size is not None:
+        ctx.max_size = args.max_size * 1024
+    if args.max_age is not None:
+        ctx.max_age = args.max_age * 24 * 60 * 60
+
     if args.dry_run:
         ctx.dry_run = True
 
+    if args.packing:
+        ctx.packing = True
+
+    if args.dedup:
+        ctx.dedup = True
+
+    if args.detect_moves:
+        ctx.detect_moves = True
+
+    if args.track_changes:
+        ctx.track_changes = True
+
+    if args.bandwidth_limit:
+        ctx.set_bandwidth_limit(args.bandwidth_limit)
+
+    if args.concurrent_files:
+        ctx.concurrent_files = args.concurrent_files
+
+    if args.recursive:
+        ctx.recursive = True
+        ctx.max_depth = args.max_depth
+        if args.prune:
+            ctx.set_prune_directories(args.prune.split(','))
+    elif args.max_depth is not None or args.prune:
+        parser.error("--max-depth and --prune can be used only with --recursive.")
+        return
+
     if 'FROKUP_FTP_MODE' in os.environ:
         main = Main(ctx=ctx, glacier=GlacierFtpBased)
         try:
             main.glacier.launch()
             main.glacier.wait_for_ftpserver()
             for a_directory in args.directory:
-                main.process_directory(a_directory)
+                main.process(a_directory)
             main.close()
         finally:
             main.glacier.kill_ftp()
@@ -173,7 +503,7 @@ def main():
             main.process_file(args.directory[0], args.one_file)
         else:
             for a_directory in args.directory:
-                main.process_directory(a_directory)
+                main.process(a_directory)
         main.close()
 
     included, excluded = ctx.get_log_processed()
@@ -185,5 +515,15 @@ def main():
     for dirname, filename in excluded:
         print " - {0}/{1}".format(dirname, filename)
 
+    if ctx.dedup:
+        print "{0} duplicated file(s) not uploaded, {1} bytes saved".format(
+            ctx.deduplicated_count, ctx.bytes_saved)
+
+    if ctx.detect_moves:
+        print "{0} moved file(s) not uploaded".format(ctx.moved_count)
+
+    print "{0} file(s) scanned, {1:.2f} stat call(s) per file".format(ctx.scanned_files,
+        ctx.get_stat_calls_per_file())
+
 if __name__ == '__main__':
     main()
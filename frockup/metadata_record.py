@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+"""
+Serialization of the local metadata of a file.
+
+Two formats are supported:
+
+- JSON: the original format, a JSON object with keys like 'archive_id',
+  'stats.st_size', 'stats.st_mtime', 'old_archive_ids', etc.
+- Binary (version 1): a fixed-width header followed by the variable-length
+  fields, all little-endian:
+
+      B   version (1)
+      B   flags (see FLAG_*)
+      q   stats.st_size
+      d   stats.st_mtime
+      H   length of archive_id, followed by archive_id
+      32s tree_hash (binary digest)                   if FLAG_TREE_HASH
+      q q bundle.offset, bundle.length                if FLAG_BUNDLE
+      H   number of old_archive_ids, followed by
+          each one as (H length, bytes)
+      I   length of a JSON object with any other key  if FLAG_EXTRA
+
+JSON records always start with '{', so both formats can be read.
+"""
+
+import binascii
+import json
+import struct
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
+BINARY_VERSION = 1
+
+FLAG_TREE_HASH = 0x01
+FLAG_BUNDLE = 0x02
+FLAG_EXTRA = 0x04
+
+_HEADER = struct.Struct('<BBqd')
+_LENGTH = struct.Struct('<H')
+_BUNDLE = struct.Struct('<qq')
+_EXTRA_LENGTH = struct.Struct('<I')
+
+# Keys stored in fixed fields of the binary format
+_BINARY_KEYS = frozenset(['archive_id', 'stats.st_size', 'stats.st_mtime', 'tree_hash',
+    'bundle.offset', 'bundle.length', 'old_archive_ids'])
+
+
+def _pack_string(value):
+    value = str(value)
+    return _LENGTH.pack(len(value)) + value
+
+
+def _unpack_string(raw_data, offset):
+    length, = _LENGTH.unpack_from(raw_data, offset)
+    offset += _LENGTH.size
+    return raw_data[offset:offset + length], offset + length
+
+
+def encode_record(data, record_format=FORMAT_BINARY):
+    """
+    Serializes the metadata of a file. Records without archive id or
+    stats are always serialized as JSON.
+    """
+    if record_format == FORMAT_JSON or data.get('archive_id') is None \
+            or data.get('stats.st_size') is None or data.get('stats.st_mtime') is None:
+        return json.dumps(data)
+
+    flags = 0
+    fields = [_pack_string(data['archive_id'])]
+    if data.get('tree_hash'):
+        flags |= FLAG_TREE_HASH
+        fields.append(binascii.unhexlify(data['tree_hash']))
+    if data.get('bundle.offset') is not None:
+        flags |= FLAG_BUNDLE
+        fields.append(_BUNDLE.pack(data['bundle.offset'], data['bundle.length']))
+    old_archive_ids = data.get('old_archive_ids', [])
+    fields.append(_LENGTH.pack(len(old_archive_ids)))
+    fields.extend([_pack_string(archive_id) for archive_id in old_archive_ids])
+    extra = dict([(key, value) for key, value in data.iteritems()
+                  if key not in _BINARY_KEYS])
+    if extra:
+        flags |= FLAG_EXTRA
+        extra_json = json.dumps(extra)
+        fields.append(_EXTRA_LENGTH.pack(len(extra_json)) + extra_json)
+
+    header = _HEADER.pack(BINARY_VERSION, flags, data['stats.st_size'],
+        data['stats.st_mtime'])
+    return header + ''.join(fields)
+
+
+def decode_record(raw_data):
+    """Deserializes the metadata of a file (in any of the supported formats)"""
+    if raw_data.startswith('{'):
+        return json.loads(raw_data)
+
+    version, flags, st_size, st_mtime = _HEADER.unpack_from(raw_data)
+    assert version == BINARY_VERSION, \
+        "Unsupported metadata record version: {0}".format(version)
+    data = {'stats.st_size': st_size, 'stats.st_mtime': st_mtime}
+    data['archive_id'], offset = _unpack_string(raw_data, _HEADER.size)
+    if flags & FLAG_TREE_HASH:
+        data['tree_hash'] = binascii.hexlify(raw_data[offset:offset + 32])
+        offset += 32
+    if flags & FLAG_BUNDLE:
+        data['bundle.offset'], data['bundle.length'] = _BUNDLE.unpack_from(raw_data, offset)
+        offset += _BUNDLE.size
+    count, = _LENGTH.unpack_from(raw_data, offset)
+    offset += _LENGTH.size
+    if count:
+        data['old_archive_ids'] = []
+        for _ in xrange(count):
+            archive_id, offset = _unpack_string(raw_data, offset)
+            data['old_archive_ids'].append(archive_id)
+    if flags & FLAG_EXTRA:
+        length, = _EXTRA_LENGTH.unpack_from(raw_data, offset)
+        offset += _EXTRA_LENGTH.size
+        data.update(json.loads(raw_data[offset:offset + length]))
+    return data
+
+
+def decode_stats(raw_data):
+    """
+    Returns `(st_size, st_mtime)` of the record (any of them may be None),
+    without deserializing the other fields (when possible)
+    """
+    if raw_data.startswith('{'):
+        data = json.loads(raw_data)
+        return (data.get('stats.st_size'), data.get('stats.st_mtime'))
+    version, _, st_size, st_mtime = _HEADER.unpack_from(raw_data)
+    assert version == BINARY_VERSION, \
+        "Unsupported metadata record version: {0}".format(version)
+    return (st_size, st_mtime)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import os
+import sqlite3
+import threading
+
+from frockup.common import get_config_option
+from frockup.glacier import GlacierData
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_LOCATION_INDEX_FILENAME = '~/.frockup/locations.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (device, inode)
+);
+"""
+
+
+class LocationIndex():
+    """
+    Index of the location of the backed up files, by (device, inode), shared
+    by all the directories. Used to recognize files that were moved or renamed.
+
+    The methods can be called from different threads.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = os.path.expanduser(filename or DEFAULT_LOCATION_INDEX_FILENAME)
+        logger.debug("Opening location index at '%s'", self.filename)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        # Filenames are byte strings, and may not be valid UTF-8
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def get(self, stats):
+        """Returns the `(directory, filename)` of the file with the same inode, size and mtime"""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT directory, filename FROM locations WHERE device = ? AND inode = ? "
+                "AND size = ? AND mtime = ?",
+                (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime)).fetchone()
+
+    def set(self, directory, filename, stats, commit=True):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO locations (device, inode, size, mtime, directory, "
+                "filename) VALUES (?, ?, ?, ?, ?, ?)", (stats.st_dev, stats.st_ino,
+                stats.st_size, stats.st_mtime, directory, filename))
+            if commit:
+                self.connection.commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MoveDetector():
+    """
+    Recognizes files that were moved or renamed since they were backed up,
+    and copies the metadata of the old location (archive id, etc.) to the
+    new one, instead of uploading them again.
+
+    The location of each file is recorded when its local metadata is
+    updated, and when a scan finds it already backed up.
+    """
+
+    def __init__(self, ctx, local_metadata):
+        self.ctx = ctx
+        self.local_metadata = local_metadata
+        self.index = LocationIndex(get_config_option(self.ctx.config, 'moves', 'index'))
+        self.local_metadata.add_listener(self.metadata_updated)
+
+    def metadata_updated(self, directory, filename, file_stats, glacier_data):
+        self.index.set(directory, filename, file_stats.stats)
+
+    def file_seen(self, directory, filename, stats):
+        """Records the location of a file found already backed up (committed on `flush()`)"""
+        self.index.set(directory, filename, stats, commit=False)
+
+    def flush(self):
+        self.index.commit()
+
+    def record_move(self, directory, filename, file_stats):
+        """
+        If the file was backed up in other location, updates the local metadata
+        to reference its archive and returns True
+        """
+        location = self.index.get(file_stats.stats)
+        if location is None or location == (directory, filename):
+            return False
+        old_directory, old_filename = location
+        data = self.local_metadata.get_file_data(old_directory, old_filename)
+        if data.get('archive_id') is None or \
+                data.get('stats.st_size') != file_stats.stats.st_size or \
+                data.get('stats.st_mtime') != file_stats.stats.st_mtime:
+            return False
+
+        logger.info("File '%s/%s' was moved from '%s/%s' (not uploaded)", directory, filename,
+            old_directory, old_filename)
+        glacier_data = GlacierData()
+        glacier_data.archive_id = data['archive_id']
+        glacier_data.tree_hash = data.get('tree_hash')
+        glacier_data.bundle_offset = data.get('bundle.offset')
+        glacier_data.bundle_length = data.get('bundle.length')
+        self.local_metadata.update_metadata(directory, filename, file_stats, glacier_data)
+        self.ctx.add_moved(directory, filename, os.path.join(old_directory, old_filename))
+        return True
+
+    def close(self):
+        self.index.close()
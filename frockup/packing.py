@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import os
+import shutil
+import tarfile
+import tempfile
+import traceback
+
+from frockup.common import get_config_option
+from frockup.glacier import GlacierData
+
+logger = logging_.getLogger(__name__)
+
+# Defaults of the `[packing]` section of the configuration
+DEFAULT_MAX_FILE_SIZE_KB = 1024
+DEFAULT_BUNDLE_SIZE_MB = 64
+
+BUNDLE_FILENAME = 'bundle.tar'
+
+
+class Bundle():
+    """
+    Tar archive, created in a temporary directory, with small files
+    of one directory. The bundle is uploaded to Glacier as a single archive.
+
+    For each file, the offset and length of its contents inside the
+    archive are kept in `members`, to allow ranged retrievals.
+    """
+
+    def __init__(self, directory, tmp_dir=None):
+        self.directory = directory
+        self.tmp_dir = tempfile.mkdtemp(prefix='frockup-bundle-', dir=tmp_dir)
+        self.fileobj = open(os.path.join(self.tmp_dir, BUNDLE_FILENAME), 'wb')
+        self.tar = tarfile.open(fileobj=self.fileobj, mode='w')
+        # List of (filename, file_stats, offset, length)
+        self.members = []
+
+    @property
+    def size(self):
+        return self.tar.offset
+
+    def add(self, filename, file_stats):
+        full_filename = os.path.join(self.directory, filename)
+        start_offset = self.tar.offset
+        try:
+            tarinfo = self.tar.gettarinfo(full_filename, arcname=filename)
+            with open(full_filename, 'rb') as fp:
+                self.tar.addfile(tarinfo, fp)
+        except:
+            # Discard anything written, to keep the archive consistent
+            self.fileobj.seek(start_offset)
+            self.fileobj.truncate()
+            self.tar.offset = start_offset
+            raise
+        # The contents are at the end of the archive, padded to `BLOCKSIZE`
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder:
+            blocks += 1
+        offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+        self.members.append((filename, file_stats, offset, tarinfo.size))
+
+    def close(self):
+        """Writes the end of the archive. The bundle can't be modified after this"""
+        self.tar.close()
+        self.fileobj.close()
+
+    def remove(self):
+        """Removes the temporary directory"""
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class Packer():
+    """
+    Groups small files of a directory in bundles, and uploads each
+    bundle as one archive, to avoid the per-archive overhead of Glacier.
+
+    The local metadata of each file references the archive of the bundle,
+    with the offset and length of the file inside it.
+    """
+
+    def __init__(self, ctx, glacier, local_metadata):
+        self.ctx = ctx
+        self.glacier = glacier
+        self.local_metadata = local_metadata
+        # Files up to this size are packed
+        self.max_file_size = get_config_option(self.ctx.config, 'packing',
+            'max_file_size_kb', DEFAULT_MAX_FILE_SIZE_KB, int) * 1024
+        # Bundles are uploaded when reaching this size
+        self.bundle_size = get_config_option(self.ctx.config, 'packing',
+            'bundle_size_mb', DEFAULT_BUNDLE_SIZE_MB, int) * 1024 * 1024
+        self.tmp_dir = get_config_option(self.ctx.config, 'packing', 'tmp_dir', None)
+        self.bundle = None
+
+    def accepts(self, file_stats):
+        """Returns True if the file is small enough to be packed"""
+        return file_stats.stats.st_size <= self.max_file_size
+
+    def add(self, directory, filename, file_stats):
+        """Adds the file to the current bundle, uploading it if it's full"""
+        logger.debug("Packing file '%s/%s'", directory, filename)
+        if self.ctx.dry_run:
+            return
+        if self.bundle is not None:
+            if self.bundle.directory != directory or \
+                    self.bundle.size + file_stats.stats.st_size > self.bundle_size:
+                self.flush()
+        if self.bundle is None:
+            self.bundle = Bundle(directory, self.tmp_dir)
+        try:
+            self.bundle.add(filename, file_stats)
+        except Exception, e:
+            logger.info("Exception '%s' detected while packing file: '%s/%s'", e,
+                directory, filename)
+            self.ctx.add_error(directory, filename, 'packing_error',
+                traceback.format_exc() or str(e) or 'error')
+
+    def flush(self):
+        """Uploads the current bundle (if any) and updates the local metadata"""
+        bundle, self.bundle = self.bundle, None
+        if bundle is None:
+            return
+        try:
+            bundle.close()
+            if not bundle.members:
+                return
+            logger.info("Uploading bundle of %s file(s) of '%s'", len(bundle.members),
+                bundle.directory)
+            try:
+                bundle_data = self.glacier.upload_file(bundle.tmp_dir, BUNDLE_FILENAME,
+                    description="frockup bundle of {0}".format(bundle.directory))
+            except Exception, e:
+                logger.info("Exception '%s' detected while uploading bundle of '%s'", e,
+                    bundle.directory)
+                error = traceback.format_exc() or str(e) or 'error'
+                for filename, _, _, _ in bundle.members:
+                    self.ctx.add_error(bundle.directory, filename, 'upload_error', error)
+                return
+
+            for filename, file_stats, offset, length in bundle.members:
+                glacier_data = GlacierData()
+                glacier_data.archive_id = bundle_data.archive_id
+                glacier_data.bundle_offset = offset
+                glacier_data.bundle_length = length
+                self.local_metadata.update_metadata(bundle.directory, filename, file_stats,
+                    glacier_data)
+        finally:
+            bundle.remove()
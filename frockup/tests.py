@@ -17,8 +17,10 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #===============================================================================
 
+import ConfigParser
 import logging
 import os
+import socket
 import unittest
 import uuid
 import pprint
@@ -26,12 +28,43 @@ import shutil
 import time
 import gdbm
 import json
+import hashlib
+import tempfile
+import multiprocessing
+import threading
+from cStringIO import StringIO
 
 from frockup.main import Main
 from frockup.glacier import GlacierFtpBased, GlacierMock, \
-    GlacierErrorOnUploadMock
+    GlacierErrorOnUploadMock, get_part_size, MEGABYTE, hash_part, \
+    iter_hashed_parts, combine_tree_hashes, GlacierData, ThrottledBody, UPLOAD_CHUNK_SIZE, \
+    Glacier, GlacierConnectionPool, get_connection_pool, close_connection_pools, \
+    _connection_pools
 from frockup.common import get_config, Context
-from frockup.file_filter import FileFilter
+from frockup.file_filter import FileFilter, CompiledFileFilter
+from frockup.local_metadata import FileStats, LocalMetadata, SqliteLocalMetadata
+from frockup.packing import Bundle
+from frockup.walker import walk_parallel
+from frockup.bandwidth import TokenBucket
+from frockup.web.adaptive import AdaptiveConcurrency, INCREASE, DECREASE, BACK_OFF, \
+    KEEP
+from frockup.web.background import upload_worker, ProcessController, PROCESS_STARTED, \
+    PROCESS_FINISH_OK, PROCESS_PROGRESS, WORKER_EXIT, SCAN_DIRECTORY, SCAN_RESULT, \
+    UPLOAD_RESULT, UPLOAD_FILE, LAUNCH_BACKUP, GET_STATUS, STOP_ALL_PROCESSES, \
+    PROCESS_FINISH_WITH_ERROR, METADATA_MAX_ATTEMPTS, EVENT_DIRECTORY_FINISHED, \
+    UploadProgress, _upload_file
+from frockup.web.events import EventBroadcaster
+from frockup.web.journal import JobJournal
+from frockup.web.scan_cache import DirectoryScanCache
+from frockup.web.scan_jobs import ScanJob, create_scan_pool
+from frockup.web.scheduling import JobQueue, FIFO, SHORTEST_FIRST, LARGEST_FIRST, \
+    FAIR_SHARE
+from frockup.catalog import MetadataCatalog
+from frockup.changes import ChangeIndex, ChangeWatcher, Inotify, IN_Q_OVERFLOW, \
+    WHOLE_DIRECTORY
+from frockup.checkpoints import CheckpointStore
+from frockup.metadata_record import encode_record, decode_record, decode_stats, \
+    FORMAT_JSON
 
 DB_FILENAME = '.frockup.gdbm'
 
@@ -88,7 +121,7 @@ class BaseTest(unittest.TestCase):
         copy = {}
         k = db.firstkey()
         while k != None:
-            copy[k] = json.loads(db[k])
+            copy[k] = decode_record(db[k])
             k = db.nextkey(k)
         db.close()
         return copy
@@ -111,7 +144,7 @@ class BaseTest(unittest.TestCase):
         database = gdbm.open(db_filename, 'c')
         logging.debug("Database at %s: %s", db_filename, pprint.pformat(database))
         for filename in ('file1.txt', 'file2.txt', 'file3.txt'):
-            data = json.loads(database[filename])
+            data = decode_record(database[filename])
             data['archive_id']
             data['stats.st_size']
             data['stats.st_mtime']
@@ -136,7 +169,7 @@ class BaseTest(unittest.TestCase):
         database = gdbm.open(db_filename, 'c')
         logging.debug("Database at %s: %s", db_filename, pprint.pformat(database))
         for filename in ('file1.txt', 'file2.txt', 'file3.txt'):
-            data = json.loads(database[filename])
+            data = decode_record(database[filename])
             self.assertDictEqual(data,
                 created_metadata[filename])
 
@@ -286,6 +319,200 @@ class BaseTest(unittest.TestCase):
             pprint.pformat(self._get_db_copy(dir1)))
         logging.debug("Log: %s", pprint.pformat(main.ctx.log))
 
+    def test_concurrent_uploads(self):
+        dir1 = self._get_test_subdir('dir1')
+        self._remove_db_if_exists(dir1)
+        ctx = Context()
+        ctx.concurrent_files = 3
+        ctx.max_bytes_in_flight = 1
+        main = Main(ctx=ctx, glacier=GlacierMock)
+        main.process_directory(dir1)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 3)
+        self.assertEqual(main.ctx.error_count, 0)
+        db = self._get_db_copy(dir1)
+        self.assertEqual(sorted(db.keys()), ['file1.txt', 'file2.txt', 'file3.txt'])
+
+    def test_files_are_stated_once(self):
+        dir1 = self._get_test_subdir('dir1')
+        self._remove_db_if_exists(dir1)
+        main = Main(glacier=GlacierMock)
+        main.process_directory(dir1)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 3)
+        self.assertTrue(main.ctx.scanned_files >= 3)
+
+        # Nothing to upload: the entries are stat'ed at most once, and the
+        # signature of the DB is read once for the whole directory
+        main = Main(glacier=GlacierMock)
+        main.process_directory(dir1)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 0)
+        entries_count = len(os.listdir(dir1))
+        self.assertTrue(main.ctx.get_stat_calls() >= 1)
+        self.assertTrue(main.ctx.get_stat_calls() <= entries_count + 1, main.ctx.get_stat_calls())
+        self.assertTrue(main.ctx.get_stat_calls_per_file() <= (entries_count + 1.0) / 3)
+
+        # A single file: the directory and the file
+        main = Main(glacier=GlacierMock)
+        main.process_file(dir1, 'file1.txt')
+        main.close()
+        self.assertEqual(main.ctx.get_stat_calls(), 2 + 1)
+
+    def test_sqlite_backend(self):
+        dir1 = self._get_test_subdir('dir1')
+        self._remove_db_if_exists(dir1)
+        tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            catalog_filename = os.path.join(tmp_dir, 'catalog.sqlite')
+            for expected_included in (3, 0):
+                ctx = Context()
+                if not ctx.config.has_section('metadata'):
+                    ctx.config.add_section('metadata')
+                ctx.config.set('metadata', 'backend', 'sqlite')
+                ctx.config.set('metadata', 'catalog', catalog_filename)
+                main = Main(ctx=ctx, glacier=GlacierMock)
+                main.process_directory(dir1)
+                main.close()
+                self.assertEqual(main.ctx.included_count, expected_included)
+            # No gdbm database was created
+            self.assertFalse(os.path.exists(os.path.join(dir1, DB_FILENAME)))
+            catalog = MetadataCatalog(catalog_filename)
+            self.assertEqual(sorted(catalog.get_directory(dir1).keys()),
+                             ['file1.txt', 'file2.txt', 'file3.txt'])
+            catalog.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_catalog_versions(self):
+        tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            ctx = Context()
+            if not ctx.config.has_section('metadata'):
+                ctx.config.add_section('metadata')
+            ctx.config.set('metadata', 'catalog', os.path.join(tmp_dir, 'catalog.sqlite'))
+            local_metadata = SqliteLocalMetadata(ctx)
+            self.assertEqual(local_metadata.get_signature('/dir1'), 0)
+            catalog = MetadataCatalog(os.path.join(tmp_dir, 'catalog.sqlite'))
+            catalog.set('/dir1', 'file1', 'data')
+            catalog.set('/dir1', 'file2', 'data')
+            catalog.set('/dir2', 'file1', 'data')
+            # Only the changes of the directory change its signature
+            signature = local_metadata.get_signature('/dir1')
+            self.assertEqual(signature, 2)
+            catalog.set('/dir2', 'file1', 'other data')
+            self.assertEqual(local_metadata.get_signature('/dir1'), signature)
+            self.assertEqual(local_metadata.get_signature('/dir2'), 2)
+            catalog.set('/dir1', 'file1', 'other data')
+            self.assertEqual(local_metadata.get_signature('/dir1'), signature + 1)
+            catalog.close()
+            local_metadata.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_dedup(self):
+        tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            for dirname in ('photos', 'best-of'):
+                os.mkdir(os.path.join(tmp_dir, dirname))
+                with open(os.path.join(tmp_dir, dirname, 'IMG_1.jpg'), 'w') as a_file:
+                    a_file.write('the same contents' * 100)
+            ctx = Context()
+            ctx.dedup = True
+            if not ctx.config.has_section('dedup'):
+                ctx.config.add_section('dedup')
+            ctx.config.set('dedup', 'index', os.path.join(tmp_dir, 'dedup.sqlite'))
+            main = Main(ctx=ctx, glacier=GlacierMock)
+            main.process_directory(os.path.join(tmp_dir, 'photos'))
+            main.process_directory(os.path.join(tmp_dir, 'best-of'))
+            main.close()
+            self.assertEqual(ctx.included_count, 2)
+            self.assertEqual(ctx.deduplicated_count, 1)
+            self.assertEqual(ctx.bytes_saved, len('the same contents') * 100)
+            archive_ids = [self._get_db_copy(os.path.join(tmp_dir, dirname))['IMG_1.jpg']
+                           ['archive_id'] for dirname in ('photos', 'best-of')]
+            self.assertEqual(archive_ids[0], archive_ids[1])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_moved_files_are_not_uploaded(self):
+        tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            for dirname in ('old', 'new'):
+                os.mkdir(os.path.join(tmp_dir, dirname))
+            with open(os.path.join(tmp_dir, 'old', 'IMG_1.jpg'), 'w') as a_file:
+                a_file.write('contents of the photo')
+
+            def _process(dirname, glacier):
+                ctx = Context()
+                ctx.detect_moves = True
+                if not ctx.config.has_section('moves'):
+                    ctx.config.add_section('moves')
+                ctx.config.set('moves', 'index', os.path.join(tmp_dir, 'locations.sqlite'))
+                main = Main(ctx=ctx, glacier=glacier)
+                main.process_directory(os.path.join(tmp_dir, dirname))
+                main.close()
+                return ctx
+
+            _process('old', GlacierMock)
+            os.rename(os.path.join(tmp_dir, 'old', 'IMG_1.jpg'),
+                      os.path.join(tmp_dir, 'new', 'IMG_1-renamed.jpg'))
+            # Any upload would fail
+            ctx = _process('new', GlacierErrorOnUploadMock)
+            self.assertEqual(ctx.error_count, 0)
+            self.assertEqual(ctx.moved_count, 1)
+            self.assertEqual(self._get_db_copy(os.path.join(tmp_dir, 'old'))['IMG_1.jpg']
+                             ['archive_id'], self._get_db_copy(os.path.join(tmp_dir, 'new'))
+                             ['IMG_1-renamed.jpg']['archive_id'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_snapshot_is_discarded_when_db_changes(self):
+        dir2 = self._get_test_subdir('dir2')
+        _generate_local_metadata_db(dir2, ('file1.txt', 'file2.txt', 'file3.txt'),
+            overwrite=True)
+        main = Main(glacier=GlacierMock)
+        main.process_directory(dir2)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 0)
+        # The DB is modified by someone else
+        _generate_local_metadata_db(dir2, ('file1.txt',), overwrite=True)
+        main = Main(glacier=GlacierMock)
+        main.process_directory(dir2)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 2)
+
+    def test_packing(self):
+        dir1 = self._get_test_subdir('dir1')
+        self._remove_db_if_exists(dir1)
+        ctx = Context()
+        ctx.packing = True
+        main = Main(ctx=ctx, glacier=GlacierMock)
+        main.process_directory(dir1)
+        main.close()
+        self.assertEqual(main.ctx.included_count, 3)
+        db = self._get_db_copy(dir1)
+        # All the files are in the same bundle
+        self.assertEqual(len(set([db[filename]['archive_id'] for filename in db])), 1)
+        for filename in ('file1.txt', 'file2.txt', 'file3.txt'):
+            self.assertEqual(db[filename]['bundle.length'],
+                             os.path.getsize(os.path.join(dir1, filename)))
+
+    def test_bundle_offsets(self):
+        dir2 = self._get_test_subdir('dir2')
+        bundle = Bundle(dir2)
+        try:
+            for filename in ('file1.txt', 'file2.txt', 'file3.txt'):
+                bundle.add(filename, FileStats(os.stat(os.path.join(dir2, filename))))
+            bundle.close()
+            with open(os.path.join(bundle.tmp_dir, 'bundle.tar'), 'rb') as bundle_file:
+                for filename, _, offset, length in bundle.members:
+                    bundle_file.seek(offset)
+                    with open(os.path.join(dir2, filename), 'rb') as original:
+                        self.assertEqual(bundle_file.read(length), original.read())
+        finally:
+            bundle.remove()
+
     def test_change_in_file_while_upload_is_detected(self):
         # FIXME: implement this test!
         pass
@@ -304,6 +531,49 @@ class ConfigLoadTest(unittest.TestCase):
 
 class GlacierTest(unittest.TestCase):
 
+    def test_get_part_size(self):
+        self.assertEqual(get_part_size(10 * MEGABYTE, 8 * MEGABYTE), 8 * MEGABYTE)
+        self.assertEqual(get_part_size(10 * MEGABYTE, 5 * MEGABYTE), 8 * MEGABYTE)
+        self.assertEqual(get_part_size(10 * MEGABYTE, 1), MEGABYTE)
+        # Must not exceed 10,000 parts
+        self.assertEqual(get_part_size(20000 * MEGABYTE, MEGABYTE), 2 * MEGABYTE)
+        self.assertRaises(ValueError, get_part_size, 4096 * MEGABYTE * 10001, MEGABYTE)
+
+    def test_tree_hash_of_parts(self):
+        data = os.urandom(5 * MEGABYTE + 123)
+        linear_hash, tree_hash = hash_part(data)
+        parts = list(iter_hashed_parts(StringIO(data), 2 * MEGABYTE))
+        self.assertEqual([offset for offset, _, _, _ in parts], [0, 2 * MEGABYTE, 4 * MEGABYTE])
+        self.assertEqual(''.join([part_data for _, part_data, _, _ in parts]), data)
+        self.assertEqual(combine_tree_hashes([part_hash for _, _, _, part_hash in parts]),
+                         tree_hash)
+        self.assertEqual(linear_hash, hashlib.sha256(data).hexdigest())
+
+    def test_checkpoints(self):
+        tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            store = CheckpointStore(tmp_dir)
+            stats = os.stat(__file__)
+            self.assertEqual(store.load('vault', __file__), None)
+            checkpoint = store.create('vault', __file__, stats, 'upload-1', MEGABYTE)
+            checkpoint.add_part(MEGABYTE, hashlib.sha256('x').digest())
+            checkpoint = store.load('vault', __file__)
+            self.assertEqual(checkpoint.upload_id, 'upload-1')
+            self.assertTrue(checkpoint.matches(stats))
+            self.assertEqual(checkpoint.get_part_hashes(), {MEGABYTE: hashlib.sha256('x').digest()})
+            self.assertEqual(len(store.get_checkpoints()), 1)
+            checkpoint.remove()
+            self.assertEqual(store.get_checkpoints(), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # Uploaded parts aren't read again
+        data = os.urandom(3 * MEGABYTE + 1)
+        parts = list(iter_hashed_parts(StringIO(data), MEGABYTE,
+                                       skip_offsets=frozenset([0, 2 * MEGABYTE])))
+        self.assertEqual([offset for offset, _, _, _ in parts], [MEGABYTE, 3 * MEGABYTE])
+        self.assertEqual(parts[1][1], data[3 * MEGABYTE:])
+
     def _test_list_vaults(self):
         config = get_config()
         from boto.glacier.layer1 import Layer1
@@ -324,35 +594,989 @@ class GlacierTest(unittest.TestCase):
         l1.close()
 
 
+class _FakeLayer1(object):
+    """Fake boto Layer1: `make_request()` raises the pending `errors` (one per call)"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.healthy = True
+        self.health_checks = 0
+        self.closed = False
+
+    def describe_vault(self, vault_name):
+        self.health_checks += 1
+        if not self.healthy:
+            raise socket.error("Connection reset by peer")
+        return {'VaultName': vault_name}
+
+    def make_request(self, method, path, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'ArchiveId': 'archive-1'}
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeVault(object):
+
+    def __init__(self, layer1, name):
+        self.layer1 = layer1
+        self.name = name
+
+
+class _FakeLayer2(object):
+
+    def __init__(self, errors):
+        self.layer1 = _FakeLayer1(errors)
+
+    def get_vault(self, vault_name):
+        return _FakeVault(self.layer1, vault_name)
+
+
+class _FakeConnectionPool(GlacierConnectionPool):
+    """GlacierConnectionPool that records the (fake) connections it creates"""
+
+    def __init__(self, config, errors=()):
+        GlacierConnectionPool.__init__(self, config)
+        self.errors = list(errors)
+        self.connections = []
+
+    def _connect(self):
+        self.layer2 = _FakeLayer2(self.errors)
+        self.connections.append(self.layer2)
+        self.vaults = {}
+
+
+class GlacierConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigParser.ConfigParser()
+        for section, options in (
+                ('identity', {'aws_access_key_id': uuid.uuid4().hex,
+                              'aws_secret_access_key': 'secret'}),
+                ('defaults', {'vault_name': 'vault'}),
+                ('upload', {'health_check_interval': '60', 'hashing_processes': '0',
+                            'resumable': 'false'})):
+            self.config.add_section(section)
+            for option, value in options.items():
+                self.config.set(section, option, value)
+        self.directory = tempfile.mkdtemp(prefix='frockup-test-')
+        with open(os.path.join(self.directory, 'file.jpg'), 'w') as f:
+            f.write('x' * 1024)
+
+    def tearDown(self):
+        close_connection_pools()
+        shutil.rmtree(self.directory)
+
+    def test_connection_reused_until_unhealthy(self):
+        pool = _FakeConnectionPool(self.config)
+        vault = pool.get_vault('vault')
+        self.assertIs(pool.get_vault('vault'), vault)
+        self.assertEqual(len(pool.connections), 1)
+        self.assertEqual(vault.layer1.health_checks, 0)
+        # Checked after being idle for `health_check_interval` seconds
+        pool.last_used -= 61
+        self.assertIs(pool.get_vault('vault'), vault)
+        self.assertEqual(vault.layer1.health_checks, 1)
+        # Re-created if the check fails
+        vault.layer1.healthy = False
+        pool.last_used -= 61
+        new_vault = pool.get_vault('vault')
+        self.assertIsNot(new_vault, vault)
+        self.assertTrue(vault.layer1.closed)
+        self.assertEqual(len(pool.connections), 2)
+        # ...and after invalidate()
+        pool.invalidate()
+        self.assertTrue(new_vault.layer1.closed)
+        self.assertIsNot(pool.get_vault('vault'), new_vault)
+        self.assertEqual(len(pool.connections), 3)
+
+    def test_pool_per_process(self):
+        pool = get_connection_pool(self.config)
+        self.assertIs(get_connection_pool(self.config), pool)
+        parent_conn, child_conn = multiprocessing.Pipe()
+
+        def _child():
+            # The pool inherited from the parent isn't used after the fork
+            child_conn.send(get_connection_pool(self.config) is not pool)
+
+        process = multiprocessing.Process(target=_child)
+        process.start()
+        self.assertTrue(parent_conn.poll(5))
+        self.assertTrue(parent_conn.recv())
+        process.join()
+
+    def test_upload_retried_once_with_new_connection(self):
+        pool = _FakeConnectionPool(self.config, [socket.error("Connection reset by peer")])
+        _connection_pools[(os.getpid(), self.config.get('identity', 'aws_access_key_id'))] = pool
+        glacier = Glacier(Context(self.config))
+        try:
+            self.assertEqual(glacier.upload_file(self.directory, 'file.jpg').archive_id,
+                             'archive-1')
+            self.assertEqual(len(pool.connections), 2)
+            self.assertTrue(pool.connections[0].layer1.closed)
+            # Fails if the retry fails too
+            pool.errors.extend([socket.error("Connection reset by peer")] * 2)
+            self.assertRaises(socket.error, glacier.upload_file, self.directory, 'file.jpg')
+            self.assertEqual(len(pool.connections), 3)
+            self.assertEqual(len(pool.errors), 0)
+        finally:
+            glacier.close()
+
+
+class MetadataRecordTest(unittest.TestCase):
+
+    def test_binary_record(self):
+        data = {
+            'archive_id': 'archive-2',
+            'stats.st_size': 1234,
+            'stats.st_mtime': 1380000000.25,
+            'tree_hash': hashlib.sha256('x').hexdigest(),
+            'bundle.offset': 512,
+            'bundle.length': 1234,
+            'old_archive_ids': ['archive-0', 'archive-1'],
+            'other': 'value',
+        }
+        raw_data = encode_record(data)
+        self.assertNotEqual(raw_data[0], '{')
+        self.assertDictEqual(decode_record(raw_data), data)
+        self.assertEqual(decode_stats(raw_data), (1234, 1380000000.25))
+        self.assertTrue(len(raw_data) < len(encode_record(data, FORMAT_JSON)))
+
+        data = {'archive_id': 'archive-0', 'stats.st_size': 0, 'stats.st_mtime': 1.0}
+        self.assertDictEqual(decode_record(encode_record(data)), data)
+
+    def test_json_record(self):
+        data = {'archive_id': 'archive-0', 'stats.st_size': 10, 'stats.st_mtime': 2.5}
+        self.assertDictEqual(decode_record(json.dumps(data)), data)
+        self.assertEqual(decode_stats(json.dumps(data)), (10, 2.5))
+        # Records without archive id are kept as JSON
+        self.assertEqual(encode_record({'stats.st_size': 10}), json.dumps({'stats.st_size': 10}))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_consume(self):
+        bucket = TokenBucket(1000000)
+        start_time = time.time()
+        # The first second of tokens is available
+        bucket.consume(1000000)
+        self.assertTrue(time.time() - start_time < 0.1)
+        bucket.consume(200000)
+        self.assertTrue(time.time() - start_time >= 0.15)
+
+        # No limit
+        bucket.set_rate(0)
+        start_time = time.time()
+        bucket.consume(10000000)
+        self.assertTrue(time.time() - start_time < 0.1)
+
+    def test_shared_between_processes(self):
+        bucket = TokenBucket(1000000)
+        process = multiprocessing.Process(target=bucket.consume, args=(1000000,))
+        process.start()
+        process.join()
+        # The tokens were consumed by the other process
+        start_time = time.time()
+        bucket.consume(200000)
+        self.assertTrue(time.time() - start_time >= 0.15)
+
+
+class ThrottledBodyTest(unittest.TestCase):
+
+    def _send(self, body, block_size=8192):
+        """Reads `body` as `httplib` does, returns the (elapsed time, bytes sent) of each block"""
+        start_time = time.time()
+        sent = []
+        total = 0
+        while True:
+            block = body.read(block_size)
+            if not block:
+                return sent
+            total += len(block)
+            sent.append((time.time() - start_time, total))
+
+    def test_bytes_spread_over_time(self):
+        rate = 1024 * 1024
+        bucket = TokenBucket(rate)
+        # Without the initial burst
+        bucket.consume(rate)
+        data = os.urandom(rate / 2)
+        body = ThrottledBody(data, bucket.consume)
+        self.assertEqual(len(body), len(data))
+        sent = self._send(body)
+        self.assertEqual(sent[-1][1], len(data))
+        self.assertTrue(sent[-1][0] >= 0.45)
+        # The bytes are sent as the tokens are available, never more than
+        # the ones available (plus the chunk being sent)...
+        for elapsed, total in sent:
+            self.assertTrue(total <= (elapsed + 0.05) * rate + UPLOAD_CHUNK_SIZE,
+                            (elapsed, total))
+        # ...instead of waiting for the whole body and sending it in a burst
+        self.assertTrue(sent[0][0] < 0.2)
+        self.assertTrue(len([total for elapsed, total in sent if elapsed < 0.25]) > 0)
+        self.assertTrue(len([total for elapsed, total in sent if elapsed < 0.25]) < len(sent))
+
+        body = ThrottledBody(data, bucket.consume)
+        self.assertEqual(body.read(10) + body.read(), data)
+
+        # The progress is reported as the blocks are read
+        reported = []
+        body = ThrottledBody(data, lambda size: None, progress=reported.append)
+        self._send(body)
+        self.assertEqual(reported, [8192] * (len(data) / 8192))
+
+    def test_rate_changed_while_sending(self):
+        bucket = TokenBucket(64 * 1024)
+        bucket.consume(64 * 1024)
+        # 64 seconds at the initial rate
+        body = ThrottledBody(os.urandom(4 * MEGABYTE), bucket.consume)
+        timer = threading.Timer(0.3, bucket.set_rate, (0,))
+        timer.start()
+        try:
+            start_time = time.time()
+            sent = self._send(body)
+            self.assertEqual(sent[-1][1], 4 * MEGABYTE)
+            self.assertTrue(time.time() - start_time < 3)
+        finally:
+            timer.cancel()
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+
+    def test_aimd(self):
+        concurrency = AdaptiveConcurrency(2, 1, 4, interval=0)
+        # All the processes running and uploads waiting: additive increase
+        concurrency.add_sample(1024 * 1024, 0)
+        self.assertEqual(concurrency.update(running=2, waiting=5), 3)
+        # The increase didn't improve the throughput: back off
+        self.assertEqual(concurrency.update(running=3, waiting=5), 2)
+        concurrency.add_sample(1024 * 1024, 0)
+        self.assertEqual(concurrency.update(running=2, waiting=5), 3)
+        # Errors: multiplicative decrease
+        concurrency.add_sample(0, 1)
+        self.assertEqual(concurrency.update(running=3, waiting=5), 1)
+        # Nothing waiting: keep
+        self.assertEqual(concurrency.update(running=1, waiting=0), 1)
+        status = concurrency.get_status()
+        self.assertEqual([item['action'] for item in status['history']],
+                         [INCREASE, BACK_OFF, INCREASE, DECREASE, KEEP])
+        self.assertEqual((status['limit'], status['min'], status['max']), (1, 1, 4))
+
+    def test_bounds(self):
+        concurrency = AdaptiveConcurrency(4, 2, 4, interval=0)
+        concurrency.add_sample(1024, 0)
+        self.assertEqual(concurrency.update(running=4, waiting=5), 4)
+        concurrency.add_sample(0, 3)
+        self.assertEqual(concurrency.update(running=4, waiting=5), 2)
+        concurrency.add_sample(0, 3)
+        self.assertEqual(concurrency.update(running=2, waiting=5), 2)
+
+
+class UploadWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for filename in ('file.txt', 'file.jpg'):
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                f.write('x')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _run_worker(self, messages, max_jobs):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        for msg in messages:
+            parent_conn.send(msg)
+        upload_worker(child_conn, max_jobs=max_jobs)
+        # The worker closes its end when exits
+        received = []
+        while True:
+            try:
+                received.append(parent_conn.recv())
+            except EOFError:
+                return received
+
+    def _get_scanned_files(self, received):
+        return [[filename for filename, _ in item[1]] for item in received
+                if isinstance(item, tuple) and item[0] == SCAN_RESULT]
+
+    def test_jobs_until_exit(self):
+        job = {'action': SCAN_DIRECTORY, 'directory': self.directory}
+        # A 'STOP' received while idle is ignored
+        received = self._run_worker([job, 'STOP', job, WORKER_EXIT], max_jobs=10)
+        self.assertEqual([item for item in received if not isinstance(item, tuple)],
+                         [PROCESS_STARTED, PROCESS_FINISH_OK] * 2)
+        self.assertEqual(self._get_scanned_files(received), [['file.jpg']] * 2)
+        # The stats are sent as `os.stat_result` (the ones of `scandir` can't be pickled)
+        stats = os.stat(os.path.join(self.directory, 'file.jpg'))
+        for item in received:
+            if isinstance(item, tuple) and item[0] == SCAN_RESULT:
+                self.assertEqual(type(item[1][0][1].stats), os.stat_result)
+                self.assertEqual(item[1][0][1].stats.st_mtime, stats.st_mtime)
+
+    def test_progress_while_uploading(self):
+        class SlowGlacier(object):
+            def upload_file(self, directory, filename, description=None, progress=None):
+                progress(400)
+                time.sleep(0.6)
+                progress(400)
+                # Retried
+                progress(400)
+                return GlacierData()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        file_stats = FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 1000, 0, 0, 0)))
+        _upload_file(child_conn, self.directory, 'file.jpg', file_stats, SlowGlacier(),
+            logging.getLogger('test'))
+        received = [item for item in self._receive(parent_conn) if isinstance(item, tuple)]
+        self.assertEqual([item[0] for item in received],
+                         [PROCESS_PROGRESS, UPLOAD_RESULT, PROCESS_PROGRESS])
+        # Reported before the end of the upload, and never more than the size of the file
+        self.assertEqual(received[0][1:], (800, 0))
+        self.assertEqual(received[2][1:], (200, 0))
+
+    def _receive(self, parent_conn):
+        received = []
+        while parent_conn.poll():
+            received.append(parent_conn.recv())
+        return received
+
+    def test_upload_progress(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        upload_progress = UploadProgress(child_conn, 100, interval=0)
+        upload_progress.progress(30)
+        upload_progress.progress(50)
+        upload_progress.progress(50)
+        upload_progress.finish()
+        self.assertEqual(self._receive(parent_conn), [(PROCESS_PROGRESS, 30, 0),
+            (PROCESS_PROGRESS, 50, 0), (PROCESS_PROGRESS, 20, 0)])
+
+        upload_progress = UploadProgress(child_conn, 100, interval=60)
+        upload_progress.progress(30)
+        upload_progress.finish()
+        self.assertEqual(self._receive(parent_conn), [(PROCESS_PROGRESS, 100, 0)])
+
+    def test_recycle_after_max_jobs(self):
+        job = {'action': SCAN_DIRECTORY, 'directory': self.directory, 'files': ['file.txt']}
+        received = self._run_worker([job, job], max_jobs=2)
+        self.assertEqual(self._get_scanned_files(received), [[]] * 2)
+
+    def test_exit_when_controller_exits(self):
+        controller = ProcessController()
+        workers = []
+        for _ in range(2):
+            controller._start_worker(workers)
+        try:
+            # The controller died: the workers must not keep its ends open
+            for worker in workers:
+                worker['parent_conn'].close()
+            for worker in workers:
+                worker['p'].join(5)
+                self.assertFalse(worker['p'].is_alive())
+        finally:
+            for worker in workers:
+                if worker['p'].is_alive():
+                    worker['p'].terminate()
+
+    def test_exited_worker_replaced_without_waiting(self):
+        directories = []
+        for dirname in ('dir1', 'dir2'):
+            directories.append(os.path.join(self.directory, dirname))
+            os.mkdir(directories[-1])
+            with open(os.path.join(directories[-1], 'file.txt'), 'w') as f:
+                f.write('x')
+        controller = ProcessController()
+        controller.journal = JobJournal('')
+        # The worker exits after its job, without starting the next one: the controller
+        # must start a new worker when it detects the end (not when `select()` times out)
+        controller.worker_max_jobs = 1
+        controller.concurrent_uploads = 1
+        controller.concurrency = AdaptiveConcurrency(1, 1, 1, 60)
+        controller.start()
+        subscription = controller.subscribe_events()
+        try:
+            start = time.time()
+            for directory in directories:
+                self.assertTrue(controller.launch_backup(directory)['ok'])
+            finished = []
+            while len(finished) < len(directories):
+                event = subscription.get(10)
+                if event['type'] == EVENT_DIRECTORY_FINISHED:
+                    finished.append(event['directory'])
+            self.assertEqual(finished, directories)
+            self.assertLess(time.time() - start, 10)
+        finally:
+            controller.parent_conn.close()
+            controller.process_controller.join(5)
+
+
+class FileJobsSchedulerTest(unittest.TestCase):
+
+    def _get_file_stats(self, size):
+        return FileStats(os.stat_result((0, 0, 0, 0, 0, 0, size, 0, 0, 0)))
+
+    def test_directories_are_expanded_in_file_jobs(self):
+        controller = ProcessController()
+        for directory in ('/dir1', '/dir2'):
+            controller._handle_message([], {'action': LAUNCH_BACKUP, 'directory': directory})
+        self.assertFalse(controller._handle_message([],
+            {'action': LAUNCH_BACKUP, 'directory': '/dir1'})['ok'])
+
+        workers = [{'job': controller.pending_uploads.pop()} for _ in range(2)]
+        for worker, count in zip(workers, (3, 1)):
+            files = [('file{}'.format(num), self._get_file_stats(1024)) for num in range(count)]
+            for received in (PROCESS_STARTED, (SCAN_RESULT, files, []), PROCESS_FINISH_OK):
+                controller._handle_worker_message(worker, received)
+        # The files of both directories can be uploaded by any worker
+        self.assertEqual(sorted([(job['directory'], job['filename']) for job in
+                                 controller.pending_uploads]), [('/dir1', 'file0'),
+                         ('/dir1', 'file1'), ('/dir1', 'file2'), ('/dir2', 'file0')])
+
+        for worker in workers:
+            worker['job'] = controller.pending_uploads.pop()
+            for received in (PROCESS_STARTED, (UPLOAD_RESULT, None),
+                             (PROCESS_PROGRESS, 1024, 0), PROCESS_FINISH_OK):
+                controller._handle_worker_message(worker, received)
+        status = controller._handle_message([], {'action': GET_STATUS})
+        self.assertEqual([(item['directory'], item['files_done'], item['files_total'],
+                           item['bytes_done'], item['jobs']) for item in status['directories']],
+                         [('/dir1', 2, 3, 2048, 1), ('/dir2', 0, 1, 0, 1)])
+
+        # Cancel the waiting jobs: the directories are done
+        controller._handle_message([], {'action': STOP_ALL_PROCESSES})
+        self.assertEqual(len(controller.pending_uploads), 0)
+        self.assertEqual(len(controller.directories), 0)
+
+    def test_failed_metadata_doesnt_block_the_others(self):
+
+        class _LocalMetadata(object):
+            written = []
+
+            def update_metadata(self, directory, filename, file_stats, glacier_data):
+                if filename == 'bad':
+                    raise IOError("Can't write")
+                self.written.append(filename)
+
+            def close(self):
+                pass
+
+        controller = ProcessController()
+        controller.local_metadata = _LocalMetadata()
+        file_stats = self._get_file_stats(1024)
+        controller.pending_metadata = [('/dir1', filename, file_stats, GlacierData())
+                                       for filename in ('bad', 'file1', 'file2')]
+        controller._flush_metadata()
+        self.assertEqual(controller.local_metadata.written, ['file1', 'file2'])
+        self.assertEqual([item[1] for item in controller.pending_metadata], ['bad'])
+        # Retried, until it fails permanently
+        for _ in range(METADATA_MAX_ATTEMPTS - 1):
+            controller._flush_metadata()
+        self.assertEqual(controller.pending_metadata, [])
+        self.assertEqual(controller.metadata_failures, {})
+
+    def test_metadata_of_file_removed_after_upload(self):
+        directory = tempfile.mkdtemp(prefix='frockup-test-')
+        try:
+            local_metadata = LocalMetadata(Context())
+            glacier_data = GlacierData()
+            glacier_data.archive_id = 'archive-1'
+            local_metadata.update_metadata(directory, 'removed.txt',
+                self._get_file_stats(1024), glacier_data)
+            self.assertEqual(local_metadata.get_file_data(directory, 'removed.txt')
+                             ['archive_id'], 'archive-1')
+            local_metadata.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class JobJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'jobs.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        file_stats = FileStats(os.stat(self.directory))
+        glacier_data = GlacierData()
+        glacier_data.archive_id = 'archive-1'
+        journal = JobJournal(self.filename)
+        self.assertEqual(journal.open(), [])
+        journal.add_queued('/dir1')
+        journal.add_scanned('/dir1', [('file1', file_stats), ('file2', file_stats),
+                                      ('file3', file_stats)])
+        journal.add_started('/dir1', 'file1')
+        journal.add_uploaded('/dir1', 'file1', glacier_data)
+        journal.add_failed('/dir1', 'file2')
+        journal.add_queued('/dir2', ['file4'])
+        journal.add_queued('/dir3')
+        journal.add_finished('/dir3')
+        journal.close()
+        # Crash while writing
+        with open(self.filename, 'a') as f:
+            f.write('{"event": "upl')
+
+        states = JobJournal(self.filename).open()
+        self.assertEqual([state['directory'] for state in states], ['/dir1', '/dir2'])
+        self.assertEqual(states[0]['scanned'][2][1].stats.st_mtime, file_stats.stats.st_mtime)
+        self.assertEqual(states[0]['uploaded']['file1'].archive_id, 'archive-1')
+        self.assertEqual(states[0]['failed'], set(['file2']))
+        self.assertEqual((states[1]['scanned'], states[1]['files']), (None, ['file4']))
+        self.assertTrue(isinstance(states[0]['scanned'][0][0], str))
+
+        # The controller re-scans only the directory not scanned, and uploads only
+        # the files not uploaded
+        states[0]['uploaded']['file1'] = None
+        controller = ProcessController()
+        controller._resume_jobs(states)
+        jobs = [controller.pending_uploads.pop() for _ in range(2)]
+        self.assertEqual([(job['action'], job['directory'], job.get('filename')) for job in jobs],
+                         [(UPLOAD_FILE, '/dir1', 'file3'), (SCAN_DIRECTORY, '/dir2', None)])
+        self.assertEqual(len(controller.pending_uploads), 0)
+        self.assertEqual([(item['files_done'], item['errors'], item['files_total'])
+                          for item in controller.directories.values()], [(1, 1, 3), (0, 0, 0)])
+
+    def test_names_not_utf8(self):
+        file_stats = FileStats(os.stat(self.directory))
+        glacier_data = GlacierData()
+        glacier_data.archive_id = 'archive-1'
+        journal = JobJournal(self.filename)
+        journal.open()
+        journal.add_queued('/dir\xe1', ['\xff.jpg', 'caf\xc3\xa9.jpg'])
+        journal.add_scanned('/dir\xe1', [('\xff.jpg', file_stats),
+                                          ('caf\xc3\xa9.jpg', file_stats)])
+        journal.add_started('/dir\xe1', '\xff.jpg')
+        journal.add_uploaded('/dir\xe1', '\xff.jpg', glacier_data)
+        journal.add_failed('/dir\xe1', 'caf\xc3\xa9.jpg')
+        journal.close()
+
+        states = JobJournal(self.filename).open()
+        self.assertEqual(states[0]['directory'], '/dir\xe1')
+        self.assertEqual(states[0]['files'], ['\xff.jpg', 'caf\xc3\xa9.jpg'])
+        self.assertEqual([filename for filename, _ in states[0]['scanned']],
+                         ['\xff.jpg', 'caf\xc3\xa9.jpg'])
+        self.assertEqual(states[0]['uploaded']['\xff.jpg'].archive_id, 'archive-1')
+        self.assertEqual(states[0]['failed'], set(['caf\xc3\xa9.jpg']))
+
+    def test_finished_once_metadata_is_written(self):
+
+        class _LocalMetadata(object):
+            fail = True
+
+            def update_metadata(self, directory, filename, file_stats, glacier_data):
+                if self.fail:
+                    raise IOError("Database locked")
+
+            def close(self):
+                pass
+
+        glacier_data = GlacierData()
+        glacier_data.archive_id = 'archive-1'
+        controller = ProcessController()
+        controller.journal = JobJournal(self.filename)
+        controller.local_metadata = _LocalMetadata()
+        controller._resume_jobs(controller.journal.open())
+        controller._handle_message([], {'action': LAUNCH_BACKUP, 'directory': '/dir1'})
+        worker = {'job': controller.pending_uploads.pop()}
+        for received in (PROCESS_STARTED, (SCAN_RESULT, [('file1', FileStats(
+                os.stat(self.directory)))], []), PROCESS_FINISH_OK):
+            controller._handle_worker_message(worker, received)
+        worker = {'job': controller.pending_uploads.pop()}
+        for received in (PROCESS_STARTED, (UPLOAD_RESULT, glacier_data), PROCESS_FINISH_OK):
+            controller._handle_worker_message(worker, received)
+        controller._flush_metadata()
+        self.assertEqual(controller.directories, {})
+        # The metadata wasn't written: the upload is replayed after a restart
+        states = JobJournal(self.filename).replay()
+        self.assertEqual(states[0]['uploaded']['file1'].archive_id, 'archive-1')
+        controller.local_metadata.fail = False
+        controller._flush_metadata()
+        self.assertEqual(JobJournal(self.filename).replay(), [])
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        controller.journal.close()
+
+
+class DirectoryScanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'subdir'))
+        for filename in ('a.jpg', 'b.txt', 'subdir/c.jpg'):
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                f.write('x')
+        _generate_local_metadata_db(self.directory, [])
+        ctx = Context()
+        ctx.set_include_extensions(('jpg',))
+        self.scan_cache = DirectoryScanCache(ctx, CompiledFileFilter(ctx), LocalMetadata(ctx))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_counts(self):
+        result = self.scan_cache.scan(self.directory)
+        return (result['ignored_count'], result['updated_count'], result['pending_count'])
+
+    def test_unchanged_directories_are_not_scanned(self):
+        result = self.scan_cache.scan(self.directory)
+        self.assertEqual(result['subdirectories'], [os.path.join(self.directory, 'subdir')])
+        self.assertEqual((result['files_count'], result['pending_bytes']), (3, 1))
+        self.assertEqual(self._get_counts(), (2, 0, 1))
+        self.assertEqual((self.scan_cache.hits, self.scan_cache.misses), (1, 1))
+
+        # The metadata was updated
+        _generate_local_metadata_db(self.directory, ['a.jpg'], overwrite=True)
+        self.assertEqual(self._get_counts(), (2, 1, 0))
+        self.assertEqual(self.scan_cache.misses, 2)
+
+        # A file was added
+        with open(os.path.join(self.directory, 'd.jpg'), 'w') as f:
+            f.write('x')
+        self.assertEqual(self._get_counts(), (2, 1, 1))
+        self.scan_cache.invalidate(self.directory)
+        self.assertEqual(self._get_counts(), (2, 1, 1))
+        self.assertEqual((self.scan_cache.hits, self.scan_cache.misses), (1, 4))
+
+
+class ScanJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for subdir in ('a', 'a/b', 'a/b/c', 'd', 'e'):
+            os.mkdir(os.path.join(self.directory, subdir))
+            with open(os.path.join(self.directory, subdir, 'file.jpg'), 'w') as f:
+                f.write('x')
+            _generate_local_metadata_db(os.path.join(self.directory, subdir), [])
+        _generate_local_metadata_db(self.directory, [])
+        self.ctx = Context()
+        self.ctx.set_include_extensions(('jpg',))
+        self.scan_cache = DirectoryScanCache(self.ctx, CompiledFileFilter(self.ctx),
+            LocalMetadata(self.ctx))
+        self.pool = create_scan_pool(self.ctx, 2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.directory)
+
+    def test_pages(self):
+        job = ScanJob(self.directory, self.scan_cache, self.pool, max_buffered=2).start()
+        directories, finished = job.get_page(max_results=1, timeout=10)
+        self.assertEqual((len(directories), finished), (1, False))
+        self.assertFalse('subdirectories' in directories[0])
+        directories.extend(job.get_all())
+        self.assertEqual(len(directories), 6)
+        self.assertEqual(sum([item['pending_count'] for item in directories]), 5)
+
+        # The second time, all the results come from the cache
+        job = ScanJob(self.directory, self.scan_cache, self.pool).start()
+        self.assertEqual(sorted([item['name'] for item in job.get_all()]),
+                         sorted([item['name'] for item in directories]))
+        self.assertEqual((self.scan_cache.hits, self.scan_cache.misses), (6, 6))
+
+    def test_cancel_while_scanning(self):
+        class StuckPool(object):
+            # The scans are never finished
+            def apply_async(self, func, args, callback=None):
+                pass
+        job = ScanJob(self.directory, self.scan_cache, StuckPool()).start()
+        time.sleep(0.2)
+        self.assertFalse(job.finished)
+        job.cancel()
+        job.thread.join(5)
+        self.assertTrue(job.finished)
+        self.assertEqual(job.get_page(timeout=0), ([], True))
+
+
+class EventBroadcasterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events_conn, self.child_events_conn = multiprocessing.Pipe(duplex=False)
+
+    def test_events_are_sent_to_all_the_subscribers(self):
+        broadcaster = EventBroadcaster(self.events_conn, max_queued=2).start()
+        subscriptions = [broadcaster.subscribe() for _ in range(2)]
+        self.child_events_conn.send({'type': 'progress'})
+        self.assertEqual([item.get(1.0) for item in subscriptions], [{'type': 'progress'}] * 2)
+        # A subscriber that falls behind is disconnected
+        for num in range(3):
+            self.child_events_conn.send({'type': 'progress', 'num': num})
+            self.assertEqual(subscriptions[1].get(1.0)['num'], num)
+        self.assertEqual(subscriptions[0].get(1.0)['num'], 0)
+        self.assertEqual(subscriptions[0].get(1.0)['num'], 1)
+        self.assertEqual(subscriptions[0].get(1.0), None)
+        self.assertEqual(broadcaster.subscriptions, [subscriptions[1]])
+        # The controller exited
+        self.child_events_conn.close()
+        broadcaster.thread.join(1.0)
+        self.assertTrue(subscriptions[1].closed)
+
+    def test_controller_emits_status_changes(self):
+        controller = ProcessController()
+        controller.events_conn = self.child_events_conn
+        controller._handle_message([], {'action': LAUNCH_BACKUP, 'directory': '/dir1'})
+        worker = {'p': multiprocessing.current_process(), 'status': None,
+                  'job': controller.pending_uploads.pop()}
+        for received in (PROCESS_STARTED, (SCAN_RESULT, [], []), PROCESS_FINISH_WITH_ERROR):
+            controller._handle_worker_message(worker, received)
+        events = []
+        while self.events_conn.poll():
+            events.append(self.events_conn.recv())
+        self.assertEqual([(event['type'], event['pid']) for event in events], [
+            ('directory_queued', -1), ('job_started', os.getpid()), ('progress', -1),
+            ('job_error', os.getpid()), ('directory_finished', -1)])
+        self.assertEqual(events[-1]['progress']['errors'], 1)
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def _fill_queue(self, queue):
+        queue.append({'directory': '/dir1', 'filename': 'medium',
+            'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 50, 0, 0, 0)))})
+        queue.append({'directory': '/dir1', 'filename': 'big',
+            'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 900, 0, 0, 0)))})
+        queue.append({'directory': '/dir1', 'filename': 'small',
+            'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 1, 0, 0, 0)))})
+        queue.append({'directory': '/dir2', 'filename': 'other',
+            'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 10, 0, 0, 0)))})
+        # Scans of directories go first (except with FIFO)
+        queue.append({'directory': '/dir3'})
+
+    def _pop_all(self, queue, large=False):
+        jobs = []
+        while True:
+            job = queue.pop(large)
+            if job is None:
+                return jobs
+            jobs.append(job.get('filename', job['directory']))
+
+    def test_policies(self):
+        for policy, expected in (
+                (FIFO, ['medium', 'big', 'small', 'other', '/dir3']),
+                (SHORTEST_FIRST, ['/dir3', 'small', 'other', 'medium', 'big']),
+                (LARGEST_FIRST, ['/dir3', 'big', 'medium', 'other', 'small']),
+                (FAIR_SHARE, ['/dir3', 'medium', 'other', 'big', 'small'])):
+            queue = JobQueue(policy)
+            self._fill_queue(queue)
+            self.assertEqual(len(queue), 5)
+            self.assertEqual(self._pop_all(queue), expected, policy)
+
+    def test_fair_share_round_robin(self):
+        queue = JobQueue(FAIR_SHARE)
+        for filename in ('a1', 'a2', 'a3', 'a4', 'a5', 'a6'):
+            queue.append({'directory': '/dirA', 'filename': filename,
+                'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 10, 0, 0, 0)))})
+        self.assertEqual([queue.pop()['filename'] for _ in range(3)], ['a1', 'a2', 'a3'])
+        # A directory added later takes turns with the others (it doesn't take
+        # all the turns until catching up the jobs taken by the others)
+        for filename in ('b1', 'b2', 'b3'):
+            queue.append({'directory': '/dirB', 'filename': filename,
+                'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 10, 0, 0, 0)))})
+        queue.append({'directory': '/dirC', 'filename': 'c1',
+            'file_stats': FileStats(os.stat_result((0, 0, 0, 0, 0, 0, 10, 0, 0, 0)))})
+        self.assertEqual(self._pop_all(queue), ['a4', 'b1', 'c1', 'a5', 'b2', 'a6', 'b3'])
+
+    def test_large_file_lane(self):
+        queue = JobQueue(FIFO)
+        self._fill_queue(queue)
+        queue.append_first({'directory': '/dir4'})
+        # The waiting jobs are re-ordered
+        queue.configure(SHORTEST_FIRST, 50)
+        self.assertEqual((queue.count(), queue.count(large=True)), (4, 2))
+        self.assertEqual(self._pop_all(queue, large=True), ['medium', 'big'])
+        self.assertEqual(self._pop_all(queue), ['/dir4', '/dir3', 'small', 'other'])
+
+
 class FileFilterTest(unittest.TestCase):
 
     def test_include(self):
         ctx = Context()
         ctx.set_include_extensions(('jpg', 'png'))  # Only include JPGs
-        file_filter = FileFilter(ctx)
-        INCLUDED = ('x.jpg', 'X.JPG', 'z.PNG')
-        EXCLUDED = ('x.zip', 'X.ZIP', 'xjpg', 'XJPG', '.algojpg',
-                    '.frockup', '.frockup-yadayadayada')
-        for filename in INCLUDED:
-            self.assertTrue(file_filter.include_file('/', filename),
-                            "File {} should be included".format(filename))
-        for filename in EXCLUDED:
-            self.assertFalse(file_filter.include_file('/', filename),
-                            "File {} should be excluded".format(filename))
+        for file_filter in (FileFilter(ctx), CompiledFileFilter(ctx)):
+            INCLUDED = ('x.jpg', 'X.JPG', 'z.PNG')
+            EXCLUDED = ('x.zip', 'X.ZIP', 'xjpg', 'XJPG', '.algojpg',
+                        '.frockup', '.frockup-yadayadayada')
+            for filename in INCLUDED:
+                self.assertTrue(file_filter.include_file('/', filename),
+                                "File {} should be included".format(filename))
+            for filename in EXCLUDED:
+                self.assertFalse(file_filter.include_file('/', filename),
+                                "File {} should be excluded".format(filename))
 
     def test_exclude(self):
         ctx = Context()
         ctx.set_exclude_extensions(('jpg', 'png'))  # Include all, exclude JPGs
-        file_filter = FileFilter(ctx)
-        EXCLUDED = ('x.jpg', 'X.JPG', 'z.PNG', '.algojpg', '.frockup', '.frockup-yadayadayada')
-        INCLUDED = ('x.zip', 'X.ZIP', 'xjpg', 'XJPG')
-        for filename in INCLUDED:
-            self.assertTrue(file_filter.include_file('/', filename),
-                            "File {} should be included".format(filename))
-        for filename in EXCLUDED:
-            self.assertFalse(file_filter.include_file('/', filename),
-                            "File {} should be excluded".format(filename))
+        for file_filter in (FileFilter(ctx), CompiledFileFilter(ctx)):
+            EXCLUDED = ('x.jpg', 'X.JPG', 'z.PNG', '.algojpg', '.frockup',
+                        '.frockup-yadayadayada')
+            INCLUDED = ('x.zip', 'X.ZIP', 'xjpg', 'XJPG')
+            for filename in INCLUDED:
+                self.assertTrue(file_filter.include_file('/', filename),
+                                "File {} should be included".format(filename))
+            for filename in EXCLUDED:
+                self.assertFalse(file_filter.include_file('/', filename),
+                                "File {} should be excluded".format(filename))
+
+    def test_compiled_rules(self):
+        ctx = Context()
+        ctx.set_include_globs(('IMG_*', '*.raw'))
+        ctx.set_exclude_globs(('*.tmp',))
+        ctx.set_exclude_regexes((r'_backup\b',))
+        ctx.set_prune_directories(('.thumbnails', 'cache*'))
+        ctx.min_size = 10
+        ctx.max_age = 3600
+        file_filter = CompiledFileFilter(ctx)
+        for filename in ('IMG_1.jpg', 'x.raw', 'IMG_2'):
+            self.assertTrue(file_filter.include_file('/', filename), filename)
+        for filename in ('x.jpg', 'IMG_1.tmp', 'IMG_1_backup.jpg', '.IMG_1'):
+            self.assertFalse(file_filter.include_file('/', filename), filename)
+
+        self.assertTrue(file_filter.has_stats_rules)
+        now = time.time()
+        self.assertTrue(file_filter.include_stats('/', 'x', os.stat_result(
+            (0, 0, 0, 0, 0, 0, 10, now, now, now))))
+        self.assertFalse(file_filter.include_stats('/', 'x', os.stat_result(
+            (0, 0, 0, 0, 0, 0, 9, now, now, now))))
+        self.assertFalse(file_filter.include_stats('/', 'x', os.stat_result(
+            (0, 0, 0, 0, 0, 0, 10, now, now - 7200, now))))
+
+        self.assertTrue(file_filter.prune_directory('/', '.thumbnails'))
+        self.assertTrue(file_filter.prune_directory('/', 'cache-1'))
+        self.assertFalse(file_filter.prune_directory('/', 'photos'))
+
+
+
+class WalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='frockup-test-')
+        for dirname in ('a/b/c', 'a/cache/x', 'd'):
+            os.makedirs(os.path.join(self.root, dirname))
+        for filename in ('f0', 'a/f1', 'a/b/f2', 'a/b/c/f3', 'a/cache/x/f4', 'd/f5'):
+            with open(os.path.join(self.root, filename), 'w') as a_file:
+                a_file.write(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _walk(self, **kwargs):
+        return dict([(os.path.relpath(directory, self.root), sorted([e.name for e in entries]))
+                     for directory, entries in walk_parallel(self.root, **kwargs)])
+
+    def test_walk(self):
+        self.assertDictEqual(self._walk(), {'.': ['f0'], 'a': ['f1'], 'a/b': ['f2'],
+            'a/b/c': ['f3'], 'a/cache': [], 'a/cache/x': ['f4'], 'd': ['f5']})
+
+    def test_max_depth_and_prune(self):
+        walked = self._walk(max_depth=1, prune=lambda directory, name: name == 'cache')
+        self.assertEqual(sorted(walked.keys()), ['.', 'a', 'd'])
+        walked = self._walk(prune=lambda directory, name: name == 'cache')
+        self.assertEqual(sorted(walked.keys()), ['.', 'a', 'a/b', 'a/b/c', 'd'])
+
+
+class ChangeTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='frockup-test-')
+        self.tmp_dir = tempfile.mkdtemp(prefix='frockup-test-')
+        for dirname in ('a', 'b'):
+            os.mkdir(os.path.join(self.root, dirname))
+        for filename in ('f0', 'a/f1', 'b/f2'):
+            with open(os.path.join(self.root, filename), 'w') as a_file:
+                a_file.write('x' * 2048)
+        self.index_filename = os.path.join(self.tmp_dir, 'changes.sqlite')
+        self.index = ChangeIndex(self.index_filename)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.tmp_dir)
+
+    def _start_watching(self):
+        self.index.start_watching(self.root, os.getpid())
+        self.index.set_watching_since(self.root, time.time())
+
+    def test_dirty_set_used_after_complete_pass(self):
+        dir_a, dir_b = os.path.join(self.root, 'a'), os.path.join(self.root, 'b')
+        self.assertIsNone(self.index.get_dirty(self.root, 'tree'))
+        self._start_watching()
+        # Not completely backed up since it's watched
+        self.assertIsNone(self.index.get_dirty(self.root, 'tree'))
+        self.index.set_pass(self.root, 'tree', time.time())
+        self.assertIsNone(self.index.get_dirty(self.root, 'other options'))
+        self.index.add_dirty([(dir_a, 'f1'), (dir_b, 'f2'), (dir_b, WHOLE_DIRECTORY),
+                              (self.root + '-other', 'f3')])
+        dirty, max_seq = self.index.get_dirty(self.root, 'tree')
+        self.assertEqual(dirty, {dir_a: set(['f1']), dir_b: None})
+        # Changed again while being backed up: kept
+        self.index.add_dirty([(dir_a, 'f1')])
+        self.index.clear([dir_a, dir_b], max_seq)
+        self.assertEqual(self.index.get_dirty(self.root, 'tree')[0], {dir_a: set(['f1'])})
+        # Events lost: a new complete backup is needed
+        self.index.set_watching_since(self.root, time.time() + 1)
+        self.assertIsNone(self.index.get_dirty(self.root, 'tree'))
+
+    def _backup(self):
+        ctx = Context()
+        ctx.track_changes = True
+        ctx.recursive = True
+        ctx.min_age = None
+        if not ctx.config.has_section('changes'):
+            ctx.config.add_section('changes')
+        ctx.config.set('changes', 'index', self.index_filename)
+        main = Main(ctx=ctx, glacier=GlacierMock)
+        main.process(self.root)
+        main.close()
+        return ctx.scanned_files, ctx.included_count
+
+    def test_main_checks_only_dirty_files(self):
+        self._start_watching()
+        self.assertEqual(self._backup(), (3, 3))
+        # Changed in place (the mtime of the directory doesn't change)
+        with open(os.path.join(self.root, 'b', 'f2'), 'a') as a_file:
+            a_file.write('x')
+        self.index.add_dirty([(os.path.join(self.root, 'b'), 'f2')])
+        self.assertEqual(self._backup(), (1, 1))
+        self.assertEqual(self._backup(), (0, 0))
+
+    def test_watcher_records_changes(self):
+        try:
+            Inotify().close()
+        except OSError:
+            self.skipTest("inotify isn't available")
+        watcher = ChangeWatcher(self.index, [self.root], batch_seconds=0.1)
+        watcher.start()
+        try:
+            with open(os.path.join(self.root, 'a', 'f1'), 'a') as a_file:
+                a_file.write('x')
+            os.mkdir(os.path.join(self.root, 'c'))
+            for _ in range(5):
+                for wd, mask, _, name in watcher.inotify.read_events(0.1):
+                    watcher.handle_event(wd, mask, name)
+            watcher.flush()
+            self.index.set_pass(self.root, 'tree', 0)
+            self.assertIsNone(self.index.get_dirty(self.root, 'tree'))
+            self.index.set_pass(self.root, 'tree', time.time())
+            self.assertEqual(self.index.get_dirty(self.root, 'tree')[0], {
+                os.path.join(self.root, 'a'): set(['f1']), os.path.join(self.root, 'c'): None})
+        finally:
+            watcher.close()
+        # Not watched anymore
+        self.assertIsNone(self.index.get_dirty(self.root, 'tree'))
 
+    def test_untracked_root_kept_after_overflow(self):
+        other_root = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_root)
+        watcher = ChangeWatcher(self.index, [self.root, other_root])
+        for root in (self.root, other_root):
+            self.index.start_watching(root, os.getpid())
+            self.index.set_watching_since(root, time.time())
+        watcher._untrack(os.path.join(self.root, 'a'), "the limit of inotify watches was reached")
+        watcher.handle_event(0, IN_Q_OVERFLOW, '')
+        self.assertIsNone(self.index._get_watching_since(self.root))
+        self.assertIsNotNone(self.index._get_watching_since(other_root))
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
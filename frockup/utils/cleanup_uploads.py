@@ -0,0 +1,23 @@
+import sys
+import logging
+
+from frockup.common import Context
+from frockup.glacier import Glacier, DEFAULT_ABANDONED_UPLOAD_DAYS
+
+
+def main():
+    """
+    Aborts the abandoned multipart uploads of the vault (see `Glacier.cleanup_uploads()`).
+    The max. age of the uploads, in days, can be passed as the first argument.
+    """
+    logging.basicConfig(level=logging.INFO)
+    max_age_days = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ABANDONED_UPLOAD_DAYS
+    glacier = Glacier(Context())
+    try:
+        aborted = glacier.cleanup_uploads(max_age_days * 24 * 60 * 60)
+        print "{0} abandoned upload(s) aborted".format(aborted)
+    finally:
+        glacier.close()
+
+if __name__ == '__main__':
+    main()
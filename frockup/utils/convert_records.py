@@ -0,0 +1,46 @@
+import gdbm
+import sys
+import os
+
+from frockup.metadata_record import encode_record, decode_record, FORMAT_BINARY, \
+    FORMAT_JSON
+
+
+def convert_database(filename, record_format):
+    """Re-encodes all the records of the database. Returns the number of converted records"""
+    database = gdbm.open(filename, 'w')
+    try:
+        count = 0
+        key = database.firstkey()
+        while key is not None:
+            raw_data = database[key]
+            new_raw_data = encode_record(decode_record(raw_data), record_format)
+            if new_raw_data != raw_data:
+                database[key] = new_raw_data
+                count += 1
+            key = database.nextkey(key)
+        database.reorganize()
+        return count
+    finally:
+        database.close()
+
+
+def main():
+    """
+    Converts the records of all the '.frockup.gdbm' databases found in a tree
+    to the binary format (or to JSON, if 'json' is passed as the second argument)
+    """
+    directory = sys.argv[1]
+    assert os.path.exists(directory)
+    assert os.path.isdir(directory)
+    record_format = sys.argv[2] if len(sys.argv) > 2 else FORMAT_BINARY
+    assert record_format in (FORMAT_BINARY, FORMAT_JSON)
+
+    for root, _, files in os.walk(os.path.abspath(directory)):
+        if '.frockup.gdbm' in files:
+            print " - Converting:", root
+            count = convert_database(os.path.join(root, '.frockup.gdbm'), record_format)
+            print "   {0} records converted".format(count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import ConfigParser
+import random
+import sys
+import timeit
+
+from frockup.common import Context
+from frockup.file_filter import FileFilter, CompiledFileFilter
+
+EXTENSIONS = ('jpg', 'JPG', 'png', 'avi', 'MOV', 'xcf', 'txt', 'tar.gz', '')
+
+
+def _generate_filenames(count):
+    filenames = []
+    for num in xrange(count):
+        extension = random.choice(EXTENSIONS)
+        prefix = '.' if num % 20 == 0 else ''
+        if extension:
+            filenames.append('{0}IMG_{1:06d}.{2}'.format(prefix, num, extension))
+        else:
+            filenames.append('{0}IMG_{1:06d}'.format(prefix, num))
+    return filenames
+
+
+def main():
+    """
+    Compares the time spent by FileFilter and CompiledFileFilter to check
+    a list of synthetic filenames (the number of filenames can be passed
+    as the first argument)
+    """
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    filenames = _generate_filenames(count)
+
+    for description, setup in (
+            ('include extensions', lambda ctx: ctx.set_include_extensions(('jpg', 'png'))),
+            ('exclude extensions', lambda ctx: ctx.set_exclude_extensions(('avi', 'mov', 'xcf'))),
+            ('no rules', lambda ctx: None)):
+        ctx = Context(config=ConfigParser.ConfigParser())
+        setup(ctx)
+        print "{0} filenames, {1}:".format(count, description)
+        results = []
+        for file_filter in (FileFilter(ctx), CompiledFileFilter(ctx)):
+            # Both implementations must give the same results
+            results.append([file_filter.include_file('/', filename) for filename in filenames])
+
+            def _check_all():
+                for filename in filenames:
+                    file_filter.include_file('/', filename)
+
+            elapsed = min(timeit.repeat(_check_all, number=1, repeat=3))
+            print " - {0}: {1:.3f} secs ({2:.2f} usecs per file)".format(
+                file_filter.__class__.__name__, elapsed, elapsed * 1000000.0 / count)
+        assert results[0] == results[1]
+
+if __name__ == '__main__':
+    main()
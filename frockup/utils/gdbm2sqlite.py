@@ -0,0 +1,26 @@
+import sys
+import os
+
+from frockup.catalog import MetadataCatalog, import_gdbm_database
+
+
+def main():
+    """
+    Imports all the '.frockup.gdbm' databases found in a tree to the metadata
+    catalog (the catalog filename can be passed as the second argument)
+    """
+    directory = sys.argv[1]
+    assert os.path.exists(directory)
+    assert os.path.isdir(directory)
+    catalog = MetadataCatalog(sys.argv[2] if len(sys.argv) > 2 else None)
+
+    for root, _, files in os.walk(os.path.abspath(directory)):
+        if '.frockup.gdbm' in files:
+            print " - Converting:", root
+            count = import_gdbm_database(catalog, root)
+            print "   {0} entries imported".format(count)
+
+    catalog.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import sys
+import logging
+import os
+
+from frockup.changes import ChangeIndex, ChangeWatcher
+from frockup.common import Context, get_config_option
+
+
+def main():
+    """
+    Watches the trees passed as arguments, recording the changed files until
+    interrupted (see `frockup.changes.ChangeWatcher`). The backups done with
+    '--changes' (or with 'enabled = true' in the '[changes]' section of the
+    configuration) check only the changed files of the watched trees.
+    """
+    logging.basicConfig(level=logging.INFO)
+    roots = [os.path.abspath(directory) for directory in sys.argv[1:]]
+    assert roots, "Usage: python -m frockup.utils.watch_changes DIRECTORY [DIRECTORY ...]"
+    for root in roots:
+        assert os.path.isdir(root)
+    ctx = Context()
+    index = ChangeIndex(get_config_option(ctx.config, 'changes', 'index'))
+    watcher = ChangeWatcher(index, roots)
+    try:
+        watcher.start()
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        index.close()
+
+if __name__ == '__main__':
+    main()
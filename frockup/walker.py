@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#    frockup - FROzen baCKUP or backup to Amazon Glacier
+#    Copyright (C) 2013 Horacio Guillermo de Oro <hgdeoro@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging as logging_
+import os
+import stat
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from frockup.common import stat_file
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of `os.scandir()` for Python 2 (https://pypi.python.org/pypi/scandir)
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging_.getLogger(__name__)
+
+DEFAULT_WALKER_THREADS = 8
+
+
+class _DirEntry():
+    """
+    Minimal implementation of `os.DirEntry`, returned by `list_directory()`. The
+    stats are taken with `stat_file()` (so the calls are counted) and cached, like
+    `os.DirEntry` does. If `entry` (the `os.DirEntry` returned by `scandir()`) is
+    passed, it's used for the type checks: the type comes with the listing, without
+    stat calls (in most file systems).
+    """
+
+    def __init__(self, directory, name, entry=None):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.entry = entry
+        self._lstat = None
+        self._stat = None
+
+    def _get_lstat(self):
+        if self._lstat is None:
+            self._lstat = stat_file(self.path, follow_symlinks=False)
+        return self._lstat
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and self.is_symlink():
+            if self._stat is None:
+                self._stat = stat_file(self.path)
+            return self._stat
+        return self._get_lstat()
+
+    def is_symlink(self):
+        if self.entry is not None:
+            return self.entry.is_symlink()
+        return stat.S_ISLNK(self._get_lstat().st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        if self.entry is not None:
+            return self.entry.is_dir(follow_symlinks=follow_symlinks)
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        if self.entry is not None:
+            return self.entry.is_file(follow_symlinks=follow_symlinks)
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def list_directory(directory):
+    """Returns the entries of `directory` (as `os.DirEntry` compatible instances)"""
+    if scandir is not None:
+        return [_DirEntry(directory, entry.name, entry) for entry in scandir(directory)]
+    return [_DirEntry(directory, name) for name in os.listdir(directory)]
+
+
+def walk_parallel(top, max_depth=None, prune=None, threads=DEFAULT_WALKER_THREADS):
+    """
+    Walks the tree at `top`, listing the directories from a pool of `threads`
+    threads, and yields `(directory, entries)` for each directory found, where
+    `entries` are the entries of the regular files in it.
+
+    Directories are yielded as soon as they are listed, so the order
+    isn't deterministic. Symbolic links to directories aren't followed.
+
+    :param max_depth: max. depth to descend (0 to only list `top`, None for no limit)
+    :param prune: callable receiving `(directory, name)` of each sub-directory,
+        returns True to exclude it (and all its sub-directories)
+    """
+    results = Queue.Queue()
+
+    def _list(directory, depth):
+        try:
+            results.put((directory, depth, list_directory(directory), None))
+        except Exception, e:
+            results.put((directory, depth, None, e))
+
+    pool = ThreadPool(threads)
+    try:
+        pool.apply_async(_list, (top, 0))
+        pending = 1
+        while pending:
+            directory, depth, entries, error = results.get()
+            pending -= 1
+            if error is not None:
+                logger.warn("Couldn't list directory '%s': %s", directory, error)
+                continue
+            files = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if max_depth is not None and depth >= max_depth:
+                        logger.debug("Ignoring sub-directory '%s' (max. depth reached)",
+                            entry.path)
+                    elif prune is not None and prune(directory, entry.name):
+                        logger.debug("Pruning sub-directory '%s'", entry.path)
+                    else:
+                        pool.apply_async(_list, (entry.path, depth + 1))
+                        pending += 1
+                elif entry.is_file():
+                    files.append(entry)
+            yield directory, files
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,106 @@
+import collections
+import logging
+import time
+
+# Actions of `AdaptiveConcurrency.update()`
+INCREASE = 'increase'
+DECREASE = 'decrease'
+BACK_OFF = 'back_off'
+KEEP = 'keep'
+
+
+class AdaptiveConcurrency(object):
+    """
+    Decides the number of upload processes to run, with an AIMD policy
+    (additive increase / multiplicative decrease) driven by the aggregate
+    throughput and errors reported by the processes.
+
+    Every `interval` seconds:
+    - if errors were reported, the limit is multiplied by `decrease_factor`
+    - if the last increase didn't improve the throughput (at least by
+      `min_gain`), the limit is reduced by one (back off)
+    - if all the allowed processes are running and there are uploads
+      waiting, the limit is increased by one
+
+    The limit is always kept between `min_limit` and `max_limit`.
+    """
+
+    def __init__(self, initial, min_limit, max_limit, interval=30.0, decrease_factor=0.5,
+                 min_gain=0.05, history_size=20):
+        assert 1 <= min_limit <= max_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.interval = interval
+        self.decrease_factor = decrease_factor
+        self.min_gain = min_gain
+        self.history = collections.deque(maxlen=history_size)
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.last_throughput = None
+        self.last_action = None
+
+    def add_sample(self, bytes_uploaded, errors):
+        """Registers the bytes uploaded and errors reported by a process"""
+        self.window_bytes += bytes_uploaded
+        self.window_errors += errors
+
+    def seconds_to_next_update(self):
+        return max(0.0, self.window_start + self.interval - time.time())
+
+    def update(self, running, waiting):
+        """
+        Re-computes the limit, if `interval` seconds passed since the last update.
+        `running` and `waiting` are the number of processes running and uploads waiting.
+        Returns the limit.
+        """
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return self.limit
+
+        throughput = self.window_bytes / elapsed
+        if self.window_errors:
+            action = DECREASE
+            new_limit = int(self.limit * self.decrease_factor)
+        elif self.last_action == INCREASE and self.last_throughput is not None and \
+                throughput < self.last_throughput * (1 + self.min_gain):
+            action = BACK_OFF
+            new_limit = self.limit - 1
+        elif running >= self.limit and waiting > 0:
+            action = INCREASE
+            new_limit = self.limit + 1
+        else:
+            action = KEEP
+            new_limit = self.limit
+        new_limit = max(self.min_limit, min(new_limit, self.max_limit))
+        if new_limit == self.limit and action in (INCREASE, BACK_OFF):
+            # Already at the bounds
+            action = KEEP
+
+        if new_limit != self.limit:
+            logging.info("Concurrent uploads: %s -> %s (%s, %.1f kb/sec, %s errors)",
+                self.limit, new_limit, action, throughput / 1024, self.window_errors)
+        self.history.append({
+            'time': now,
+            'limit': new_limit,
+            'throughput_kbps': int(throughput / 1024),
+            'errors': self.window_errors,
+            'action': action,
+        })
+        self.limit = new_limit
+        self.last_throughput = throughput
+        self.last_action = action
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_errors = 0
+        return self.limit
+
+    def get_status(self):
+        return {
+            'limit': self.limit,
+            'min': self.min_limit,
+            'max': self.max_limit,
+            'history': list(self.history),
+        }
@@ -1,14 +1,25 @@
+import collections
 import logging
+import resource
+import select
+import threading
 import time
 import os
 
 from multiprocessing import Process, Pipe
 
+from frockup.bandwidth import TokenBucket
+from frockup.changes import ChangeTracker, DIRECTORY_PASS, is_too_recent
 from frockup.common import Context
-from frockup.file_filter import FileFilter
-from frockup.local_metadata import LocalMetadata
+from frockup.file_filter import CompiledFileFilter
+from frockup.local_metadata import FileStats, get_local_metadata_class
 from frockup.main import _should_process_file
+from frockup.walker import list_directory
 from frockup.glacier import Glacier
+from frockup.web.adaptive import AdaptiveConcurrency
+from frockup.web.scheduling import JobQueue, POLICIES, FIFO
+from frockup.web.journal import JobJournal, DEFAULT_JOURNAL_FILENAME
+from frockup.web.events import EventBroadcaster
 
 DRY_RUN = 'FROCKUP_DRY_RUN' in os.environ
 
@@ -19,12 +30,59 @@ if DRY_RUN:
 LAUNCH_BACKUP = 'launch'
 GET_STATUS = 'get_status'
 STOP_ALL_PROCESSES = 'stop_all_processes'
+SET_BANDWIDTH_LIMIT = 'set_bandwidth_limit'
 
 PROCESS_STARTED = 'STARTED'
 PROCESS_FINISH_OK = 'FINISH_OK'
 PROCESS_FINISH_WITH_ERROR = 'FINISH_WITH_ERROR'
 PROCESS_CANCELLED = 'PROCESS_CANCELLED'
 
+# Sent by the upload processes as (PROCESS_PROGRESS, bytes uploaded, errors)
+PROCESS_PROGRESS = 'PROGRESS'
+
+# Status sent by the workers when a job ends (the worker is idle after sending it)
+JOB_FINISHED_STATUSES = (PROCESS_FINISH_OK, PROCESS_FINISH_WITH_ERROR, PROCESS_CANCELLED)
+
+# Sent to a worker to make it exit
+WORKER_EXIT = 'EXIT'
+
+# Jobs of the workers
+SCAN_DIRECTORY = 'scan'
+UPLOAD_FILE = 'upload'
+
+# Sent by the workers as (SCAN_RESULT, [(filename, file_stats), ...], too_recent) and
+# (UPLOAD_RESULT, glacier_data)
+SCAN_RESULT = 'SCAN_RESULT'
+UPLOAD_RESULT = 'UPLOAD_RESULT'
+
+# Status of the directories being backed up
+DIRECTORY_WAITING = 'WAITING'
+DIRECTORY_SCANNING = 'SCANNING'
+DIRECTORY_UPLOADING = 'UPLOADING'
+DIRECTORY_CANCELLED = 'CANCELLED'
+
+# Status changes sent by the controller to the web tier (see `_emit_event()`)
+EVENT_DIRECTORY_QUEUED = 'directory_queued'
+EVENT_DIRECTORY_FINISHED = 'directory_finished'
+EVENT_JOB_STARTED = 'job_started'
+EVENT_JOB_STATUS = 'job_status'
+EVENT_JOB_FINISHED = 'job_finished'
+EVENT_JOB_ERROR = 'job_error'
+EVENT_PROGRESS = 'progress'
+
+# Min. seconds between the EVENT_PROGRESS events of a directory
+PROGRESS_EVENT_SECONDS = 0.5
+
+# Min. seconds between the PROCESS_PROGRESS sent while a file is being uploaded
+UPLOAD_PROGRESS_SECONDS = 0.5
+
+METADATA_RETRY_SECONDS = 1.0
+
+# Times the update of the metadata of a file is tried (then the file will be uploaded again)
+METADATA_MAX_ATTEMPTS = 60
+
+MEGABYTE = 1024 * 1024
+
 #
 # Standard response:
 #  - ok (boolean)
@@ -52,12 +110,55 @@ class ProcessController(object):
     def __init__(self):
         # The controller, who launch and manitains hanlders processes
         self.process_controller = None
-        # Connection used to send commands to controller
+        # Connection used to send commands to controller (used by one thread at a time)
         self.parent_conn = None
-        # Uploads not started because of concurrent limit (see `concurrent_uploads`)
-        self.pending_uploads = []
-        # Max number of concurrent uploads
+        self.send_lock = threading.Lock()
+        # Connection used by the controller to send the status changes, and (in the web
+        # tier) the `EventBroadcaster` that sends them to the clients
+        self.events_conn = None
+        self.events = None
+        # Time of the last EVENT_PROGRESS of each directory
+        self.progress_events = {}
+        # Jobs not started because of concurrent limit (see `concurrent_uploads`), ordered
+        # by the scheduling policy. Files of FROCKUP_LARGE_FILE_MB (or bigger) are
+        # uploaded by up to FROCKUP_LARGE_FILE_WORKERS workers, apart from the others.
+        self.pending_uploads = JobQueue(os.environ.get('FROCKUP_SCHEDULING_POLICY', FIFO),
+            int(os.environ.get('FROCKUP_LARGE_FILE_MB', '0')) * MEGABYTE)
+        self.large_file_workers = max(1, int(os.environ.get('FROCKUP_LARGE_FILE_WORKERS', '1')))
+        # Progress of the directories being backed up, by name
+        self.directories = collections.OrderedDict()
+        # Uploaded files whose metadata wasn't written yet:
+        # (directory, filename, file_stats, glacier_data)
+        self.pending_metadata = []
+        # Failed updates of the metadata, by (directory, filename)
+        self.metadata_failures = {}
+        # Directories whose jobs finished, recorded as finished in the journal once
+        # their metadata is written (see `_journal_finished()`)
+        self.finishing_directories = set()
+        # Used (in the controller process) to write the metadata of the uploads
+        self.local_metadata = None
+        # Journal of the jobs, to resume them if the controller is restarted (see
+        # `_resume_jobs()`). Opened by `loop()`. Set FROCKUP_JOURNAL='' to disable it.
+        self.journal = JobJournal(os.environ.get('FROCKUP_JOURNAL', DEFAULT_JOURNAL_FILENAME))
+        # If the changes are tracked (see `frockup.changes`), only the dirty files of the
+        # directories are checked. Created by `loop()`. The state of each backup, by directory
+        self.change_tracker = None
+        self.changes = {}
+        # Max number of concurrent uploads (initial value, adjusted by `concurrency`
+        # between FROCKUP_MIN_CONCURRENT_UPLOADS and FROCKUP_MAX_CONCURRENT_UPLOADS)
         self.concurrent_uploads = int(os.environ.get('FROCKUP_CONCURRENT_UPLOADS', '3'))
+        self.concurrency = AdaptiveConcurrency(self.concurrent_uploads,
+            int(os.environ.get('FROCKUP_MIN_CONCURRENT_UPLOADS', self.concurrent_uploads)),
+            int(os.environ.get('FROCKUP_MAX_CONCURRENT_UPLOADS', self.concurrent_uploads)),
+            float(os.environ.get('FROCKUP_CONCURRENCY_INTERVAL', '30')))
+        # Limits the sum of the uploads of all the processes (created here, to be
+        # shared with the processes started by the controller). 0 for no limit.
+        self.bandwidth_limiter = TokenBucket(
+            int(os.environ.get('FROCKUP_BANDWIDTH_LIMIT_KBPS', '0')) * 1024)
+        # The workers are replaced after this number of jobs, or if their memory
+        # usage (max. RSS) grows above this number of MB
+        self.worker_max_jobs = int(os.environ.get('FROCKUP_WORKER_MAX_JOBS', '100'))
+        self.worker_max_memory = int(os.environ.get('FROCKUP_WORKER_MAX_MEMORY_MB', '512'))
 
     def start(self):
         """
@@ -66,8 +167,12 @@ class ProcessController(object):
         """
         logging.info("start()")
         self.parent_conn, child_conn = Pipe()
-        self.process_controller = Process(target=self.loop, args=(child_conn,))
+        events_conn, child_events_conn = Pipe(duplex=False)
+        self.process_controller = Process(target=self.loop, args=(child_conn, child_events_conn))
         self.process_controller.start()
+        # Only the controller writes the events
+        child_events_conn.close()
+        self.events = EventBroadcaster(events_conn).start()
 
     # Utility method - hides implementation details
     def get_background_process_status(self):
@@ -79,15 +184,17 @@ class ProcessController(object):
         return data
 
     # Utility method - hides implementation details
-    def launch_backup(self, directory_name):
+    def launch_backup(self, directory_name, policy=None, large_file_mb=None):
         """
         Launch the backup of a directory.
+        `policy` and `large_file_mb` change the scheduling of the waiting jobs
+        (see `JobQueue`), if not None.
         This method is invoked in the WEB tier.
         """
         # TODO: rename to 'sync_directory()' or something else
         assert os.path.exists(directory_name)
         data = self.send_msg({'action': LAUNCH_BACKUP,
-            'directory': directory_name})
+            'directory': directory_name, 'policy': policy, 'large_file_mb': large_file_mb})
         return data
 
     # Utility method - hides implementation details
@@ -99,6 +206,27 @@ class ProcessController(object):
         data = self.send_msg({'action': STOP_ALL_PROCESSES})
         return data
 
+    # Utility method - hides implementation details
+    def set_bandwidth_limit(self, kbps):
+        """
+        Sets the max. kb/sec of the sum of all the uploads (0 for no limit).
+        This method is invoked in the WEB tier.
+        """
+        data = self.send_msg({'action': SET_BANDWIDTH_LIMIT, 'kbps': kbps})
+        return data
+
+    # Utility method - hides implementation details
+    def subscribe_events(self):
+        """
+        Returns a `Subscription` to the status changes of the controller, to be
+        passed to `unsubscribe_events()` when the client disconnects.
+        This method is invoked in the WEB tier.
+        """
+        return self.events.subscribe()
+
+    def unsubscribe_events(self, subscription):
+        self.events.unsubscribe(subscription)
+
     def send_msg(self, msg):
         """
         Sends a message and wait for the response
@@ -116,27 +244,49 @@ class ProcessController(object):
         if not self.process_controller.is_alive():
             logging.warn("process_controller is NOT alive!")
             return get_error_response('First subprocess is NOT alive.')
-        self.parent_conn.send(msg)
-        data = self.parent_conn.recv()
+        # The requests of different threads must not be mixed
+        with self.send_lock:
+            self.parent_conn.send(msg)
+            data = self.parent_conn.recv()
         return data
 
-    def loop(self, child_conn):
+    def loop(self, child_conn, events_conn=None):
         """
         This method is the 'target' method of `self.process_controller`.
         This methods has a loop, receives the messages and call `_handle_message()`
         This method is invoked in the FIRST SUBPROCESS (others sub-sub-processes
         are the processes that do the actual work, like uploading files).
 
+        The loop waits (with `select()`) on the connection with the web tier and the
+        connections with all the running processes, so messages, status updates and
+        finished processes (detected by the end-of-file of their connection) are
+        handled as soon as they happen.
+
+        The uploads are done by a pool of long-lived worker processes (see
+        `upload_worker()`); `background_processes_in_child` are the workers, with
+        the `directory` of their job (None if the worker is idle).
+
+        The status changes are sent to the web tier through `events_conn` (see
+        `_emit_event()`).
+
         Returns 'response', generated by `get_ok_response()` or `get_error_response()`.
         """
         logging.info("loop()")
+        self.events_conn = events_conn
+        # The end of the web tier was inherited: close it, to detect when the web tier exits
+        self.parent_conn.close()
+        ctx = Context()
+        self.local_metadata = get_local_metadata_class(ctx.config)(ctx)
+        if ctx.track_changes and not DRY_RUN:
+            self.change_tracker = ChangeTracker(ctx)
+        self._resume_jobs(self.journal.open())
 
         background_processes_in_child = []
         finished_background_process = []
 
         def _loop():
+            data = child_conn.recv()
             try:
-                data = child_conn.recv()
                 ret = self._handle_message(background_processes_in_child, data)
                 child_conn.send(ret)
             except:
@@ -146,12 +296,25 @@ class ProcessController(object):
 
         try:
             while True:
-                if child_conn.poll(2):
+                connections = [child_conn] + [a_process['parent_conn']
+                                              for a_process in background_processes_in_child]
+                readable, _, _ = select.select(connections, [], [],
+                    self._get_wait_timeout(background_processes_in_child))
+                if child_conn in readable:
                     _loop()
                 self._handle_cleanup(background_processes_in_child, finished_background_process)
+        except EOFError:
+            logging.info("Connection with the web tier closed, exiting loop()")
         except:
             logging.exception("Exception detected in main loop of subprocess_handler()")
             raise
+        finally:
+            # The workers exit after finishing their current job
+            for a_process in background_processes_in_child:
+                try:
+                    a_process['parent_conn'].send(WORKER_EXIT)
+                except (IOError, OSError):
+                    pass
 
     def _handle_message(self, background_processes_in_child, data):
         """
@@ -165,8 +328,31 @@ class ProcessController(object):
         #
 
         if data['action'] == LAUNCH_BACKUP:
-            self.pending_uploads.append(data)
-            last_dir = os.path.split(data['directory'])[1]
+            directory = data['directory']
+            last_dir = os.path.split(directory)[1]
+            if directory in self.directories:
+                return get_error_response("Backup of '{}' already scheduled".format(last_dir))
+            policy = data.get('policy')
+            if policy is not None and policy not in POLICIES:
+                return get_error_response("Invalid scheduling policy: '{}'".format(policy))
+            large_file_mb = data.get('large_file_mb')
+            if policy is not None or large_file_mb is not None:
+                self.pending_uploads.configure(policy, None if large_file_mb is None
+                                               else int(large_file_mb) * MEGABYTE)
+            files = data.get('files')
+            if files is None and self.change_tracker is not None:
+                dirty, self.changes[directory] = self.change_tracker.start(directory,
+                    DIRECTORY_PASS, recursive=False)
+                # Only the dirty files (all of them, if the whole directory is dirty)
+                if dirty is not None and directory not in dirty:
+                    files = []
+                elif dirty is not None and dirty[directory] is not None:
+                    files = sorted(dirty[directory])
+            # A new backup replaces the previous one, in the journal
+            self.finishing_directories.discard(directory)
+            self._add_directory(directory, files)
+            self.journal.add_queued(directory, files)
+            self._emit_event(EVENT_DIRECTORY_QUEUED, directory)
             return get_ok_response("Backup of '{}' scheduled".format(last_dir))
 
         #
@@ -174,44 +360,56 @@ class ProcessController(object):
         #
 
         if data['action'] == GET_STATUS:
-            ret = get_ok_response('{} process running'.format(len(background_processes_in_child)))
+            busy_workers = [item for item in background_processes_in_child
+                            if item['directory'] is not None]
+            ret = get_ok_response('{} process running, {} jobs waiting'.format(
+                len(busy_workers), len(self.pending_uploads)))
             proc_status = []
             # Processes running
-            for item in background_processes_in_child:
+            for item in busy_workers:
                 proc_status.append({'pid': item['p'].pid, 'status': item['status'],
                     'directory': item['directory']})
-            # Processes waiting
-            for data in self.pending_uploads:
-                proc_status.append({'pid': -1, 'status': 'WAITING - Directory: {}'.format(
-                    data['directory']), 'directory': data['directory']})
+            # Progress of the directories
+            for progress in self.directories.itervalues():
+                proc_status.append({'pid': -1, 'status': self._get_progress_msg(progress),
+                    'directory': progress['directory']})
 
             ret['proc_status'] = proc_status
+            ret['directories'] = self.directories.values()
+            ret['bandwidth_limit_kbps'] = self.bandwidth_limiter.get_rate() / 1024
+            ret['concurrency'] = self.concurrency.get_status()
+            ret['scheduling'] = self.pending_uploads.get_status()
+            ret['scheduling']['large_file_workers'] = self.large_file_workers
+            ret['workers'] = len(background_processes_in_child)
             return ret
 
+        #
+        # SET_BANDWIDTH_LIMIT
+        #
+
+        if data['action'] == SET_BANDWIDTH_LIMIT:
+            kbps = int(data['kbps'] or 0)
+            self.bandwidth_limiter.set_rate(kbps * 1024)
+            if kbps:
+                return get_ok_response('Bandwidth limited to {} kb/sec'.format(kbps))
+            return get_ok_response('Bandwidth not limited')
+
         #
         # STOP_ALL_PROCESSES
         #
 
         if data['action'] == STOP_ALL_PROCESSES:
-            self.pending_uploads = []
-            all_stopped = True
-            for item in background_processes_in_child:
-                if not item['p'].is_alive():
-                    logging.info("Won't send STOP to process {} - It's NOT alive".format(
-                        item['p'].pid))
-
-                logging.info("Will send STOP to process {}".format(item['p'].pid))
-                try:
-                    item['parent_conn'].send('STOP')
-                except:
-                    all_stopped = False
-                    logging.exception("STOP_ALL_PROCESSES: exception detected when "
-                        "sending STOP to process {}".format(item['p'].pid))
-
-            if all_stopped:
-                return get_ok_response('Stop sent to all the processes')
-            else:
-                return get_error_response("Couldn't send STOP to all processes")
+            # The jobs being processed can't be interrupted: they'll finish
+            for progress in self.directories.values():
+                progress['status'] = DIRECTORY_CANCELLED
+                self._emit_event(EVENT_PROGRESS, progress['directory'])
+            pending_uploads = self.pending_uploads.clear()
+            for job in pending_uploads:
+                self._finish_job(job, False)
+            running = len([item for item in background_processes_in_child
+                           if item['directory'] is not None])
+            return get_ok_response('{} jobs cancelled ({} running jobs will finish)'.format(
+                len(pending_uploads), running))
 
         #
         # (unknown)
@@ -219,29 +417,357 @@ class ProcessController(object):
 
         return get_error_response("Unknown action: '{}'".format(data['action']))
 
+    def _get_progress_msg(self, progress):
+        return "{} - Directory: {} - {} of {} files ({} of {} kb) - {} errors".format(
+            progress['status'], progress['directory'], progress['files_done'],
+            progress['files_total'], progress['bytes_done'] / 1024,
+            progress['bytes_total'] / 1024, progress['errors'])
+
+    def _emit_event(self, event_type, directory, worker=None):
+        """
+        Sends a status change to the web tier (see `EventBroadcaster`), with the
+        current progress of the directory and the status of the worker (if any).
+        """
+        if self.events_conn is None:
+            return
+        progress = self.directories.get(directory)
+        event = {
+            'type': event_type,
+            'directory': directory,
+            'pid': worker['p'].pid if worker is not None else -1,
+            'status': worker['status'] if worker is not None else None,
+            'progress': progress,
+            'directory_status': self._get_progress_msg(progress) if progress else None,
+            'jobs_waiting': len(self.pending_uploads),
+        }
+        try:
+            self.events_conn.send(event)
+        except (IOError, OSError):
+            logging.warn("Couldn't send event to the web tier: no more events will be sent")
+            self.events_conn = None
+
+    def _emit_progress(self, directory):
+        """Sends EVENT_PROGRESS, at most once every PROGRESS_EVENT_SECONDS per directory"""
+        now = time.time()
+        if now - self.progress_events.get(directory, 0) >= PROGRESS_EVENT_SECONDS:
+            self.progress_events[directory] = now
+            self._emit_event(EVENT_PROGRESS, directory)
+
+    def _get_wait_timeout(self, background_processes_in_child):
+        """
+        Returns the max. seconds `loop()` should wait for messages: until the next
+        update of `concurrency` while there is work, None (forever) if idle.
+        """
+        if self.pending_metadata:
+            # Retry the update of the metadata
+            return METADATA_RETRY_SECONDS
+        if not self.pending_uploads and all([item['directory'] is None
+                                             for item in background_processes_in_child]):
+            return None
+        return self.concurrency.seconds_to_next_update()
+
+    def _start_worker(self, background_processes_in_child):
+        _parent_conn, _child_conn = Pipe()
+        # The ends of the controller (of this and the other workers) are inherited: the
+        # new process closes them, so the workers get EOF if the controller dies
+        inherited_conns = [_parent_conn] + [item['parent_conn']
+                                            for item in background_processes_in_child]
+        new_process = Process(target=upload_worker, args=(_child_conn, self.bandwidth_limiter,
+            self.worker_max_jobs, self.worker_max_memory, inherited_conns))
+        new_process.start()
+        # Only the new process must keep this end open, to detect its end by EOF
+        _child_conn.close()
+        worker = {
+            'p': new_process,
+            'parent_conn': _parent_conn,
+            'status': None,
+            'directory': None,
+            # The job being processed, and if the worker already started it
+            'job': None,
+            'started': False,
+            # The job is a file of the large file lane
+            'large': False,
+            # WORKER_EXIT was sent to the worker
+            'exiting': False,
+        }
+        background_processes_in_child.append(worker)
+        return worker
+
+    def _add_directory(self, directory, files=None, scan=True):
+        """Adds the progress of a directory, and queues its scan (if `scan`)"""
+        progress = {
+            'directory': directory,
+            'status': DIRECTORY_WAITING,
+            # Jobs (of this directory) waiting or running
+            'jobs': 0,
+            'files_total': 0,
+            'files_done': 0,
+            'bytes_total': 0,
+            'bytes_done': 0,
+            'errors': 0,
+        }
+        self.directories[directory] = progress
+        if scan:
+            self.pending_uploads.append({'action': SCAN_DIRECTORY, 'directory': directory,
+                'files': files})
+            progress['jobs'] += 1
+        return progress
+
+    def _add_file(self, progress, filename, file_stats):
+        self.pending_uploads.append({'action': UPLOAD_FILE, 'directory': progress['directory'],
+            'filename': filename, 'file_stats': file_stats})
+        progress['jobs'] += 1
+        progress['files_total'] += 1
+        progress['bytes_total'] += file_stats.stats.st_size
+
+    def _add_files(self, job, files, too_recent):
+        """Queues the upload of the files found by a SCAN_DIRECTORY job"""
+        progress = self.directories.get(job['directory'])
+        if progress is None or progress['status'] == DIRECTORY_CANCELLED:
+            return
+        if job['directory'] in self.changes:
+            for filename in too_recent:
+                self.change_tracker.add_pending(job['directory'], filename)
+        self.journal.add_scanned(job['directory'], files)
+        progress['status'] = DIRECTORY_UPLOADING
+        for filename, file_stats in files:
+            self._add_file(progress, filename, file_stats)
+
+    def _resume_jobs(self, states):
+        """
+        Re-creates the jobs of the directories not finished when the controller
+        stopped (read from the journal): the scanned directories aren't scanned
+        again, and only the files not uploaded (or failed) are queued.
+        """
+        for state in states:
+            directory = state['directory']
+            progress = self._add_directory(directory, state['files'],
+                scan=state['scanned'] is None)
+            for filename, file_stats in state['scanned'] or []:
+                if filename in state['uploaded']:
+                    progress['files_total'] += 1
+                    progress['files_done'] += 1
+                    progress['bytes_total'] += file_stats.stats.st_size
+                    progress['bytes_done'] += file_stats.stats.st_size
+                    glacier_data = state['uploaded'][filename]
+                    if glacier_data is not None:
+                        data = self.local_metadata.get_file_data(directory, filename)
+                        self.local_metadata.close()
+                        # The metadata may not have been written before the restart
+                        if data.get('archive_id') != glacier_data.archive_id:
+                            self.pending_metadata.append((directory, filename, file_stats,
+                                glacier_data))
+                elif filename in state['failed']:
+                    progress['files_total'] += 1
+                    progress['errors'] += 1
+                else:
+                    self._add_file(progress, filename, file_stats)
+            if state['scanned'] is not None:
+                progress['status'] = DIRECTORY_UPLOADING
+            if progress['jobs'] == 0:
+                self._directory_finished(progress)
+            else:
+                logging.info("Resuming backup of '%s' (%s files waiting)", directory,
+                    progress['jobs'])
+
+    def _directory_finished(self, progress):
+        logging.info("Backup of '%s' finished: %s of %s files uploaded, %s errors",
+            progress['directory'], progress['files_done'], progress['files_total'],
+            progress['errors'])
+        self._emit_event(EVENT_DIRECTORY_FINISHED, progress['directory'])
+        self.progress_events.pop(progress['directory'], None)
+        del self.directories[progress['directory']]
+        changes_state = self.changes.pop(progress['directory'], None)
+        if changes_state is not None and progress['status'] != DIRECTORY_CANCELLED:
+            self.change_tracker.done(changes_state, [progress['directory']])
+        self.finishing_directories.add(progress['directory'])
+        self._journal_finished()
+
+    def _journal_finished(self):
+        """
+        Records in the journal the finished directories whose metadata was written
+        (until then, the uploads are replayed if the controller is restarted)
+        """
+        if not self.finishing_directories:
+            return
+        waiting = set([item[0] for item in self.pending_metadata])
+        for directory in list(self.finishing_directories):
+            if directory not in waiting:
+                self.journal.add_finished(directory)
+                self.finishing_directories.remove(directory)
+        if not self.directories and not self.pending_metadata:
+            # Nothing to resume: start a new journal
+            self.journal.truncate()
+
+    def _finish_job(self, job, error):
+        """Updates the progress of the directory of the job (removed when all its jobs finished)"""
+        progress = self.directories.get(job['directory'])
+        if progress is None:
+            return
+        if error:
+            progress['errors'] += 1
+        progress['jobs'] -= 1
+        if error and job['action'] == UPLOAD_FILE:
+            self.journal.add_failed(job['directory'], job['filename'])
+            if job['directory'] in self.changes:
+                self.change_tracker.add_pending(job['directory'], job['filename'])
+        elif error:
+            # Not scanned: its dirty entries are kept
+            self.changes.pop(job['directory'], None)
+        if progress['jobs'] == 0:
+            self._directory_finished(progress)
+
+    def _handle_worker_message(self, worker, received):
+        job = worker['job']
+        if isinstance(received, tuple):
+            progress = self.directories.get(job['directory']) if job else None
+            if received[0] == PROCESS_PROGRESS:
+                self.concurrency.add_sample(received[1], received[2])
+                if progress is not None:
+                    progress['bytes_done'] += received[1]
+                    self._emit_progress(job['directory'])
+            elif received[0] == SCAN_RESULT:
+                self._add_files(job, received[1], received[2])
+                self._emit_event(EVENT_PROGRESS, job['directory'])
+            elif received[0] == UPLOAD_RESULT:
+                self.journal.add_uploaded(job['directory'], job['filename'], received[1])
+                if received[1] is not None:
+                    self.pending_metadata.append((job['directory'], job['filename'],
+                        job['file_stats'], received[1]))
+                if progress is not None:
+                    progress['files_done'] += 1
+            return
+
+        worker['status'] = received
+        if received == PROCESS_STARTED:
+            worker['started'] = True
+            self.journal.add_started(job['directory'], job.get('filename'))
+            progress = self.directories.get(job['directory'])
+            if progress is not None and progress['status'] == DIRECTORY_WAITING:
+                progress['status'] = DIRECTORY_SCANNING
+            self._emit_event(EVENT_JOB_STARTED, job['directory'], worker)
+        elif received in JOB_FINISHED_STATUSES:
+            self._emit_event(EVENT_JOB_ERROR if received == PROCESS_FINISH_WITH_ERROR
+                             else EVENT_JOB_FINISHED, job['directory'], worker)
+            self._finish_job(job, received == PROCESS_FINISH_WITH_ERROR)
+            worker['directory'] = None
+            worker['job'] = None
+        elif job is not None:
+            self._emit_event(EVENT_JOB_STATUS, job['directory'], worker)
+
+    def _flush_metadata(self):
+        """
+        Writes the metadata of the uploaded files. The controller is the only
+        process that writes it, so the updates of a directory never conflict.
+        """
+        if not self.pending_metadata:
+            return
+        # The failed updates are retried later, without blocking the others
+        failed = []
+        try:
+            for entry in self.pending_metadata:
+                directory, filename, file_stats, glacier_data = entry
+                try:
+                    self.local_metadata.update_metadata(directory, filename, file_stats,
+                        glacier_data)
+                    self.metadata_failures.pop((directory, filename), None)
+                except:
+                    attempts = self.metadata_failures.pop((directory, filename), 0) + 1
+                    if attempts < METADATA_MAX_ATTEMPTS:
+                        # The traceback is logged only once (retried every second)
+                        (logging.exception if attempts == 1 else logging.warn)(
+                            "Couldn't update the metadata of '%s/%s' (will retry)",
+                            directory, filename)
+                        self.metadata_failures[(directory, filename)] = attempts
+                        failed.append(entry)
+                    else:
+                        logging.exception("Couldn't update the metadata of '%s/%s' after %s "
+                            "attempts: the file will be uploaded again", directory, filename,
+                            attempts)
+            self.pending_metadata = failed
+        finally:
+            # Release the DB, so it can be opened by other processes
+            self.local_metadata.close()
+        self._journal_finished()
+
     def _handle_cleanup(self, background_processes_in_child, finished_background_process):
+        """
+        Handles the messages of the workers, and assigns the waiting jobs to them.
+
+        The jobs are SCAN_DIRECTORY (the worker sends back the files to upload,
+        queued as UPLOAD_FILE jobs, one per file) and UPLOAD_FILE. All the jobs
+        are in a single queue (`pending_uploads`), so any idle worker takes the
+        next one, and the files of a big directory are uploaded in parallel.
+        Up to `concurrent_uploads` workers process the jobs, plus up to
+        `large_file_workers` for the files of the large file lane.
+        """
         logging.debug("_handle_cleanup()")
-        for a_process in background_processes_in_child:
-            if a_process['parent_conn'].poll():
-                a_process['status'] = a_process['parent_conn'].recv()
+        for a_process in list(background_processes_in_child):
+            try:
+                while a_process['parent_conn'].poll():
+                    self._handle_worker_message(a_process, a_process['parent_conn'].recv())
+            except (EOFError, IOError):
+                # The process closed its end of the connection: it finished (or died).
+                # IOError (connection reset) if it exited without reading a job.
+                a_process['p'].join()
             if not a_process['p'].is_alive():
-                finished_background_process.append(
-                    background_processes_in_child.remove(a_process))
-
-        logging.debug("Start new process (if any)")
-        while self.pending_uploads and len(background_processes_in_child) < self.concurrent_uploads:
-            data = self.pending_uploads.pop(0)
-            _parent_conn, _child_conn = Pipe()
-            new_process = Process(target=action_upload_directory, args=(_child_conn,
-                data['directory']))
-            new_process.start()
-            background_processes_in_child.append({
-                                       'p': new_process,
-                                       'child_conn': _child_conn,
-                                       'parent_conn': _parent_conn,
-                                       'status': None,
-                                       'directory': data['directory'],
-                                       })
+                a_process['parent_conn'].close()
+                background_processes_in_child.remove(a_process)
+                finished_background_process.append(a_process)
+                if a_process['job'] is not None:
+                    if a_process['started']:
+                        logging.error("Worker %s died while processing %s",
+                            a_process['p'].pid, a_process['job'])
+                        self._emit_event(EVENT_JOB_ERROR, a_process['job']['directory'],
+                            a_process)
+                        self._finish_job(a_process['job'], True)
+                    else:
+                        # The worker exited (ie: recycled) before starting the job
+                        self.pending_uploads.append_first(a_process['job'])
+
+        self._flush_metadata()
+
+        idle_workers = [item for item in background_processes_in_child
+                        if item['directory'] is None and not item['exiting']]
+        busy_workers = [item for item in background_processes_in_child
+                        if item['directory'] is not None]
+        busy_large = len([item for item in busy_workers if item['large']])
+        busy_count = len(busy_workers) - busy_large
+
+        self.concurrent_uploads = self.concurrency.update(busy_count,
+            self.pending_uploads.count())
+
+        logging.debug("Start new jobs (if any)")
+        for large, limit in ((False, self.concurrent_uploads), (True, self.large_file_workers)):
+            running = busy_large if large else busy_count
+            while running < limit:
+                job = self.pending_uploads.pop(large)
+                if job is None:
+                    break
+                worker = idle_workers.pop(0) if idle_workers else \
+                    self._start_worker(background_processes_in_child)
+                worker.update({'job': job, 'started': False, 'status': None,
+                    'directory': job['directory'], 'large': large})
+                try:
+                    worker['parent_conn'].send(job)
+                except (IOError, OSError):
+                    # The worker is exiting: it will be removed and the job re-queued
+                    logging.warn("Couldn't send job to worker %s", worker['p'].pid)
+                running += 1
+            if large:
+                busy_large = running
+            else:
+                busy_count = running
+
+        # Don't keep more idle workers than needed
+        max_workers = self.concurrent_uploads
+        if self.pending_uploads.large_file_threshold:
+            max_workers += self.large_file_workers
+        while idle_workers and busy_count + busy_large + len(idle_workers) > max_workers:
+            worker = idle_workers.pop()
+            logging.info("Stopping idle worker %s", worker['p'].pid)
+            worker['parent_conn'].send(WORKER_EXIT)
+            worker['exiting'] = True
 
 
 #===============================================================================
@@ -251,71 +777,178 @@ class ProcessController(object):
 #===============================================================================
 
 
-def action_upload_directory(_child_conn, directory):
+def _to_os_stat_result(stats):
+    """Returns `stats` as `os.stat_result` (the stats of `scandir` can't be pickled)"""
+    # The float times are only available as attributes
+    return os.stat_result(tuple(stats), dict([(name, getattr(stats, name))
+        for name in ('st_atime', 'st_mtime', 'st_ctime')]))
+
+
+def _scan_directory(_child_conn, directory, ctx, file_filter, local_metadata, logger,
+                    filenames=None):
     """
-    Uploads a directory.
+    Sends `(SCAN_RESULT, [(filename, file_stats), ...], too_recent)` with the files of
+    `directory` (only `filenames`, if not None) that must be uploaded, and the names
+    of the files excluded only because they're too recent (see `frockup.changes`).
+    """
+    files = []
+    too_recent = []
+    # Nothing to check if no file changed (see `frockup.changes`)
+    entries = list_directory(directory) if filenames is None or filenames else []
+    filenames = None if filenames is None else set(filenames)
+    local_metadata.check_directory(directory)
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        a_file = entry.name
+        if filenames is not None and a_file not in filenames:
+            continue
+        should_proc, file_stats = _should_process_file(
+            directory, a_file, file_filter, local_metadata, ctx, entry)
+        if should_proc:
+            logger.info("INCLUDING %s/%s", directory, a_file)
+            files.append((a_file, FileStats(_to_os_stat_result(file_stats.stats))))
+        else:
+            logger.info("EXCLUDING %s/%s", directory, a_file)
+            if file_stats is None and file_filter.include_file(directory, a_file) and \
+                    is_too_recent(ctx, entry.stat()):
+                too_recent.append(a_file)
+    _child_conn.send((SCAN_RESULT, files, too_recent))
+
+
+class UploadProgress(object):
+    """
+    Sends `(PROCESS_PROGRESS, bytes, 0)` as the file is uploaded (at most every
+    `interval` seconds), so the throughput is sampled while the uploads run
+    (see `AdaptiveConcurrency`). At most `size` bytes are reported: the bytes
+    re-sent when a request is retried aren't counted twice.
     """
-    logger = logging.getLogger('action_upload_directory[{}]'.format(os.getpid()))
-    try:
-        logger.info("action_upload_directory(directory=%s)", directory)
-        _child_conn.send(PROCESS_STARTED)
 
-        ctx = Context()
-        ctx.set_include_extensions(('jpg',))
-        file_filter = FileFilter(ctx)
-        local_metadata = LocalMetadata(ctx)
-        glacier = Glacier(ctx)
-
-        file_list_to_proc = []
-        bytes_to_backup = 0
-        for a_file in os.listdir(directory):
-            if not os.path.isfile(os.path.join(directory, a_file)):
+    def __init__(self, conn, size, interval=UPLOAD_PROGRESS_SECONDS):
+        self.conn = conn
+        self.size = size
+        self.interval = interval
+        # `progress()` is called by the threads uploading the parts
+        self.lock = threading.Lock()
+        self.reported = 0
+        self.pending = 0
+        self.last_report = time.time()
+
+    def progress(self, size):
+        with self.lock:
+            self.pending += size
+            if time.time() - self.last_report >= self.interval:
+                self._report()
+
+    def finish(self):
+        """Reports the bytes not reported yet, once the file is uploaded"""
+        with self.lock:
+            self.pending = self.size
+            self._report()
+
+    def _report(self):
+        size = min(self.pending, self.size - self.reported)
+        self.pending = 0
+        self.last_report = time.time()
+        if size > 0:
+            self.reported += size
+            self.conn.send((PROCESS_PROGRESS, size, 0))
+
+
+def _upload_file(_child_conn, directory, filename, file_stats, glacier, logger):
+    """
+    Uploads a file, and sends `(UPLOAD_RESULT, glacier_data)` (the metadata
+    is updated by the controller). The progress is sent while uploading
+    (see `UploadProgress`).
+    """
+    size = file_stats.stats.st_size
+    _child_conn.send("Uploading file {}/{} - ({} kb)".format(directory, filename, size / 1024))
+    logger.info("Starting upload of %s/%s", directory, filename)
+    upload_progress = UploadProgress(_child_conn, size)
+    if DRY_RUN:
+        time.sleep(2)
+        glacier_data = None
+    else:
+        glacier_data = glacier.upload_file(directory, filename,
+            progress=upload_progress.progress)
+    logger.info("Finished upload of %s/%s", directory, filename)
+    _child_conn.send((UPLOAD_RESULT, glacier_data))
+    upload_progress.finish()
+
+
+def _create_upload_objects(bandwidth_limiter):
+    ctx = Context()
+    ctx.set_include_extensions(('jpg',))
+    if bandwidth_limiter is not None:
+        ctx.bandwidth_limiter = bandwidth_limiter
+    file_filter = CompiledFileFilter(ctx)
+    local_metadata = get_local_metadata_class(ctx.config)(ctx)
+    glacier = Glacier(ctx)
+    return ctx, file_filter, local_metadata, glacier
+
+
+def get_max_rss_mb():
+    """Returns the max. resident set size of this process, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def upload_worker(_child_conn, bandwidth_limiter=None, max_jobs=100, max_memory_mb=512,
+                  inherited_conns=()):
+    """
+    Long-lived upload process: receives jobs (SCAN_DIRECTORY or UPLOAD_FILE, see
+    `ProcessController._handle_cleanup()`) and processes them one at a time,
+    re-using the context, the metadata DB and the Glacier connection.
+
+    Exits when WORKER_EXIT is received (or the controller closes the connection),
+    after `max_jobs` jobs, or when the max. RSS grows above `max_memory_mb`, so
+    it's replaced by a new process. `inherited_conns` are the ends of the
+    controller inherited by this process, closed before receiving the jobs.
+    """
+    for conn in inherited_conns:
+        conn.close()
+    logger = logging.getLogger('upload_worker[{}]'.format(os.getpid()))
+    ctx, file_filter, local_metadata, glacier = _create_upload_objects(bandwidth_limiter)
+    jobs_done = 0
+    try:
+        while True:
+            try:
+                job = _child_conn.recv()
+            except EOFError:
+                break
+            if job == WORKER_EXIT:
+                break
+            if not isinstance(job, dict):
+                logger.warn("Ignoring received message '{}'".format(job))
                 continue
-            should_proc, file_stats = _should_process_file(
-                directory, a_file, file_filter, local_metadata, ctx)
-            if should_proc:
-                logger.info("INCLUDING %s/%s", directory, a_file)
-                file_list_to_proc.append((a_file, file_stats))
-                bytes_to_backup += file_stats.stats.st_size
-            else:
-                logger.info("EXCLUDING %s/%s", directory, a_file)
-
-        bytes_uploaded = 0
-        start_time = time.time()
-        msg_template = "Uploading file {}/{} - ({} of {}) - ({} kb uploaded / {} kb pending)" + \
-            " - Speed: {} kb/sec"
-        try:
-            num = 0
-            for a_file, file_stats in file_list_to_proc:
-                num += 1
-                if _child_conn.poll():
-                    received = _child_conn.recv()
-                    if received == 'STOP':
-                        _child_conn.send(PROCESS_CANCELLED)
-                        return
-                    else:
-                        logger.warn("Ignoring received text '{}'".format(received))
-
-                bytes_pending_upload = bytes_to_backup - bytes_uploaded
-                bytes_per_sec = int(bytes_uploaded / (time.time() - start_time))
-                _child_conn.send(msg_template.format(directory, a_file,
-                    num, len(file_list_to_proc), (bytes_uploaded / 1024),
-                    (bytes_pending_upload / 1024), (bytes_per_sec / 1024)))
-                logger.info("Starting upload of %s/%s", directory, a_file)
-                if DRY_RUN:
-                    time.sleep(2)
-                else:
-                    glacier_data = glacier.upload_file(directory, a_file)
-                logger.info("Finished upload of %s/%s", directory, a_file)
-                bytes_uploaded += file_stats.stats.st_size
 
-                if DRY_RUN:
-                    pass
+            logger.debug("upload_worker(job=%s)", job)
+            ctx.reset_log()
+            _child_conn.send(PROCESS_STARTED)
+            try:
+                if job['action'] == SCAN_DIRECTORY:
+                    _scan_directory(_child_conn, job['directory'], ctx, file_filter,
+                        local_metadata, logger, job.get('files'))
                 else:
-                    local_metadata.update_metadata(directory, a_file, file_stats, glacier_data)
-            _child_conn.send(PROCESS_FINISH_OK)
-        except:
-            _child_conn.send(PROCESS_FINISH_WITH_ERROR)
-    except:
-        logger.exception("Exception detected")
-        raise
+                    _upload_file(_child_conn, job['directory'], job['filename'],
+                        job['file_stats'], glacier, logger)
+                _child_conn.send(PROCESS_FINISH_OK)
+            except:
+                logger.exception("Exception detected when processing %s", job)
+                if job['action'] == UPLOAD_FILE:
+                    _child_conn.send((PROCESS_PROGRESS, 0, 1))
+                _child_conn.send(PROCESS_FINISH_WITH_ERROR)
+            finally:
+                # Release the DB, so it can be opened by other processes
+                local_metadata.close()
+
+            jobs_done += 1
+            if jobs_done >= max_jobs:
+                logger.info("Recycling worker after %s jobs", jobs_done)
+                break
+            if get_max_rss_mb() > max_memory_mb:
+                logger.info("Recycling worker: using %s MB", get_max_rss_mb())
+                break
+    finally:
+        local_metadata.close()
+        glacier.close()
+        _child_conn.close()
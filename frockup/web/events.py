@@ -0,0 +1,105 @@
+import json
+import logging
+import Queue
+import threading
+
+# Max. events waiting to be sent to a client: a client that falls behind is
+# disconnected (the browser re-connects, and receives the current status)
+DEFAULT_MAX_QUEUED = 1000
+
+# Seconds between the comments sent to idle clients (to detect closed connections)
+KEEPALIVE_SECONDS = 15.0
+
+
+def format_event(event_type, data):
+    """Returns the event, in the format of 'text/event-stream' (server-sent events)"""
+    return 'event: {}\ndata: {}\n\n'.format(event_type, json.dumps(data))
+
+
+class Subscription(object):
+    """Events received by a client (see `EventBroadcaster.subscribe()`)"""
+
+    def __init__(self, max_queued):
+        self.events = Queue.Queue(max_queued)
+        self.closed = False
+
+    def put(self, event):
+        """Returns False if the client fell behind (and was closed)"""
+        try:
+            self.events.put_nowait(event)
+            return True
+        except Queue.Full:
+            self.close()
+            return False
+
+    def close(self):
+        self.closed = True
+        # Wake up the client
+        try:
+            self.events.put_nowait(None)
+        except Queue.Full:
+            pass
+
+    def get(self, timeout=KEEPALIVE_SECONDS):
+        """
+        Returns the next event, or None if the subscription was closed (after
+        the queued events). Raises `Queue.Empty` if no event arrived in `timeout` seconds.
+        """
+        try:
+            return self.events.get_nowait()
+        except Queue.Empty:
+            if self.closed:
+                return None
+        return self.events.get(timeout=timeout)
+
+
+class EventBroadcaster(object):
+    """
+    Receives the status changes sent by the controller through `conn` (see
+    `ProcessController._emit_event()`), and fans them out to all the clients:
+    each change is produced once, no matter the number of clients.
+    """
+
+    def __init__(self, conn, max_queued=DEFAULT_MAX_QUEUED):
+        self.conn = conn
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.thread = threading.Thread(target=self._run, name='EventBroadcaster')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def subscribe(self):
+        subscription = Subscription(self.max_queued)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        with self.lock:
+            for subscription in list(self.subscriptions):
+                if not subscription.put(event):
+                    logging.info("Client of the events fell behind: disconnected")
+                    self.subscriptions.remove(subscription)
+
+    def _run(self):
+        try:
+            while True:
+                self.publish(self.conn.recv())
+        except EOFError:
+            logging.info("Connection with the controller closed: no more events")
+        except:
+            logging.exception("Exception detected when receiving events")
+        finally:
+            with self.lock:
+                for subscription in self.subscriptions:
+                    subscription.close()
+                del self.subscriptions[:]
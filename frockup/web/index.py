@@ -1,14 +1,18 @@
 import traceback
 import logging
 import os
+import Queue
 
-from flask import Flask, jsonify, request, json
+from flask import Flask, Response, jsonify, request, json
 
-from frockup.file_filter import FileFilter
-from frockup.common import Context
-from frockup.main import _should_process_file
-from frockup.local_metadata import LocalMetadata
+from frockup.changes import ChangeIndex
+from frockup.file_filter import CompiledFileFilter
+from frockup.common import Context, get_config_option
+from frockup.local_metadata import get_local_metadata_class
 from frockup.web.background import ProcessController
+from frockup.web.events import format_event, KEEPALIVE_SECONDS
+from frockup.web.scan_cache import DirectoryScanCache
+from frockup.web.scan_jobs import ScanJob, create_scan_pool
 
 PROCESS_CONTROLLER = ProcessController()
 
@@ -20,8 +24,17 @@ class Remote(object):
     def __init__(self):
         self.ctx = Context()
         self.ctx.set_include_extensions(('jpg',))
-        self.file_filter = FileFilter(self.ctx)
-        self.local_metadata = LocalMetadata(self.ctx)
+        self.file_filter = CompiledFileFilter(self.ctx)
+        self.local_metadata = get_local_metadata_class(self.ctx.config)(self.ctx)
+        self.scan_cache = DirectoryScanCache(self.ctx, self.file_filter, self.local_metadata)
+        # Files changed in place don't change the mtime of their directory: if the changes
+        # are tracked (see `frockup.changes`), the dirty directories are always scanned
+        self.change_index = None
+        if self.ctx.track_changes:
+            self.change_index = ChangeIndex(get_config_option(self.ctx.config, 'changes', 'index'))
+        # Scans started by `start_load_directory()`, by id, and the processes used to scan
+        self.scan_jobs = {}
+        self.scan_pool = None
         self.logger = logging.getLogger('Remote')
 
     def get_background_process_status(self, function_args):
@@ -33,7 +46,18 @@ class Remote(object):
         self.logger.info("launch_backup() - %s", function_args)
         directory_name = function_args[0]
         assert os.path.exists(directory_name)
-        data = PROCESS_CONTROLLER.launch_backup(directory_name)
+        # Optional: scheduling policy, and min. size (MB) of the files of the large file lane
+        policy = function_args[1] if len(function_args) > 1 else None
+        large_file_mb = function_args[2] if len(function_args) > 2 else None
+        data = PROCESS_CONTROLLER.launch_backup(directory_name, policy, large_file_mb)
+        self.scan_cache.invalidate(directory_name)
+        return data
+
+    def set_bandwidth_limit(self, function_args):
+        self.logger.info("set_bandwidth_limit() - %s", function_args)
+        kbps = int(function_args[0] or 0)
+        assert kbps >= 0
+        data = PROCESS_CONTROLLER.set_bandwidth_limit(kbps)
         return data
 
     def stop_all_processes(self, function_args):
@@ -41,52 +65,59 @@ class Remote(object):
         data = PROCESS_CONTROLLER.stop_all_processes()
         return data
 
-    def load_directory(self, function_args):
-        base_dir = function_args[0]
+    def _start_scan_job(self, base_dir):
         assert os.path.exists(base_dir)
+        for scan_id, job in self.scan_jobs.items():
+            if job.is_abandoned():
+                self.logger.info("Cancelling abandoned scan of '%s'", job.base_dir)
+                job.cancel()
+                del self.scan_jobs[scan_id]
+        if self.scan_pool is None:
+            self.scan_pool = create_scan_pool(self.ctx,
+                int(os.environ.get('FROCKUP_SCAN_PROCESSES', '0')) or None)
+        if self.change_index is not None:
+            for directory in self.change_index.get_dirty_directories(base_dir):
+                self.scan_cache.invalidate(directory)
+        job = ScanJob(base_dir, self.scan_cache, self.scan_pool).start()
+        self.scan_jobs[job.scan_id] = job
+        return job
 
-        directories = []
-        files = {}
-        for root, _, files in os.walk(base_dir):
-            try:
-                self.local_metadata._opendb(root, try_ro_on_error=True)
-                file_list = []
-                ignored_count = 0
-                updated_count = 0
-                pending_count = 0
-                pending_bytes = 0
-                for a_file in files:
-                    should_proc, file_stats = _should_process_file(root, a_file, self.file_filter,
-                                                          self.local_metadata, self.ctx)
-
-                    if (should_proc, file_stats) == (False, None):
-                        # Excluido!
-                        ignored_count += 1
-                    else:
-                        if should_proc is True:
-                            pending_count += 1
-                            pending_bytes += file_stats.stats.st_size
-                        elif should_proc is False:
-                            updated_count += 1
-                        else:
-                            assert False, "Invalid value for should_proc: {}".format(should_proc)
-
-                directory = {
-                    'name': root,
-                    'files': files,
-                    'files_count': len(files),
-                    'file_list': file_list,
-                    'ignored_count': ignored_count,
-                    'updated_count': updated_count,
-                    'pending_count': pending_count,
-                    'pending_bytes': pending_bytes,
-                }
-                directories.append(directory)
-            finally:
-                self.local_metadata.close()
-
+    def load_directory(self, function_args):
+        """Scans the tree and returns the results of all the directories"""
+        job = self._start_scan_job(function_args[0])
+        directories = job.get_all()
+        del self.scan_jobs[job.scan_id]
+        self.logger.info("load_directory(): %s directories (scan cache: %s)",
+            len(directories), self.scan_cache.get_status())
         return {'directories': directories}
 
+    def start_load_directory(self, function_args):
+        """
+        Starts the scan of the tree in background. The results are returned
+        by `get_load_directory_page()` as the directories are scanned.
+        """
+        self.logger.info("start_load_directory() - %s", function_args)
+        job = self._start_scan_job(function_args[0])
+        return {'scan_id': job.scan_id}
+
+    def get_load_directory_page(self, function_args):
+        scan_id = function_args[0]
+        max_results = int(function_args[1]) if len(function_args) > 1 else 500
+        job = self.scan_jobs.get(scan_id)
+        assert job is not None, "Scan not found: {}".format(scan_id)
+        directories, finished = job.get_page(max_results, timeout=0.5)
+        if finished:
+            del self.scan_jobs[scan_id]
+            self.logger.info("Scan of '%s' finished: %s directories (scan cache: %s)",
+                job.base_dir, job.directories_count, self.scan_cache.get_status())
+        return {'directories': directories, 'finished': finished}
+
+    def cancel_load_directory(self, function_args):
+        job = self.scan_jobs.pop(function_args[0], None)
+        if job is not None:
+            job.cancel()
+        return {'cancelled': job is not None}
+
 
 remote = Remote()
 
@@ -96,6 +127,37 @@ def index():
     return jsonify({'ok': True})
 
 
+@app.route('/events/')
+def events():
+    """
+    Stream of server-sent events ('text/event-stream') with the status of the
+    background processes: a 'status' event with the current status (same of
+    `get_background_process_status()`), and then the changes as they happen
+    (see `ProcessController._emit_event()`).
+    """
+    subscription = PROCESS_CONTROLLER.subscribe_events()
+
+    def _stream():
+        try:
+            # Subscribed before getting the status, so no change is lost
+            yield format_event('status', PROCESS_CONTROLLER.get_background_process_status())
+            while True:
+                try:
+                    event = subscription.get(KEEPALIVE_SECONDS)
+                except Queue.Empty:
+                    # Fails if the client disconnected
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    return
+                yield format_event(event['type'], event)
+        finally:
+            PROCESS_CONTROLLER.unsubscribe_events(subscription)
+
+    return Response(_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/callMethod/', methods=['GET', 'POST'])
 def callMethod():
     data = json.loads(request.data)
@@ -146,7 +208,8 @@ def main():
     #    logging.root.addHandler(ch)
     logging.info("Starting...")
     PROCESS_CONTROLLER.start()
-    app.run()
+    # The event streams are kept open: each client needs its own thread
+    app.run(threaded=True)
 
 if __name__ == '__main__':
     main()
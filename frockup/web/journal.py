@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import os
+
+from frockup.glacier import GlacierData
+from frockup.local_metadata import FileStats
+
+DEFAULT_JOURNAL_FILENAME = '~/.frockup/jobs.journal'
+
+# Events of the journal
+QUEUED = 'queued'
+SCANNED = 'scanned'
+STARTED = 'started'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+FINISHED = 'finished'
+
+
+def _unicode(value):
+    # The names are byte strings, not always valid UTF-8: decoded as latin-1
+    # (each byte to the code point of the same value), so they're kept as is
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    return value
+
+
+def _str(value):
+    # The inverse of `_unicode()` (`json` returns unicode)
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    return value
+
+
+def _encode_stats(file_stats):
+    # The float times are only in the dict of `__reduce__()`
+    return list(file_stats.stats.__reduce__()[1])
+
+
+def _decode_stats(value):
+    return FileStats(os.stat_result(value[0], value[1]))
+
+
+def _encode_glacier_data(glacier_data):
+    if glacier_data is None:
+        return None
+    return dict([(key, _unicode(item)) for key, item in glacier_data.__dict__.iteritems()])
+
+
+def _decode_glacier_data(value):
+    if value is None:
+        return None
+    glacier_data = GlacierData()
+    glacier_data.__dict__.update([(key, _str(item)) for key, item in value.iteritems()])
+    return glacier_data
+
+
+class JobJournal(object):
+    """
+    Append-only log (one JSON object per line) of the jobs of the controller,
+    to resume them after a restart: the directories queued, the files found
+    by the scans, and the files uploaded (with the data returned by Glacier)
+    or failed.
+
+    Each line is flushed when written, so it survives a crash of the web server
+    (but not of the OS). A truncated last line is ignored.
+    """
+
+    def __init__(self, filename=DEFAULT_JOURNAL_FILENAME):
+        # None (or empty) to disable the journal
+        self.filename = os.path.expanduser(filename) if filename else None
+        self.file = None
+
+    def open(self):
+        """Returns the state of the unfinished directories (see `replay()`), and opens the journal"""
+        if not self.filename:
+            return []
+        states = self.replay()
+        self.compact(states)
+        return states
+
+    def replay(self):
+        """
+        Returns a list with the state of the unfinished directories (dicts with
+        'directory', 'files', 'scanned' (list of `(filename, file_stats)`, None if
+        the directory wasn't scanned), 'uploaded' (dict of filename: glacier_data)
+        and 'failed' (set of filenames)).
+        """
+        states = collections.OrderedDict()
+        if not self.filename or not os.path.exists(self.filename):
+            return []
+        with open(self.filename) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warn("Ignoring invalid line of job journal: %r", line)
+                    continue
+                event, directory = record['event'], _str(record['directory'])
+                if event == QUEUED:
+                    files = record.get('files')
+                    if files is not None:
+                        files = [_str(filename) for filename in files]
+                    states[directory] = {'directory': directory, 'files': files,
+                        'scanned': None, 'uploaded': {}, 'failed': set()}
+                    continue
+                state = states.get(directory)
+                if state is None:
+                    continue
+                if event == SCANNED:
+                    state['scanned'] = [(_str(filename), _decode_stats(stats))
+                                        for filename, stats in record['files']]
+                elif event == UPLOADED:
+                    state['uploaded'][_str(record['filename'])] = \
+                        _decode_glacier_data(record['glacier_data'])
+                elif event == FAILED:
+                    state['failed'].add(_str(record['filename']))
+                elif event == FINISHED:
+                    del states[directory]
+        return states.values()
+
+    def compact(self, states):
+        """Re-writes the journal with only the given states"""
+        tmp_filename = self.filename + '.tmp'
+        self.close()
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(tmp_filename, 'w')
+        for state in states:
+            self.add_queued(state['directory'], state['files'])
+            if state['scanned'] is not None:
+                self.add_scanned(state['directory'], state['scanned'])
+            for filename, glacier_data in state['uploaded'].iteritems():
+                self.add_uploaded(state['directory'], filename, glacier_data)
+            for filename in state['failed']:
+                self.add_failed(state['directory'], filename)
+        self.file.close()
+        os.rename(tmp_filename, self.filename)
+        self.file = open(self.filename, 'a')
+
+    def truncate(self):
+        """Starts a new (empty) journal, if it's open"""
+        if self.file is not None:
+            self.compact([])
+
+    def _write(self, event, directory, **kwargs):
+        if self.file is None:
+            return
+        kwargs.update(event=event, directory=_unicode(directory))
+        self.file.write(json.dumps(kwargs) + '\n')
+        self.file.flush()
+
+    def add_queued(self, directory, files=None):
+        if files is not None:
+            files = [_unicode(filename) for filename in files]
+        self._write(QUEUED, directory, files=files)
+
+    def add_scanned(self, directory, files):
+        self._write(SCANNED, directory, files=[(_unicode(filename), _encode_stats(file_stats))
+                                               for filename, file_stats in files])
+
+    def add_started(self, directory, filename=None):
+        self._write(STARTED, directory, filename=_unicode(filename))
+
+    def add_uploaded(self, directory, filename, glacier_data):
+        self._write(UPLOADED, directory, filename=_unicode(filename),
+            glacier_data=_encode_glacier_data(glacier_data))
+
+    def add_failed(self, directory, filename):
+        self._write(FAILED, directory, filename=_unicode(filename))
+
+    def add_finished(self, directory):
+        self._write(FINISHED, directory)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,143 @@
+import collections
+import logging
+import os
+import threading
+
+from frockup.main import _should_process_file
+from frockup.walker import list_directory
+
+DEFAULT_MAX_DIRECTORIES = 100000
+
+
+class DirectoryScanCache(object):
+    """
+    Results of the scan of the directories done by `Remote.load_directory()`
+    (the counts of ignored, updated and pending files, and the sub-directories),
+    so the unchanged directories aren't scanned again. The names of the files
+    aren't kept, so the memory used depends only on the number of directories.
+
+    Each result is kept with the mtime of the directory and the signature of
+    its local metadata: it's discarded when files are created, removed or
+    renamed in the directory, or when its metadata is updated (ie: by the
+    uploads of the workers). The contents of a file changed in place don't
+    change the mtime of the directory, so they aren't detected (unless the
+    changes are tracked: see `Remote._start_scan_job()`).
+    """
+
+    def __init__(self, ctx, file_filter, local_metadata, max_directories=DEFAULT_MAX_DIRECTORIES):
+        self.ctx = ctx
+        self.file_filter = file_filter
+        self.local_metadata = local_metadata
+        self.max_directories = max_directories
+        self.lock = threading.RLock()
+        # `directory` -> `(signature, result)`, in LRU order
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_signature(self, directory):
+        """Returns the signature of the scan of `directory`, or None if it doesn't exist"""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return None
+        return (mtime, self.local_metadata.get_signature(directory))
+
+    def invalidate(self, directory):
+        with self.lock:
+            self.results.pop(directory, None)
+
+    def get(self, directory):
+        """
+        Returns `(signature, result)`: the current signature of `directory` and its
+        cached result (None if it isn't cached, or the directory changed)
+        """
+        signature = self.get_signature(directory)
+        if signature is None:
+            return None, None
+        with self.lock:
+            cached = self.results.pop(directory, None)
+            if cached is not None and cached[0] == signature:
+                self.results[directory] = cached
+                self.hits += 1
+                return signature, cached[1]
+            self.misses += 1
+        return signature, None
+
+    def put(self, directory, signature, result):
+        with self.lock:
+            self.results.pop(directory, None)
+            self.results[directory] = (signature, result)
+            while len(self.results) > self.max_directories:
+                self.results.popitem(last=False)
+
+    def scan(self, directory):
+        """
+        Returns a dict with the counts of the files of `directory` and its
+        `subdirectories`, or None if the directory can't be read.
+        """
+        # The signature is taken before the scan: a change while scanning is detected next time
+        signature, result = self.get(directory)
+        if signature is None or result is not None:
+            return result
+        result = self.scan_uncached(directory)
+        if result is not None:
+            self.put(directory, signature, result)
+        return result
+
+    def scan_uncached(self, directory):
+        """Scans `directory` (without using the cache)"""
+        try:
+            entries = list_directory(directory)
+        except OSError, e:
+            logging.warn("Couldn't list directory '%s': %s", directory, e)
+            return None
+        try:
+            return self._scan_entries(directory, entries)
+        finally:
+            # Release the DB (the snapshot of the directory is kept in the
+            # cache, and re-used while the DB isn't modified)
+            self.local_metadata.close()
+
+    def _scan_entries(self, directory, entries):
+        files_count = 0
+        subdirectories = []
+        ignored_count = 0
+        updated_count = 0
+        pending_count = 0
+        pending_bytes = 0
+        self.local_metadata.check_directory(directory)
+        for entry in sorted(entries, key=lambda item: item.name):
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            files_count += 1
+            should_proc, file_stats = _should_process_file(directory, entry.name,
+                self.file_filter, self.local_metadata, self.ctx, entry)
+
+            if (should_proc, file_stats) == (False, None):
+                # Excluido!
+                ignored_count += 1
+            elif should_proc is True:
+                pending_count += 1
+                pending_bytes += file_stats.stats.st_size
+            elif should_proc is False:
+                updated_count += 1
+            else:
+                assert False, "Invalid value for should_proc: {}".format(should_proc)
+
+        return {
+            'name': directory,
+            'files_count': files_count,
+            'file_list': [],
+            'ignored_count': ignored_count,
+            'updated_count': updated_count,
+            'pending_count': pending_count,
+            'pending_bytes': pending_bytes,
+            'subdirectories': subdirectories,
+        }
+
+    def get_status(self):
+        return {'directories': len(self.results), 'hits': self.hits, 'misses': self.misses}
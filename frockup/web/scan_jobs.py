@@ -0,0 +1,159 @@
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+import uuid
+
+from frockup.common import Context
+from frockup.file_filter import CompiledFileFilter
+from frockup.local_metadata import get_local_metadata_class
+from frockup.web.scan_cache import DirectoryScanCache
+
+# Max. results waiting to be read by the client (the scan pauses while full)
+DEFAULT_MAX_BUFFERED = 1000
+
+# Jobs not read by the client during this time are cancelled
+ABANDONED_JOB_SECONDS = 300
+
+# Scan cache of the processes of the pool (see `create_scan_pool()`)
+_worker_scan_cache = None
+
+
+def _init_scan_worker(include_extensions):
+    global _worker_scan_cache
+    ctx = Context()
+    ctx.set_include_extensions(include_extensions)
+    _worker_scan_cache = DirectoryScanCache(ctx, CompiledFileFilter(ctx),
+        get_local_metadata_class(ctx.config)(ctx))
+
+
+def _scan_in_worker(directory):
+    """Returns `(directory, signature, result)` (`result` is None on errors)"""
+    try:
+        signature = _worker_scan_cache.get_signature(directory)
+        if signature is None:
+            return directory, None, None
+        return directory, signature, _worker_scan_cache.scan_uncached(directory)
+    except:
+        logging.exception("Exception detected when scanning '%s'", directory)
+        return directory, None, None
+
+
+def create_scan_pool(ctx, processes=None):
+    """Returns the pool of processes used to scan the directories changed since the last scan"""
+    return multiprocessing.Pool(processes, _init_scan_worker, (ctx.include_extensions,))
+
+
+class ScanJob(object):
+    """
+    Scans the tree at `base_dir` in background. The directories found in
+    `scan_cache` (unchanged since the last scan) are returned right away,
+    and the others are scanned in parallel by the processes of `pool`.
+
+    The results are read by the client with `get_page()` as they are produced.
+    At most `max_buffered` results wait to be read: the scan is paused
+    while the buffer is full, so the memory used is bounded.
+    """
+
+    def __init__(self, base_dir, scan_cache, pool, max_buffered=DEFAULT_MAX_BUFFERED,
+                 max_in_flight=None):
+        self.scan_id = str(uuid.uuid4())
+        self.base_dir = base_dir
+        self.scan_cache = scan_cache
+        self.pool = pool
+        self.max_in_flight = max_in_flight or multiprocessing.cpu_count() * 2
+        self.results = Queue.Queue(max_buffered)
+        self.finished = False
+        self.cancelled = False
+        self.last_access = time.time()
+        self.directories_count = 0
+        self.thread = threading.Thread(target=self._run, name='ScanJob-' + self.scan_id)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_abandoned(self):
+        return time.time() - self.last_access > ABANDONED_JOB_SECONDS
+
+    def _emit(self, result):
+        """Queues the result for the client (waits while the buffer is full)"""
+        directory = dict(result)
+        del directory['subdirectories']
+        while not self.cancelled:
+            try:
+                self.results.put(directory, timeout=1.0)
+                self.directories_count += 1
+                return
+            except Queue.Full:
+                continue
+
+    def _run(self):
+        # Walked depth-first, so the list of directories to scan stays short
+        to_scan = [self.base_dir]
+        scanned = Queue.Queue()
+        in_flight = 0
+        try:
+            while not self.cancelled:
+                while to_scan and in_flight < self.max_in_flight and not self.cancelled:
+                    directory = to_scan.pop()
+                    signature, result = self.scan_cache.get(directory)
+                    if result is not None:
+                        self._emit(result)
+                        to_scan.extend(reversed(result['subdirectories']))
+                    elif signature is not None:
+                        self.pool.apply_async(_scan_in_worker, (directory,),
+                            callback=scanned.put)
+                        in_flight += 1
+                if not in_flight:
+                    break
+                try:
+                    directory, signature, result = scanned.get(timeout=1.0)
+                except Queue.Empty:
+                    # Check `cancelled` (the scans in flight are ignored once cancelled)
+                    continue
+                in_flight -= 1
+                if result is not None:
+                    self.scan_cache.put(directory, signature, result)
+                    self._emit(result)
+                    to_scan.extend(reversed(result['subdirectories']))
+        except:
+            logging.exception("Exception detected when scanning '%s'", self.base_dir)
+        finally:
+            self.finished = True
+
+    def get_page(self, max_results=500, timeout=1.0):
+        """
+        Returns `(directories, finished)`: up to `max_results` results (waiting up to
+        `timeout` seconds for the first one), and True if there are no more results.
+        """
+        self.last_access = time.time()
+        directories = []
+        deadline = time.time() + timeout
+        while len(directories) < max_results:
+            # `finished` is read before trying to get a result: if it was set,
+            # all the results are already in the queue
+            finished = self.finished
+            try:
+                if directories:
+                    directories.append(self.results.get_nowait())
+                else:
+                    directories.append(self.results.get(timeout=0.05))
+            except Queue.Empty:
+                if finished or directories or time.time() >= deadline:
+                    return directories, finished and self.results.empty()
+        return directories, False
+
+    def get_all(self):
+        """Waits until the scan finishes, and returns all the results"""
+        directories = []
+        while True:
+            page, finished = self.get_page()
+            directories.extend(page)
+            if finished:
+                return directories
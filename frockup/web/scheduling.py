@@ -0,0 +1,133 @@
+import collections
+import heapq
+import itertools
+
+# Policies of `JobQueue`
+FIFO = 'fifo'
+SHORTEST_FIRST = 'shortest_first'
+LARGEST_FIRST = 'largest_first'
+FAIR_SHARE = 'fair_share'
+
+POLICIES = (FIFO, SHORTEST_FIRST, LARGEST_FIRST, FAIR_SHARE)
+
+
+class JobQueue(object):
+    """
+    Jobs waiting for a worker, returned in the order decided by the policy:
+
+    - FIFO: in the order they were added
+    - SHORTEST_FIRST / LARGEST_FIRST: the smallest / largest file first
+    - FAIR_SHARE: the directories with waiting jobs take turns (round-robin,
+      a directory that gets new jobs joins at the end of the turn), and the
+      files of each directory are taken in order
+
+    Jobs without `file_stats` (ie: scans of directories) go before the files
+    (except with FIFO).
+
+    If `large_file_threshold` is set, the files of that size (or bigger) are
+    kept apart, in the 'large file lane': they're only returned by `pop(large=True)`.
+    """
+
+    def __init__(self, policy=FIFO, large_file_threshold=None):
+        assert policy in POLICIES
+        self.policy = policy
+        self.large_file_threshold = large_file_threshold
+        self.counter = itertools.count()
+        self.first_counter = itertools.count(-1, -1)
+        # For each lane (large or not), a heap of `(key, seq, job)` per directory
+        # (in the order of the turns of FAIR_SHARE)
+        self.lanes = {False: collections.OrderedDict(), True: collections.OrderedDict()}
+
+    def __len__(self):
+        return self.count(False) + self.count(True)
+
+    def __iter__(self):
+        for lane in self.lanes.itervalues():
+            for heap in lane.itervalues():
+                for _, _, job in heap:
+                    yield job
+
+    def count(self, large=False):
+        return sum([len(heap) for heap in self.lanes[large].itervalues()])
+
+    def _get_size(self, job):
+        if job.get('file_stats') is None:
+            return None
+        return job['file_stats'].stats.st_size
+
+    def _is_large(self, job):
+        size = self._get_size(job)
+        return bool(self.large_file_threshold) and size is not None and \
+            size >= self.large_file_threshold
+
+    def _get_key(self, job):
+        size = self._get_size(job)
+        if self.policy == FIFO:
+            return 0
+        if size is None:
+            return (0, 0)
+        if self.policy == SHORTEST_FIRST:
+            return (1, size)
+        if self.policy == LARGEST_FIRST:
+            return (1, -size)
+        return (1, 0)
+
+    def _push(self, job, seq):
+        lane = self.lanes[self._is_large(job)]
+        heapq.heappush(lane.setdefault(job['directory'], []), (self._get_key(job), seq, job))
+
+    def append(self, job):
+        self._push(job, next(self.counter))
+
+    def append_first(self, job):
+        """Adds a job that should be taken before the others (ie: re-queued)"""
+        self._push(job, next(self.first_counter))
+
+    def pop(self, large=False):
+        """Returns the next job of the lane, or None if there are no jobs"""
+        lane = self.lanes[large]
+        if not lane:
+            return None
+        if self.policy == FAIR_SHARE:
+            # The first directory in turn with the best job (ie: scans before files)
+            best_key = min([heap[0][0] for heap in lane.itervalues()])
+            directory = next(item for item in lane if lane[item][0][0] == best_key)
+        else:
+            directory = min(lane, key=lambda item: lane[item][0][:2])
+        heap = lane.pop(directory)
+        _, _, job = heapq.heappop(heap)
+        if heap:
+            # Goes to the end of the turn
+            lane[directory] = heap
+        return job
+
+    def clear(self):
+        """Removes all the jobs, and returns them"""
+        jobs = list(self)
+        for lane in self.lanes.itervalues():
+            lane.clear()
+        return jobs
+
+    def configure(self, policy=None, large_file_threshold=None):
+        """Changes the policy and/or the threshold of the large file lane (0 to disable it)"""
+        if policy is not None:
+            assert policy in POLICIES, "Invalid policy: {}".format(policy)
+            self.policy = policy
+        if large_file_threshold is not None:
+            self.large_file_threshold = large_file_threshold
+        # Re-order the waiting jobs
+        jobs = []
+        for lane in self.lanes.itervalues():
+            for heap in lane.itervalues():
+                jobs.extend([(seq, job) for _, seq, job in heap])
+            lane.clear()
+        for seq, job in sorted(jobs):
+            self._push(job, seq)
+
+    def get_status(self):
+        return {
+            'policy': self.policy,
+            'large_file_threshold': self.large_file_threshold,
+            'waiting': self.count(False),
+            'waiting_large': self.count(True),
+        }
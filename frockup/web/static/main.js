@@ -70,6 +70,13 @@ frockup.controller('GlobalController', function($scope, $location, $timeout, $in
         extended_status : null,
         alerts : [],
         intervalCheckBackgroundProcesses : null,
+        // EventSource of the status events, and the lines of the status, by pid or directory
+        statusEvents : null,
+        status_lines : {},
+        // Id of the scan started by checkDirectory() (null if none is running),
+        // and number of the last call to checkDirectory()
+        scanId : null,
+        scanRequest : 0,
     };
 
     /*
@@ -148,34 +155,88 @@ frockup.controller('GlobalController', function($scope, $location, $timeout, $in
         });
 
         $scope.addDirToLocalHistory($scope.extras.directory);
-
-        remoteService.callMethod('load_directory', $scope.extras.directory).success(function(data) {
+        $scope.cancelLoadDirectory();
+        var scanRequest = ++$scope.extras.scanRequest;
+
+        remoteService.callMethod('start_load_directory', $scope.extras.directory).success(function(data) {
+            if (scanRequest !== $scope.extras.scanRequest) {
+                // checkDirectory() was called again while starting this scan
+                if (data.ret)
+                    remoteService.callMethod('cancel_load_directory', data.ret.scan_id);
+                return;
+            }
             if (data.ret) {
-                $scope.extras.spinner = false;
-                $scope.extras.directories = data.ret.directories;
+                $scope.extras.scanId = data.ret.scan_id;
+                $scope.extras.directories = [];
                 $scope.extras.directories_by_dirname = {};
+                $scope.loadDirectoryPage(data.ret.scan_id);
+            } else {
+                $scope.extras.spinner = false;
+                $scope.addErrorAlert("Couldn't load directory");
+            }
+
+        }).error(function(data) {
+            if (scanRequest !== $scope.extras.scanRequest)
+                return;
+            $scope.extras.spinner = false;
+            $scope.extras.directories = [];
+            $scope.extras.directories_by_dirname = {};
+        });
+    };
+
+    /*
+     * cancelLoadDirectory()
+     */
+
+    $scope.cancelLoadDirectory = function() {
+        if ($scope.extras.scanId !== null) {
+            remoteService.callMethod('cancel_load_directory', $scope.extras.scanId);
+            $scope.extras.scanId = null;
+        }
+    };
+
+    /*
+     * loadDirectoryPage()
+     */
+
+    $scope.loadDirectoryPage = function(scanId) {
+        remoteService.callMethod('get_load_directory_page', scanId).success(function(data) {
+            if (scanId !== $scope.extras.scanId) {
+                // Replaced by a newer scan (already cancelled)
+                return;
+            }
+            if (data.ret) {
                 var i = 0;
                 for (i = 0; i < data.ret.directories.length; i++) {
                     // directory = {
                     // 'name': root,
-                    // 'files': files,
-                    // 'files_count': len(files),
+                    // 'files_count': files_count,
                     // 'file_list': file_list,
                     // 'ignored_count': ignored_count,
                     // 'updated_count': updated_count,
                     // 'pending_count': pending_count,
                     // 'pending_bytes': pending_bytes,
                     // }
+                    $scope.extras.directories.push(data.ret.directories[i]);
                     $scope.extras.directories_by_dirname[data.ret.directories[i].name] = data.ret.directories[i];
                 }
+                if (data.ret.finished) {
+                    $scope.extras.scanId = null;
+                    $scope.extras.spinner = false;
+                } else {
+                    $scope.loadDirectoryPage(scanId);
+                }
             } else {
+                $scope.extras.scanId = null;
+                $scope.extras.spinner = false;
                 $scope.addErrorAlert("Couldn't load directory");
             }
 
         }).error(function(data) {
-            $scope.extras.spinner = false;
-            $scope.extras.directories = [];
-            $scope.extras.directories_by_dirname = {};
+            if (scanId === $scope.extras.scanId) {
+                $scope.extras.scanId = null;
+                $scope.extras.spinner = false;
+            }
         });
     };
 
@@ -226,25 +287,29 @@ frockup.controller('GlobalController', function($scope, $location, $timeout, $in
      * BackgroundProcessesStatus
      */
 
+    $scope.showProcStatus = function(proc_status) {
+        // proc_status[x].pid
+        // proc_status[x].status
+        // proc_status[x].directory
+        // $scope.extras.directories
+        var i;
+        var msg = "";
+        for (i = 0; i < proc_status.length; i++) {
+            msg += "[" + proc_status[i].pid + "] " + proc_status[i].status + "\n";
+            try {
+                $scope.extras.directories_by_dirname[proc_status[i].directory].is_uploading = true;
+            } catch (e) {
+            }
+        }
+        $scope.extras.extended_status = msg;
+    };
+
     $scope.getBackgroundProcessesStatus = function() {
         remoteService.callMethod('get_background_process_status').success(function(data) {
             $scope.extras.extended_status = null;
             $scope.extras.background_process_status = data.ret.message;
             if (data && data.ret && data.ret.proc_status) {
-                // data.ret.proc_status[x].pid
-                // data.ret.proc_status[x].status
-                // data.ret.proc_status[x].directory
-                // $scope.extras.directories
-                var i;
-                var msg = "";
-                for (i = 0; i < data.ret.proc_status.length; i++) {
-                    msg += "[" + data.ret.proc_status[i].pid + "] " + data.ret.proc_status[i].status + "\n";
-                    try {
-                        $scope.extras.directories_by_dirname[data.ret.proc_status[i].directory].is_uploading = true;
-                    } catch (e) {
-                    }
-                }
-                $scope.extras.extended_status = msg;
+                $scope.showProcStatus(data.ret.proc_status);
             }
         }).error(function(data) {
             $scope.extras.background_process_status = "Couldn't get status.";
@@ -252,16 +317,116 @@ frockup.controller('GlobalController', function($scope, $location, $timeout, $in
 
     };
 
-    $scope.startBackgroundProcessesStatus = function() {
-        if ($scope.extras.intervalCheckBackgroundProcesses)
-            return;
+    /*
+     * Status events: the status is received when connected, and then the
+     * changes are pushed by the server as they happen (see '/events/')
+     */
+
+    $scope.showStatusLines = function(jobs_waiting) {
+        var workers = [];
+        var directories = [];
+        angular.forEach($scope.extras.status_lines, function(line) {
+            if (line.pid == -1)
+                directories.push(line);
+            else
+                workers.push(line);
+        });
+        $scope.extras.background_process_status = "" + workers.length + " process running, "
+                + jobs_waiting + " jobs waiting";
+        $scope.showProcStatus(workers.concat(directories));
+    };
+
+    $scope.resetStatusLines = function(status) {
+        var i;
+        $scope.extras.status_lines = {};
+        if (status.proc_status) {
+            for (i = 0; i < status.proc_status.length; i++) {
+                var line = status.proc_status[i];
+                var key = line.pid == -1 ? 'dir:' + line.directory : 'pid:' + line.pid;
+                $scope.extras.status_lines[key] = line;
+            }
+        }
+        $scope.showStatusLines(status.scheduling ?
+                status.scheduling.waiting + status.scheduling.waiting_large : 0);
+        $scope.extras.background_process_status = status.message;
+    };
+
+    $scope.handleStatusEvent = function(event) {
+        var lines = $scope.extras.status_lines;
+        if (event.pid != -1) {
+            if (event.type == 'job_finished' || event.type == 'job_error')
+                delete lines['pid:' + event.pid];
+            else
+                lines['pid:' + event.pid] = {
+                    pid : event.pid,
+                    status : event.status,
+                    directory : event.directory
+                };
+        }
+        if (event.type == 'directory_finished')
+            delete lines['dir:' + event.directory];
+        else if (event.directory_status)
+            lines['dir:' + event.directory] = {
+                pid : -1,
+                status : event.directory_status,
+                directory : event.directory
+            };
+        $scope.showStatusLines(event.jobs_waiting);
+    };
+
+    $scope.startStatusEvents = function() {
+        var source = new EventSource('/events/');
+        source.addEventListener('status', function(e) {
+            $scope.$apply(function() {
+                $scope.resetStatusLines(JSON.parse(e.data));
+            });
+        });
+        angular.forEach([ 'directory_queued', 'directory_finished', 'job_started', 'job_status',
+                'job_finished', 'job_error', 'progress' ], function(eventType) {
+            source.addEventListener(eventType, function(e) {
+                $scope.$apply(function() {
+                    $scope.handleStatusEvent(JSON.parse(e.data));
+                });
+            });
+        });
+        source.onerror = function() {
+            // The browser re-connects by itself, unless the stream isn't available
+            if (source.readyState == EventSource.CLOSED) {
+                console.warn("Status events not available: polling the status");
+                $scope.$apply(function() {
+                    $scope.extras.statusEvents = null;
+                    $scope.startStatusPolling();
+                });
+            }
+        };
+        $scope.extras.statusEvents = source;
+    };
+
+    $scope.startStatusPolling = function() {
         $scope.extras.intervalCheckBackgroundProcesses = $interval(function() {
             $scope.getBackgroundProcessesStatus();
         }, 1000);
     };
 
+    $scope.isWatchingStatus = function() {
+        return !!($scope.extras.statusEvents || $scope.extras.intervalCheckBackgroundProcesses);
+    };
+
+    $scope.startBackgroundProcessesStatus = function() {
+        if ($scope.isWatchingStatus())
+            return;
+        if (window.EventSource)
+            $scope.startStatusEvents();
+        else
+            $scope.startStatusPolling();
+    };
+
     $scope.stopBackgroundProcessesStatus = function() {
         console.info("stopBackgroundProcessesStatus()");
+        if ($scope.extras.statusEvents) {
+            $scope.extras.statusEvents.close();
+            $scope.extras.statusEvents = null;
+        }
         $interval.cancel($scope.extras.intervalCheckBackgroundProcesses);
         $scope.extras.intervalCheckBackgroundProcesses = null;
     };